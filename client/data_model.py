@@ -1,10 +1,31 @@
+import hashlib
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, validator
 
 from helpers import mask_sensitive_string
 
+###############################################################################
+## Trusted construction
+#
+# Data that has already been through validation once (serialized by the server
+# itself, e.g. snapshots, the write-ahead log, or responses of the server) is
+# rebuilt with `from_trusted`, which skips the validators: they already ran,
+# and fields declared `str = None` do not accept the nulls the server
+# serializes.
+
+
+def _construct(cls, data: dict):
+    """`cls.model_construct` for trusted data, with the fields in `data` set"""
+    return cls.model_construct(_fields_set=set(data), **data)
+
+
+def _parse_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
 
 class GPUStatus(BaseModel):
     index: int = None
@@ -15,6 +36,10 @@ class GPUStatus(BaseModel):
     memory_total: float = None  # MB
     memory_usage: float = None  # range: [0, 1]
 
+    @classmethod
+    def from_trusted(cls, data: dict) -> "GPUStatus":
+        return _construct(cls, data)
+
 
 class GPUComputeProcess(BaseModel):
     pid: int = None
@@ -38,6 +63,10 @@ class GPUComputeProcess(BaseModel):
         else:
             return ""
 
+    @classmethod
+    def from_trusted(cls, data: dict) -> "GPUComputeProcess":
+        return _construct(cls, data)
+
 
 class DiskStatus(BaseModel):
     directory: str = ""
@@ -56,6 +85,15 @@ class DiskStatus(BaseModel):
         else:
             []
 
+    @classmethod
+    def from_trusted(cls, data: dict) -> "DiskStatus":
+        data = dict(data)
+        if "created_at" in data:
+            data["created_at"] = _parse_datetime(data["created_at"])
+        if data.get("detail") is not None:
+            data["detail"] = [tuple(item) for item in data["detail"]]
+        return _construct(cls, data)
+
 
 class MachineStatus(BaseModel):
     created_at: datetime = None
@@ -111,8 +149,138 @@ class MachineStatus(BaseModel):
         else:
             return {}
 
+    @classmethod
+    def from_parts(
+        cls, profile: "MachineProfile", sample: "MachineSample"
+    ) -> "MachineStatus":
+        """
+        Join a registered profile and a sample of its machine. Both were
+        validated on their own, and the status shares their values: every status
+        of a machine references the same profile values instead of a copy.
+        """
+        data = {field: getattr(profile, field) for field in MachineProfile.model_fields}
+        for field in MachineSample.model_fields:
+            if field in cls.model_fields:
+                data[field] = getattr(sample, field)
+        return _construct(cls, data)
+
+    def split(self) -> Tuple["MachineProfile", "MachineSample"]:
+        """The profile and the sample of this status, see `from_parts`"""
+        return (
+            MachineProfile.model_construct(
+                **{field: getattr(self, field) for field in MachineProfile.model_fields}
+            ),
+            MachineSample.model_construct(
+                **{
+                    field: getattr(self, field)
+                    for field in MachineSample.model_fields
+                    if field in MachineStatus.model_fields
+                }
+            ),
+        )
+
+    @classmethod
+    def from_trusted(cls, data: dict) -> "MachineStatus":
+        data = dict(data)
+        data["created_at"] = _parse_datetime(data.get("created_at"))
+        if data.get("gpu_status") is not None:
+            data["gpu_status"] = [GPUStatus.from_trusted(g) for g in data["gpu_status"]]
+        if data.get("gpu_compute_processes") is not None:
+            data["gpu_compute_processes"] = [
+                GPUComputeProcess.from_trusted(p) for p in data["gpu_compute_processes"]
+            ]
+        if data.get("disk_system") is not None:
+            data["disk_system"] = DiskStatus.from_trusted(data["disk_system"])
+        if data.get("disk_external") is not None:
+            data["disk_external"] = [
+                DiskStatus.from_trusted(d) for d in data["disk_external"]
+            ]
+        return _construct(cls, data)
+
     def __repr__(self) -> str:
         return self.model_dump_json()
 
     def __str__(self) -> str:
         return self.__repr__()
+
+
+###############################################################################
+## Profile / sample split
+#
+# Most of a MachineStatus almost never changes (hardware, OS, drivers).
+# What changes at runtime (usage, logged-in users, addresses that DHCP or a
+# NAT may change) is part of the sample, so it does not change the profile.
+# Clients register that part as a MachineProfile once, and again whenever it
+# changes, then only send a MachineSample per report interval. The server
+# answers a sample whose `profile_hash` does not match the registered profile
+# with 409, upon which the client registers its profile again.
+#
+# The split saves upload bandwidth and validation, not storage: the server
+# joins every sample with its profile when it arrives (`MachineStatus.from_parts`)
+# and logs, snapshots and stores the full MachineStatus, as it does for /report.
+
+
+class MachineProfile(BaseModel):
+    name: str = None
+    machine_id: str = None
+    report_key: str = None
+    hostname: str = None
+    # sys info
+    architecture: str = None
+    mac_address: str = None
+    platform: str = None
+    platform_release: str = None
+    platform_version: str = None
+    linux_distro: str = None
+    processor: str = None
+    cuda_version: str = "No CUDA Installed"
+    nvidia_smi_version: str = "No GPU Driver installed"
+    cpu_model: str = None
+    cpu_cores: int = None
+
+    def content_hash(self) -> str:
+        """Hash of the profile content, the report_key is not part of it"""
+        data = self.model_dump_json(exclude={"report_key"})
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def from_trusted(cls, data: dict) -> "MachineProfile":
+        return _construct(cls, data)
+
+
+class MachineSample(BaseModel):
+    created_at: datetime = None
+    machine_id: str = None
+    report_key: str = None
+    # as returned by the server when the profile was registered
+    profile_hash: Optional[str] = None
+    # ip
+    local_ip: str = None
+    public_ip: str = None
+    ipv4s: list = None
+    ipv6s: list = None
+    uptime: float = None  # seconds
+    uptime_unit: str = "seconds"
+    uptime_str: str = None
+    # sys usage
+    cpu_usage: float = None  # range: [0, 1]
+    cpu_temp: float = None
+    ram_free: str = None  # MiB
+    ram_total: str = None  # MiB
+    ram_usage: float = None  # range: [0, 1]
+    # gpu usage
+    gpu_status: List[GPUStatus] = None
+    gpu_compute_processes: List[GPUComputeProcess] = None
+    # users info
+    users_info: Dict[str, List[str]] = None
+    # disk info
+    disk_system: DiskStatus = None
+    disk_external: List[DiskStatus] = None
+
+    @validator("created_at", pre=True, always=True)
+    def default_created_at(cls, v):
+        return v or datetime.now()
+
+    @validator("users_info", pre=True, always=True)
+    def process_users_info(cls, v):
+        return MachineStatus.process_users_info(v)
@@ -0,0 +1,177 @@
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import psutil
+
+from helpers import write_json_cache
+
+###############################################################################
+## Incremental disk usage scanner
+#
+# Sums the apparent size of all files under a directory (symlinks are not
+# followed), like `os.walk` + `os.path.getsize`, but remembers for every
+# directory the total size of the files directly in it and the names of its
+# subdirectories, keyed by the directory's inode and mtime.
+#
+# The mtime of a directory changes when entries are created, removed or
+# renamed in it (not in its subdirectories), so a rescan still visits every
+# directory with one stat(), but only lists and stats the files of the
+# directories that changed. Files that grow or shrink in place do not touch
+# the mtime of their directory: every entry is rescanned anyway once it is
+# older than `max_age`.
+#
+# The cache is kept in a JSON file between runs; directories not seen by the
+# last scan are dropped from it when it is saved.
+#
+# `detail_all` scans the top-level entries of several volumes on a pool of
+# threads (scandir and stat release the GIL), interleaving the volumes so a
+# full scan takes about as long as the slowest volume. The pool threads run
+# at idle I/O priority and the lowest CPU priority, so the scan stays out of
+# the way of the jobs running on the machine.
+
+# path -> [inode, mtime_ns, size of the files in it, subdirectory names, scanned at]
+CacheEntry = list
+
+
+def _scan_dir(directory: str) -> Tuple[int, List[str]]:
+    """Total size of the files directly in `directory`, and its subdirectories"""
+    files, subdirs = 0, []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    # removed while scanning
+                    pass
+    except OSError:
+        # no permission, or removed while scanning
+        pass
+    return files, subdirs
+
+
+def _lower_priority():
+    """Idle I/O and lowest CPU priority for the calling thread (Linux only)"""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (AttributeError, OSError):
+        pass
+    try:
+        psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, OSError, psutil.Error):
+        pass
+
+
+class DiskScanner:
+    """
+    Args:
+        path: JSON file the cache is kept in between runs
+        max_age: seconds after which a directory is scanned even if unchanged
+    """
+
+    def __init__(self, path: Path, max_age: float = 86400):
+        self.path = Path(path)
+        self.max_age = max_age
+        self._entries: Dict[str, CacheEntry] = {}
+        # entries of the directories scanned since the last `save`
+        self._seen: Dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+        try:
+            self._entries = json.loads(self.path.read_text())["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            # no cache yet, or a broken one: scan everything
+            self._entries = {}
+
+    def usage(self, path: str) -> int:
+        """Total size in bytes of the files under `path` (or of the file `path`)"""
+        try:
+            if not os.path.isdir(path):
+                return os.stat(path).st_size
+        except OSError:
+            return 0
+        now = time.time()
+        seen: Dict[str, CacheEntry] = {}
+        total = 0
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            try:
+                st = os.stat(directory)
+            except OSError:
+                continue
+            entry = self._entries.get(directory)
+            if (
+                entry is None
+                or entry[0] != st.st_ino
+                or entry[1] != st.st_mtime_ns
+                or now - entry[4] > self.max_age
+            ):
+                # stat() came first: a change while listing shows up next scan
+                files, subdirs = _scan_dir(directory)
+                entry = [st.st_ino, st.st_mtime_ns, files, subdirs, now]
+            seen[directory] = entry
+            total += entry[2]
+            stack.extend(os.path.join(directory, name) for name in entry[3])
+        with self._lock:
+            self._seen.update(seen)
+        return total
+
+    def detail_all(
+        self, directories: List[str], workers: int = 4
+    ) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        Usage of every entry of every directory, the largest first, the entries
+        scanned by up to `workers` threads at once
+        """
+        directories = list(dict.fromkeys(directories))  # e.g. /home is a partition
+        volumes = []
+        for directory in directories:
+            try:
+                paths = [
+                    os.path.join(directory, name) for name in os.listdir(directory)
+                ]
+            except OSError:
+                paths = []
+            volumes.append(
+                [
+                    (directory, path)
+                    for path in paths
+                    if os.path.isdir(path) or os.path.isfile(path)
+                ]
+            )
+        # one entry of every volume after the other, so all volumes start at once
+        tasks = [
+            task
+            for group in itertools.zip_longest(*volumes)
+            for task in group
+            if task is not None
+        ]
+        with ThreadPoolExecutor(
+            max_workers=max(1, workers),
+            thread_name_prefix="disk_scan",
+            initializer=_lower_priority,
+        ) as pool:
+            sizes = pool.map(lambda task: self.usage(task[1]), tasks)
+            result = {directory: [] for directory in directories}
+            for (directory, path), size in zip(tasks, sizes):
+                result[directory].append((os.path.basename(path), size))
+        for entries in result.values():
+            entries.sort(key=lambda x: x[1], reverse=True)
+        return result
+
+    def save(self):
+        """Keep the directories scanned since the last save, for the next run"""
+        with self._lock:
+            self._entries, self._seen = self._seen, {}
+            entries = self._entries
+        write_json_cache(self.path, dict(entries=entries))
@@ -0,0 +1,144 @@
+from typing import List, Optional, Tuple
+
+from data_model import GPUComputeProcess, GPUStatus
+
+###############################################################################
+## NVML collector
+#
+# Reads GPU and GPU process info through NVML (the library nvidia-smi is built
+# on) instead of running nvidia-smi several times per report. The library is
+# initialized once and kept open, device handles and UUIDs are looked up once,
+# and every report reads all devices and their processes in a single pass.
+# Any NVML error closes the library, `collect` returns None and the caller
+# falls back to nvidia-smi; the next report tries NVML again.
+
+MIB = 1024 * 1024
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class NVMLCollector:
+    """
+    Args:
+        nvml: the NVML bindings, `py3nvml.py3nvml` by default (imported lazily,
+            it is an optional dependency), or a double with the same API
+    """
+
+    def __init__(self, nvml=None):
+        self.nvml = nvml
+        self.error: Optional[str] = None  # why NVML is not used, if it is not
+        self._handles: List = None
+        self._uuids: List[str] = []  # by GPU index
+
+    def _init(self) -> bool:
+        if self._handles is not None:
+            return True
+        try:
+            if self.nvml is None:
+                from py3nvml import py3nvml
+
+                self.nvml = py3nvml
+            self.nvml.nvmlInit()
+            self._handles = [
+                self.nvml.nvmlDeviceGetHandleByIndex(index)
+                for index in range(self.nvml.nvmlDeviceGetCount())
+            ]
+            self._uuids = [
+                _str(self.nvml.nvmlDeviceGetUUID(handle)) for handle in self._handles
+            ]
+            self.error = None
+            return True
+        except Exception as e:  # ImportError, NVMLError (no driver, no GPU), ...
+            self.error = str(e) or type(e).__name__
+            self._handles = None
+            return False
+
+    def close(self):
+        if self._handles is not None:
+            self._handles = None
+            try:
+                self.nvml.nvmlShutdown()
+            except Exception:
+                pass
+
+    def available(self) -> bool:
+        return self._init() and len(self._handles) > 0
+
+    def driver_version(self) -> Optional[str]:
+        """Driver (and CUDA) version in the words of the nvidia-smi header"""
+        if not self.available():
+            return None
+        try:
+            version = f"Driver Version: {_str(self.nvml.nvmlSystemGetDriverVersion())}"
+            if hasattr(self.nvml, "nvmlSystemGetCudaDriverVersion"):
+                cuda = self.nvml.nvmlSystemGetCudaDriverVersion()
+                version += f"    CUDA Version: {cuda // 1000}.{cuda % 1000 // 10}"
+            return version
+        except Exception as e:
+            self.error = str(e)
+            self.close()
+            return None
+
+    def collect(self) -> Optional[Tuple[List[GPUStatus], List[GPUComputeProcess]]]:
+        """
+        Status of every GPU, and the compute processes running on them (pid,
+        GPU and GPU memory only, process details are up to the caller).
+
+        Returns:
+            None if NVML is not available or failed, see `error`
+        """
+        if not self.available():
+            return None
+        nvml = self.nvml
+        gpu_status: List[GPUStatus] = []
+        processes: List[GPUComputeProcess] = []
+        try:
+            for index, handle in enumerate(self._handles):
+                memory = nvml.nvmlDeviceGetMemoryInfo(handle)
+                gpu_status.append(
+                    GPUStatus(
+                        index=index,
+                        gpu_name=_str(nvml.nvmlDeviceGetName(handle)),
+                        gpu_usage=nvml.nvmlDeviceGetUtilizationRates(handle).gpu / 100,
+                        temperature=float(
+                            nvml.nvmlDeviceGetTemperature(
+                                handle, nvml.NVML_TEMPERATURE_GPU
+                            )
+                        ),
+                        memory_total=memory.total / MIB,
+                        memory_free=memory.free / MIB,
+                        memory_usage=round(memory.used / memory.total, 5),
+                    )
+                )
+                for process in nvml.nvmlDeviceGetComputeRunningProcesses(handle):
+                    # None when the client may not see other users' processes
+                    used = process.usedGpuMemory or 0
+                    processes.append(
+                        GPUComputeProcess(
+                            pid=process.pid,
+                            gpu_uuid=self._uuids[index],
+                            gpu_index=index,
+                            gpu_mem_used=used / MIB,
+                        )
+                    )
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            self.close()
+            return None
+        return gpu_status, processes
+
+
+if __name__ == "__main__":
+    # print what the collector reads from NVML
+    import sys
+
+    collector = NVMLCollector()
+    result = collector.collect()
+    if result is None:
+        print(f"NVML not available: {collector.error}")
+        sys.exit(1)
+    print(collector.driver_version())
+    for item in result[0] + result[1]:
+        print(item.model_dump_json())
@@ -1,5 +1,8 @@
+import json
+import os
 import subprocess
 import sys
+from pathlib import Path
 
 
 def mask_sensitive_string(value: str) -> str:
@@ -23,6 +26,20 @@ def mask_sensitive_string(value: str) -> str:
         return value[0:2] + "*" * (len(value) - 3) + value[-1]
 
 
+def write_json_cache(path: Path, data, indent: int = None):
+    """
+    Write a cache file the client keeps between runs. It is written to a
+    temporary file first so a crash never leaves half a file; on a read-only
+    install it is not written at all, and the caller keeps it in memory only.
+    """
+    tmp = path.with_suffix(".tmp")
+    try:
+        tmp.write_text(json.dumps(data, indent=indent))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
 def _run(cmd):
     try:
         return subprocess.run(
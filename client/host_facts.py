@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from helpers import write_json_cache
+
+###############################################################################
+## Static host facts
+#
+# Facts that only change when the host is reconfigured (distro, CPU model,
+# driver and CUDA versions, public IP, ...) are discovered once, kept in a JSON
+# file and reused by every report, also after the client restarts.
+#
+# Every report compares a cheap fingerprint of the host (a few stat() calls and
+# small /proc reads, no subprocesses) with the one the facts were discovered
+# under; all facts are discovered again when it changed or they are older than
+# the TTL. The fingerprint covers what the facts depend on:
+#
+#   - /etc/os-release:          distro upgrades
+#   - /usr/local/cuda:          CUDA installed, upgraded or switched
+#   - /proc/driver/nvidia:      NVIDIA driver loaded or upgraded
+#   - kernel release, boot_id:  kernel upgrades, hardware changes (need a reboot)
+
+CUDA_DIR = "/usr/local/cuda"
+
+
+def _mtime(path: str) -> Optional[str]:
+    """Target and mtime of `path`, following symlinks; None if it does not exist"""
+    try:
+        return f"{os.path.realpath(path)}@{os.stat(path).st_mtime_ns}"
+    except OSError:
+        return None
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def host_fingerprint() -> Dict[str, Optional[str]]:
+    uname = os.uname()
+    return dict(
+        os_release=_mtime("/etc/os-release"),
+        cuda=_mtime(CUDA_DIR),
+        nvidia_driver=_read("/proc/driver/nvidia/version"),
+        kernel=f"{uname.release} {uname.version}",
+        boot_id=_read("/proc/sys/kernel/random/boot_id"),
+    )
+
+
+class HostFacts:
+    """
+    Args:
+        path: JSON file the facts are kept in between runs
+        ttl: seconds after which all facts are discovered again
+        fingerprint: returns what the facts depend on, see `host_fingerprint`
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        ttl: float = 86400,
+        fingerprint: Callable[[], Dict[str, Any]] = host_fingerprint,
+    ):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.facts: Dict[str, Any] = {}
+        self._fingerprint: Dict[str, Any] = None
+        self._discovered_at: float = 0
+        try:
+            data = json.loads(self.path.read_text())
+            self.facts = dict(data["facts"])
+            self._fingerprint = data["fingerprint"]
+            self._discovered_at = float(data["discovered_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # no cache yet, or a broken one: discover everything
+            self.facts = {}
+
+    def check(self) -> bool:
+        """
+        Forget all facts if the host changed or they are older than the TTL.
+        Call once per report.
+
+        Returns:
+            True if the facts were forgotten
+        """
+        fingerprint = self.fingerprint()
+        now = time.time()
+        if fingerprint == self._fingerprint and now - self._discovered_at < self.ttl:
+            return False
+        self.facts = {}
+        self._fingerprint = fingerprint
+        self._discovered_at = now
+        self._save()
+        return True
+
+    def get(self, name: str, discover: Callable[[], Any]) -> Any:
+        """
+        The fact `name`, discovered with `discover()` if it is not known.
+        None (a failed lookup) is not kept, it is discovered again next time.
+        """
+        if name in self.facts:
+            return self.facts[name]
+        value = discover()
+        if value is not None:
+            self.facts[name] = value
+            self._save()
+        return value
+
+    def _save(self):
+        data = dict(
+            fingerprint=self._fingerprint,
+            discovered_at=self._discovered_at,
+            facts=self.facts,
+        )
+        write_json_cache(self.path, data, indent=2)
@@ -1,7 +1,9 @@
 import datetime
+import gzip
 import json
 import os
 import platform
+import random
 import re
 import shlex
 import shutil
@@ -13,14 +15,24 @@ import uuid
 from logging import DEBUG, INFO
 from pathlib import Path
 from time import sleep
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import psutil
 import requests
 from puts import get_logger
 
-from data_model import DiskStatus, GPUComputeProcess, GPUStatus, MachineStatus
+from data_model import (
+    DiskStatus,
+    GPUComputeProcess,
+    GPUStatus,
+    MachineProfile,
+    MachineStatus,
+)
+from disk_scan import DiskScanner
+from gpu_nvml import NVMLCollector
 from helpers import guid
+from host_facts import CUDA_DIR, HostFacts
+from procfs import ProcFS
 
 curr_dir = Path(__file__).resolve().parent.parent
 CONFIG_PATH = curr_dir / "config.json"
@@ -45,6 +57,16 @@ SERVER = str(configs.get("api_address", ""))
 REPORT_KEY = str(configs.get("report_key", ""))
 INTERVAL = int(configs.get("report_interval", 5))
 LOGGER_LVL = str(configs.get("logger_level", "INFO")).upper()
+# gzip, zstd (needs the zstandard package) or none
+COMPRESSION = str(configs.get("report_compression", "gzip")).lower()
+# nvml (falls back to nvidia-smi when NVML is not available) or nvidia-smi
+GPU_BACKEND = str(configs.get("gpu_backend", "nvml")).lower()
+# seconds static host facts (distro, CPU, driver, public IP, ...) are reused
+HOST_FACTS_TTL = float(configs.get("host_facts_ttl", 86400))
+# seconds after which the disk scanner rescans a directory even if unchanged
+DISK_SCAN_MAX_AGE = float(configs.get("disk_scan_max_age", 86400))
+# threads scanning the top-level directories of /home and the partitions
+DISK_SCAN_WORKERS = int(configs.get("disk_scan_workers", 4))
 
 if not SERVER:
     logger.error("Server address not found in config.json")
@@ -62,14 +84,38 @@ if LOGGER_LVL == "DEBUG":
 else:
     logger.setLevel(INFO)
 
+if COMPRESSION == "zstd":
+    try:
+        import zstandard
+    except ImportError:
+        logger.warning("zstandard is not installed, compressing reports with gzip")
+        COMPRESSION = "gzip"
+
 ###############################################################################
 ## Constants
 
 POST_URL = SERVER + "/report"
+PROFILE_URL = SERVER + "/profile"
+SAMPLE_URL = SERVER + "/sample"
 HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
-PUBLIC_IP: str = ""
+# profile_hash the server returned for our profile, and our own hash of that
+# profile to notice when it changes (the server hashes it after masking)
+PROFILE_HASH: str = ""
+LOCAL_PROFILE_HASH: str = ""
+# False once the server answered /profile with 404 (no profile support)
+PROFILE_SUPPORTED: bool = True
+# seconds the server asked us to wait (Retry-After of a 429 / 503 response)
+RETRY_AFTER: float = 0
 MACHINE_ID = guid()
 logger.info(f"This Machine ID: {MACHINE_ID}")
+# kept open for the lifetime of the client, see gpu_nvml.py
+NVML = NVMLCollector() if GPU_BACKEND == "nvml" else None
+# reads /proc, os-release and utmp without forking, see procfs.py
+PROCFS = ProcFS()
+# kept between runs, see host_facts.py
+HOST_FACTS = HostFacts(
+    Path(__file__).resolve().parent / "host_facts.json", HOST_FACTS_TTL
+)
 
 ###############################################################################
 ## Networks
@@ -126,7 +172,7 @@ def get_public_ip() -> str:
     Get the public IP address of the current machine
 
     To minimize the number of requests, we cache the public IP address once obtained.
-    The cache is stored in the global variable `PUBLIC_IP`.
+    The cache is kept with the static host facts in `HOST_FACTS` (and on disk).
     When the cache is empty, we make a request to ipify.org to get the public IP address.
     The correctness of the IP address is not guaranteed.
 
@@ -136,17 +182,17 @@ def get_public_ip() -> str:
     Raises:
         Strictly no exception is raised.
     """
-    global PUBLIC_IP
-    if not PUBLIC_IP:
-        try:
-            # https://www.ipify.org/
-            PUBLIC_IP = requests.get(
-                "https://api64.ipify.org", timeout=5
-            ).content.decode("utf-8")
-        except Exception as e:
-            logger.error(e)
+    return HOST_FACTS.get("public_ip", _request_public_ip) or ""
 
-    return PUBLIC_IP
+
+def _request_public_ip() -> Optional[str]:
+    try:
+        # https://www.ipify.org/
+        r = requests.get("https://api64.ipify.org", timeout=5)
+        return r.content.decode("utf-8")
+    except Exception as e:
+        logger.error(e)
+        return None
 
 
 def get_temp_status():
@@ -183,20 +229,31 @@ def get_fans_status():
 ###############################################################################
 ## System
 
+NVCC = CUDA_DIR + "/bin/nvcc"
+
 
 def get_nvidia_smi_version():
+    if NVML is not None:
+        version = NVML.driver_version()
+        if version is not None:
+            return version
+    if shutil.which("nvidia-smi") is None:
+        return "No NVIDIA driver found"
     success, smi_output = run_command("nvidia-smi")
     if not success:
-        return "No NVIDIA driver found"
+        # e.g. the driver is still loading: None is discovered again next report
+        return None
     for line in smi_output.split("\n"):
         if "NVIDIA-SMI" in line:
             return line.strip()
 
 
 def get_cuda_version():
-    success, nvcc_version = run_command("/usr/local/cuda/bin/nvcc --version")
-    if not success:
+    if not os.path.exists(NVCC):
         return "CUDA not installed"
+    success, nvcc_version = run_command(f"{NVCC} --version")
+    if not success:
+        return None
     cuda_version = nvcc_version.split()[-1].split()[-1]
     return cuda_version
 
@@ -274,12 +331,10 @@ def _get_sys_uptime() -> Tuple[float, str]:
     Raises:
         None
     """
-    cmd = "cat /proc/uptime"
-    success, output = run_command(cmd)
-    if not success:
+    uptime = PROCFS.uptime()
+    if uptime is None:
         return -1, "NA"
 
-    uptime = float(output.split()[0])
     days = int(uptime // 86400)
     hours = int((uptime % 86400) // 3600)
     minutes = int((uptime % 3600) // 60)
@@ -294,77 +349,89 @@ def _get_sys_uptime() -> Tuple[float, str]:
     return uptime, uptime_str
 
 
-def _get_distro() -> str:
+def _get_distro() -> Optional[str]:
     """Get the name of the Linux distribution.
 
     Compatibility: All mainstream Linux distributions
 
     Returns:
-        str: name of the Linux distribution
+        str: name of the Linux distribution, None if not found
 
     Raises:
         None
     """
-    cmd = "cat /etc/os-release | grep PRETTY_NAME | cut -d '=' -f 2 | tr -d '\"'"
-    success, output = run_shell_command(cmd)
-    if not success:
-        logger.error(f"Error encountered: {output}")
-    return output if success else "NA"
+    distro = PROCFS.distro()
+    if distro is None:
+        logger.error("PRETTY_NAME not found in os-release")
+    return distro
 
 
-def _get_cpu_model() -> str:
+def _get_cpu_model() -> Optional[str]:
     """Get the CPU model name.
     Compatibility: All mainstream Linux distributions
 
     Returns:
-        str: CPU model name
+        str: CPU model name, None if /proc/cpuinfo cannot be read
 
     Raises:
         None
     """
-    cmd = "awk -F: '/model name/ {name=$2} END {print name}' /proc/cpuinfo"
-    success, output = run_command(cmd)
-    return output if success else "NA"
+    cpu_info = PROCFS.cpu_info()
+    return cpu_info["model"] if cpu_info is not None else None
 
 
-def _get_cpu_cores() -> int:
+def _get_cpu_cores() -> Optional[int]:
     """Get the number of CPU cores.
     Compatibility: All mainstream Linux distributions
 
     Returns:
-        int: number of CPU cores
+        int: number of CPU cores, None if /proc/cpuinfo cannot be read
 
     Raises:
         None
     """
-    cmd = "awk -F: '/processor/ {core++} END {print core}' /proc/cpuinfo"
-    success, output = run_command(cmd)
-    return int(output) if success else 0
+    cpu_info = PROCFS.cpu_info()
+    return cpu_info["cores"] if cpu_info is not None else None
 
 
 def _get_mac_address() -> str:
     return ":".join(re.findall("..", "%012x" % uuid.getnode()))
 
 
+# static facts of get_sys_info, discovered once and kept in HOST_FACTS. A fact
+# discovered as None (the lookup failed) is not kept and reported as below.
+SYS_FACTS_FALLBACK = dict(
+    linux_distro="NA",
+    cpu_model="NA",
+    cpu_cores=0,
+    nvidia_smi_version="No NVIDIA driver found",
+    cuda_version="CUDA not installed",
+)
+SYS_FACTS = dict(
+    platform=platform.system,
+    linux_distro=_get_distro,
+    platform_release=platform.release,
+    platform_version=platform.version,
+    architecture=platform.machine,
+    processor=platform.processor,
+    mac_address=_get_mac_address,
+    cpu_model=_get_cpu_model,
+    cpu_cores=_get_cpu_cores,
+    nvidia_smi_version=get_nvidia_smi_version,
+    cuda_version=get_cuda_version,
+)
+
+
 def get_sys_info() -> Dict[str, str]:
     info = {}
     try:
         uptime, uptime_str = _get_sys_uptime()
-        info = dict(
-            uptime=uptime,
-            uptime_str=uptime_str,
-            platform=platform.system(),
-            linux_distro=_get_distro(),
-            platform_release=platform.release(),
-            platform_version=platform.version(),
-            architecture=platform.machine(),
-            processor=platform.processor(),
-            mac_address=_get_mac_address(),
-            cpu_model=_get_cpu_model(),
-            cpu_cores=_get_cpu_cores(),
-            nvidia_smi_version=get_nvidia_smi_version(),
-            cuda_version=get_cuda_version(),
-        )
+        info = dict(uptime=uptime, uptime_str=uptime_str)
+        for name, discover in SYS_FACTS.items():
+            value = HOST_FACTS.get(name, discover)
+            if value is None:
+                value = SYS_FACTS_FALLBACK.get(name)
+            info[name] = value
     except Exception as e:
         logger.error(e)
         info["error"] = str(e)
@@ -406,14 +473,10 @@ def _get_proc_info(pid: int) -> dict:
 ## CPU & RAM & DISK
 
 
-def get_usage(start_path="."):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if not os.path.islink(fp):
-                total_size += os.path.getsize(fp)
-    return total_size
+# caches the directories it scanned between runs, see disk_scan.py
+DISK_SCANNER = DiskScanner(
+    Path(__file__).resolve().parent / "disk_scan_cache.json", DISK_SCAN_MAX_AGE
+)
 
 
 def human_readable_size(size, decimal_places=2):
@@ -424,14 +487,7 @@ def human_readable_size(size, decimal_places=2):
     return f"{size:.{decimal_places}f}{unit}"
 
 
-def get_disk_detail(directory):
-    entries = (os.path.join(directory, entry) for entry in os.listdir(directory))
-    entries = (
-        (os.path.basename(path), get_usage(path))
-        for path in entries
-        if os.path.isdir(path) or os.path.isfile(path)
-    )
-    sorted_entries = sorted(entries, key=lambda x: x[1], reverse=True)
+def _readable_detail(sorted_entries):
     sorted_entries = [
         (user, human_readable_size(usage)) for (user, usage) in sorted_entries
     ]
@@ -468,20 +524,23 @@ def get_disk_status():
     #     < current_time
     # ):
 
+    # scan /home and all partitions at once, see disk_scan.py
+    partitions = sorted(get_external_partitions())
+    details = DISK_SCANNER.detail_all(["/home"] + partitions, DISK_SCAN_WORKERS)
+
     total, used, free = get_disk_usage("/home")
     disk_system.usage = used / total
-    details = get_disk_detail("/home")
     disk_system = DiskStatus(
         directory="/home",
         created_at=current_time,
         usage=(used / total),
         free=human_readable_size(free),
         total=human_readable_size(total),
-        detail=details,
+        detail=_readable_detail(details["/home"]),
     )
 
     disk_external = []
-    for partition in get_external_partitions():
+    for partition in partitions:
         total, used, free = get_disk_usage(partition)
         disk_ext = DiskStatus(
             directory=partition,
@@ -489,10 +548,12 @@ def get_disk_status():
             usage=used / total,
             free=human_readable_size(free),
             total=human_readable_size(total),
-            detail=get_disk_detail(partition),
+            detail=_readable_detail(details[partition]),
         )
         disk_external.append(disk_ext)
 
+    DISK_SCANNER.save()
+
 
 from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -535,6 +596,10 @@ def _get_online_users() -> List[str]:
     Raises:
         None, all errors should be handled internally.
     """
+    users = PROCFS.online_users()
+    if users is not None:
+        return list(set(users))
+    # no utmp file (e.g. macOS keeps utmpx elsewhere)
     success, output = run_command("users")
     if success:
         return list(set(output.split()))
@@ -724,25 +789,49 @@ def get_gpu_compute_processes() -> List[GPUComputeProcess]:
         gpu_proc.gpu_index = gpu_uuid_index_map.get(gpu_proc.gpu_uuid, -1)
         gpu_proc.gpu_mem_used = float(row[2].strip(" MiB"))
 
-        # get more details of the process from ps
-        proc_info: dict = _get_proc_info(gpu_proc.pid)
-        gpu_proc.user = proc_info.get("user", "")
-        gpu_proc.cpu_usage = proc_info.get("cpu_usage", "")
-        gpu_proc.cpu_mem_usage = proc_info.get("cpu_mem_usage", "")
-        gpu_proc.proc_uptime = proc_info.get("proc_uptime", 0)
-        gpu_proc.proc_uptime_str = proc_info.get("proc_uptime_str", "")
-        gpu_proc.command = proc_info.get("command", "")
-
+        _add_proc_info(gpu_proc)
         gpu_compute_processes.append(gpu_proc)
 
     return gpu_compute_processes
 
 
+def _add_proc_info(gpu_proc: GPUComputeProcess):
+    # get more details of the process from ps
+    proc_info: dict = _get_proc_info(gpu_proc.pid) or {}
+    gpu_proc.user = proc_info.get("user", "")
+    gpu_proc.cpu_usage = proc_info.get("cpu_usage", "")
+    gpu_proc.cpu_mem_usage = proc_info.get("cpu_mem_usage", "")
+    gpu_proc.proc_uptime = proc_info.get("proc_uptime", 0)
+    gpu_proc.proc_uptime_str = proc_info.get("proc_uptime_str", "")
+    gpu_proc.command = proc_info.get("command", "")
+
+
+def get_gpu_info() -> Optional[Tuple[List[GPUStatus], List[GPUComputeProcess]]]:
+    """
+    GPU status and compute processes, read through NVML in one pass when
+    possible, with nvidia-smi otherwise. None when there is no GPU.
+    """
+    if NVML is not None:
+        result = NVML.collect()
+        if result is not None:
+            gpu_status, gpu_compute_processes = result
+            for gpu_proc in gpu_compute_processes:
+                _add_proc_info(gpu_proc)
+            return gpu_status, gpu_compute_processes
+        logger.debug(f"NVML not available ({NVML.error}), using nvidia-smi")
+    if _nvidia_exist():
+        return get_gpu_status(), get_gpu_compute_processes()
+    return None
+
+
 ###############################################################################
 ## get status
 
 
 def get_status() -> MachineStatus:
+    # rediscover static facts if the host changed since they were discovered
+    if HOST_FACTS.check():
+        logger.info("Discovering static host facts")
     ip = get_ip()
     sys_info = get_sys_info()
     sys_usage = get_sys_usage()
@@ -783,9 +872,9 @@ def get_status() -> MachineStatus:
     status.disk_system = sys_usage.get("disk_system", "")
     status.disk_external = sys_usage.get("disk_external", "")
     # GPU
-    if _nvidia_exist():
-        status.gpu_status = get_gpu_status()
-        status.gpu_compute_processes = get_gpu_compute_processes()
+    gpu_info = get_gpu_info()
+    if gpu_info is not None:
+        status.gpu_status, status.gpu_compute_processes = gpu_info
     # USER
     status.users_info = get_users_info()
 
@@ -796,16 +885,114 @@ def get_status() -> MachineStatus:
 ## Main
 
 
+def _compress(data: bytes) -> bytes:
+    if COMPRESSION == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def post_to_server(url: str, data: str) -> requests.Response:
+    """
+    POST a JSON body to the server, compressed unless COMPRESSION is "none".
+
+    Servers that cannot decompress it (older versions answer 415 or 422) get
+    the plain body, and compression is turned off if that is accepted.
+    """
+    global COMPRESSION
+    body = data.encode("utf-8")
+    if COMPRESSION in ("gzip", "zstd"):
+        headers = dict(HEADERS, **{"Content-Encoding": COMPRESSION})
+        r = requests.post(url, data=_compress(body), headers=headers)
+        if r.status_code not in (415, 422):
+            return r
+        r = requests.post(url, data=body, headers=HEADERS)
+        if r.status_code < 400:
+            logger.warning(f"Server rejected {COMPRESSION} reports, sending them plain")
+            COMPRESSION = "none"
+        return r
+    return requests.post(url, data=body, headers=HEADERS)
+
+
+def _accepted(r: requests.Response) -> bool:
+    """
+    201: the report was applied, 202: the server queued it.
+    When the server is overloaded (429 / 503), remember its Retry-After.
+    """
+    global RETRY_AFTER
+    if r.status_code in (201, 202):
+        return True
+    if r.status_code in (429, 503):
+        try:
+            RETRY_AFTER = float(r.headers.get("Retry-After", 0))
+        except ValueError:
+            RETRY_AFTER = 0
+    logger.error(f"status_code: {r.status_code}")
+    return False
+
+
+def register_profile(profile: MachineProfile) -> bool:
+    """
+    Register the static part of the status with the server, and remember the
+    profile_hash it returns for the samples.
+    """
+    global PROFILE_HASH, LOCAL_PROFILE_HASH, PROFILE_SUPPORTED
+    data: str = profile.model_dump_json()
+    r = post_to_server(PROFILE_URL, data)
+    if r.status_code == 404:
+        logger.warning("Server does not support profiles, reporting full statuses")
+        PROFILE_SUPPORTED = False
+        return False
+    if r.status_code != 201:
+        logger.error(f"status_code: {r.status_code}")
+        return False
+    PROFILE_HASH = r.json()["profile_hash"]
+    LOCAL_PROFILE_HASH = profile.content_hash()
+    logger.info(f"Machine profile registered ({PROFILE_HASH}).")
+    return True
+
+
 def report_to_server(status: MachineStatus) -> bool:
+    """
+    Report the status as a sample, (re-)registering the profile first when it
+    changed or the server does not know it.
+    Servers without profile support get the full status on /report, for as
+    long as the client runs.
+    """
+    global PROFILE_HASH
     # remove machine time
     status.created_at = None
+    profile, sample = status.split()
+
+    for _ in range(2):
+        if not PROFILE_SUPPORTED:
+            break
+        if not PROFILE_HASH or profile.content_hash() != LOCAL_PROFILE_HASH:
+            if not register_profile(profile):
+                break
+        sample.profile_hash = PROFILE_HASH
+        r = post_to_server(SAMPLE_URL, sample.model_dump_json())
+        if r.status_code == 409:
+            # the server lost or replaced our profile, register it again
+            PROFILE_HASH = ""
+            continue
+        return _accepted(r)
+
     data: str = status.model_dump_json()
-    r = requests.post(POST_URL, data=data, headers=HEADERS)
-    if r.status_code != 201:
-        logger.error(f"status_code: {r.status_code}")
-        return False
-    else:
-        return True
+    r = post_to_server(POST_URL, data)
+    return _accepted(r)
+
+
+def next_report_delay(recovery_delay: float) -> float:
+    """
+    Seconds until the next report: INTERVAL with +-10% jitter, plus a random
+    share of the recovery delay on top of the server's Retry-After, so clients
+    that failed together (e.g. after a network blip) do not retry in lockstep.
+    """
+    global RETRY_AFTER
+    delay = INTERVAL * random.uniform(0.9, 1.1)
+    delay += RETRY_AFTER + random.uniform(0, recovery_delay)
+    RETRY_AFTER = 0
+    return delay
 
 
 def main(debug_mode: bool = False) -> None:
@@ -819,13 +1006,15 @@ def main(debug_mode: bool = False) -> None:
         #######################################################################
         # 1. Report status to server immediately after the script starts
         # 2. On subsequent runs, report status to server after every INTERVAL seconds
-        # 3. If any error occurs, wait for (INTERVAL + recovery_delay) seconds before trying again
+        # 3. If any error occurs, wait for up to (INTERVAL + recovery_delay) seconds
+        #    (at least the server's Retry-After) before trying again
         if first_time:
             first_time = False
         else:
             # sleep for a while
-            logger.info(f"Next status report in {INTERVAL + recovery_delay} seconds...")
-            sleep(INTERVAL + recovery_delay)
+            delay = next_report_delay(recovery_delay)
+            logger.info(f"Next status report in {delay:.0f} seconds...")
+            sleep(delay)
 
         #######################################################################
         # Catch all exceptions to prevent the script from crashing
@@ -849,7 +1038,7 @@ def main(debug_mode: bool = False) -> None:
             # Post the status to the server
             successful = report_to_server(status)
             if successful:
-                logger.info("201 OK. Machine Status posted to server.")
+                logger.info("OK. Machine Status posted to server.")
                 # Reset the recovery delay to zero
                 recovery_delay = 0
             else:
@@ -0,0 +1,131 @@
+import os
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional
+
+###############################################################################
+## procfs / utmp readers
+#
+# Read what the client used to get from `cat`, `awk`, `users` and a shell
+# pipeline straight from the files, so a report forks no process for them
+# (fork/exec is slow on compute nodes with large page tables).
+#
+# Files under /proc are generated anew on every read, so those read every
+# report are opened once and read with pread() from offset 0 (which also
+# makes them safe to read from several threads). Regular files (os-release,
+# utmp) can be replaced by package upgrades or log rotation and are opened on
+# every read.
+#
+# All paths are relative to `root`, so the readers can be pointed at a fixture
+# tree (e.g. root/proc/uptime, root/etc/os-release, root/run/utmp).
+
+# struct utmp of glibc on Linux (same layout on 32 and 64 bit), see utmp(5)
+UTMP_STRUCT = struct.Struct("<hxxi32s4s32s256shhiii4i20s")
+UTMP_USER_PROCESS = 7
+
+
+class ProcFS:
+    """
+    Args:
+        root: directory the absolute paths are resolved in, "/" for this host
+    """
+
+    def __init__(self, root: str = "/"):
+        self.root = Path(root)
+        self._fds: Dict[str, int] = {}
+
+    def _path(self, path: str) -> Path:
+        return self.root / path.lstrip("/")
+
+    def _read(self, path: str) -> Optional[str]:
+        try:
+            return self._path(path).read_text()
+        except OSError:
+            return None
+
+    def _read_proc(self, path: str, size: int = 4096) -> Optional[str]:
+        """Read a /proc file through a descriptor kept open"""
+        fd = self._fds.get(path)
+        try:
+            if fd is None:
+                fd = self._fds[path] = os.open(self._path(path), os.O_RDONLY)
+            return os.pread(fd, size, 0).decode()
+        except OSError:
+            self._fds.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+            return None
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def uptime(self) -> Optional[float]:
+        """Seconds since boot, from /proc/uptime"""
+        content = self._read_proc("/proc/uptime")
+        try:
+            return float(content.split()[0])
+        except (AttributeError, IndexError, ValueError):
+            return None
+
+    def cpu_info(self) -> Optional[Dict[str, object]]:
+        """
+        Model (of the last processor listed) and number of processors, from
+        /proc/cpuinfo
+        """
+        content = self._read("/proc/cpuinfo")
+        if content is None:
+            return None
+        model, cores = "", 0
+        for line in content.splitlines():
+            key, _, value = line.partition(":")
+            key = key.strip()
+            if key == "processor":
+                cores += 1
+            elif key == "model name":
+                model = value.strip()
+        return dict(model=model, cores=cores)
+
+    def distro(self) -> Optional[str]:
+        """PRETTY_NAME of os-release(5)"""
+        for path in ("/etc/os-release", "/usr/lib/os-release"):
+            content = self._read(path)
+            if content is None:
+                continue
+            for line in content.splitlines():
+                key, _, value = line.partition("=")
+                if key.strip() == "PRETTY_NAME":
+                    return value.strip().strip("\"'")
+            return None
+        return None
+
+    def online_users(self) -> Optional[List[str]]:
+        """Users logged in (with duplicates, like `users`), from utmp"""
+        for path in ("/run/utmp", "/var/run/utmp"):
+            try:
+                data = self._path(path).read_bytes()
+            except OSError:
+                continue
+            users = []
+            size = UTMP_STRUCT.size
+            for offset in range(0, len(data) - size + 1, size):
+                record = UTMP_STRUCT.unpack_from(data, offset)
+                if record[0] == UTMP_USER_PROCESS:
+                    user = record[4].split(b"\0", 1)[0].decode(errors="replace")
+                    if user:
+                        users.append(user)
+            return sorted(users)
+        return None
+
+
+if __name__ == "__main__":
+    # print what the readers find, on this host or in the tree given as argument
+    import sys
+
+    procfs = ProcFS(sys.argv[1] if len(sys.argv) > 1 else "/")
+    print(f"uptime:       {procfs.uptime()}")
+    print(f"cpu_info:     {procfs.cpu_info()}")
+    print(f"distro:       {procfs.distro()}")
+    print(f"online_users: {procfs.online_users()}")
+    procfs.close()
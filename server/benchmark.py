@@ -0,0 +1,641 @@
+"""
+Benchmarks for the server's in-memory data structures.
+
+Usage:
+    python benchmark.py gpu_record --rows 100000 1000000
+    python benchmark.py ingest --reports 5000 --machines 50 --concurrency 64
+    python benchmark.py compression --directories 300 --processes 20 --machines 50
+    python benchmark.py load --fleet 10 100 1000 5000 --output load.json
+    python benchmark.py database --machines 10 100 --processes 0 20 --history 10 100
+    python benchmark.py validation --directories 300 --processes 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import product
+from typing import Callable, List
+
+from gpu_record import GPURecordBuffer
+
+###############################################################################
+## GPU record: list of dicts vs columnar ring buffer
+
+
+class ListGPURecord:
+    """The previous `Database.gpu_record`: a list of dicts trimmed with pop(0)"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.records = []
+
+    def append(self, user, time, machine_id):
+        self.records.append(dict(user=user, time=time, machine_id=machine_id))
+        while len(self.records) >= self.capacity:
+            self.records.pop(0)
+
+
+def _fake_rows(n: int, n_users: int = 50, n_machines: int = 40):
+    start = datetime.now() - timedelta(days=7)
+    for i in range(n):
+        yield (
+            f"us**{i % n_users}",
+            start + timedelta(seconds=i),
+            f"machine-{i % n_machines:04d}",
+        )
+
+
+def bench_gpu_record(rows: int, steady_appends: int) -> dict:
+    result = dict(rows=rows, steady_appends=steady_appends)
+    for name, cls in (("list", ListGPURecord), ("ring_buffer", GPURecordBuffer)):
+        # memory is measured on a separate fill, tracemalloc skews timings
+        tracemalloc.start()
+        store = cls(rows)
+        for row in _fake_rows(rows):
+            store.append(*row)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del store
+
+        store = cls(rows)
+        start = time.perf_counter()
+        for row in _fake_rows(rows):
+            store.append(*row)
+        fill_time = time.perf_counter() - start
+
+        # steady state: every append evicts the oldest record
+        start = time.perf_counter()
+        for row in _fake_rows(steady_appends):
+            store.append(*row)
+        steady_time = time.perf_counter() - start
+
+        result[name] = dict(
+            fill_seconds=round(fill_time, 4),
+            steady_us_per_append=round(steady_time / steady_appends * 1e6, 3),
+            peak_memory_mb=round(peak / 1024 / 1024, 2),
+        )
+    return result
+
+
+###############################################################################
+## Ingest: concurrent /report posts against the real app
+
+
+def _fake_status(machine_id: str, report_key: str, n_processes: int) -> dict:
+    return dict(
+        name=machine_id,
+        machine_id=machine_id,
+        report_key=report_key,
+        hostname=machine_id,
+        cpu_cores=8,
+        cpu_usage=0.5,
+        ram_usage=0.5,
+        gpu_status=[dict(index=i, gpu_name="A100", gpu_usage=0.5) for i in range(4)],
+        gpu_compute_processes=[
+            dict(pid=pid, user=f"user{pid}", gpu_index=pid % 4, command="python")
+            for pid in range(n_processes)
+        ],
+        users_info=dict(all_users=["user0", "user1"], online_users=["user0"]),
+        disk_system=dict(directory="/home", usage=0.5, free="1GB", total="2GB"),
+        disk_external=[],
+    )
+
+
+def bench_ingest(reports: int, machines: int, concurrency: int) -> dict:
+    """
+    Throughput of `/report`: fire `reports` concurrent posts from `machines`
+    machines (the endpoint is sync, so they run in FastAPI's threadpool) with a
+    snapshot written half-way. Reports of a machine overtaken by a later one are
+    dropped by the server. The invariants of the data are checked by
+    tests/test_database.py.
+    Runs in a temporary directory, so no real data is touched.
+    """
+    import httpx
+
+    os.chdir(tempfile.mkdtemp(prefix="declare-servers-bench-"))
+    import main
+    from database import configs
+
+    db = main.db
+    statuses = [
+        _fake_status(f"machine-{i % machines:04d}", configs["report_key"], i % 3)
+        for i in range(reports)
+    ]
+
+    async def post_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+
+            async def post(status):
+                async with semaphore:
+                    response = await client.post("/report", json=status)
+                    accepted = (
+                        response.status_code == 201 and response.json()["accepted"]
+                    )
+                    return response.status_code, bool(accepted)
+
+            async def save_half_way():
+                while db.version < reports // 2:
+                    await asyncio.sleep(0.001)
+                await asyncio.to_thread(db.save)
+
+            responses, _ = await asyncio.gather(
+                asyncio.gather(*[post(status) for status in statuses]),
+                save_half_way(),
+            )
+            return responses
+
+    start = time.perf_counter()
+    responses = asyncio.run(post_all())
+    duration = time.perf_counter() - start
+
+    accepted = sum(ok for _, ok in responses)
+    return dict(
+        reports=reports,
+        machines=machines,
+        concurrency=concurrency,
+        seconds=round(duration, 3),
+        reports_per_second=round(reports / duration, 1),
+        dropped=reports - accepted,
+        snapshot_seconds=db.save_stats["last_duration"],
+        # responses other than 201, by status code
+        errors=dict(Counter(code for code, _ in responses if code != 201)),
+    )
+
+
+###############################################################################
+## Compression: bytes on the wire and CPU cost of gzip / zstd
+
+
+def _large_status(machine_id: str, directories: int, processes: int) -> dict:
+    status = _fake_status(machine_id, "report-key", processes)
+    for process in status["gpu_compute_processes"]:
+        process["command"] = (
+            f"/home/{process['user']}/miniconda3/envs/train/bin/python -m torch."
+            f"distributed.run --nproc_per_node 8 train.py --config configs/"
+            f"exp{process['pid']}.yaml --output /data/{process['user']}/runs"
+        )
+    status["disk_system"]["detail"] = [
+        (f"/home/user{i}", f"{(i * 7919) % 1000}.{i % 100}GB")
+        for i in range(directories)
+    ]
+    return status
+
+
+def _codecs():
+    from compression import compress, decompress, supported_encodings
+
+    for encoding in supported_encodings():
+        for level in (1, 6) if encoding == "gzip" else (1, 3):
+            yield (
+                f"{encoding}-{level}",
+                lambda data, e=encoding, l=level: compress(data, e, l),
+                lambda data, e=encoding: decompress(data, e),
+            )
+
+
+def bench_compression(
+    directories: int, processes: int, machines: int, repeat: int = 20
+) -> dict:
+    from pydantic import TypeAdapter
+
+    from data_model import MachineStatus
+
+    report = MachineStatus(**_large_status("machine-0000", directories, processes))
+    payloads = dict(
+        report=report.model_dump_json().encode(),
+        server_status=TypeAdapter(List[MachineStatus]).dump_json(
+            [
+                MachineStatus(
+                    **_large_status(f"machine-{i:04d}", directories, processes)
+                )
+                for i in range(machines)
+            ]
+        ),
+    )
+
+    result = dict(directories=directories, processes=processes, machines=machines)
+    for name, payload in payloads.items():
+        result[name] = dict(identity=dict(bytes=len(payload)))
+        for codec, compress, decompress in _codecs():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                compressed = compress(payload)
+            compress_time = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                decompress(compressed)
+            decompress_time = (time.perf_counter() - start) / repeat
+            result[name][codec] = dict(
+                bytes=len(compressed),
+                ratio=round(len(payload) / len(compressed), 2),
+                compress_ms=round(compress_time * 1e3, 3),
+                decompress_ms=round(decompress_time * 1e3, 3),
+            )
+    return result
+
+
+###############################################################################
+## Validation: full pydantic validation vs trusted construction
+
+
+def bench_validation(directories: int, processes: int, repeat: int) -> dict:
+    """
+    Cost per report of every hop a status takes after it was validated on
+    ingest: the response of the server and the parsing in the web app, before
+    (validated again at every hop) and after (`from_trusted`) the trusted path.
+    """
+    from pydantic import TypeAdapter
+
+    from data_model import MachineStatus
+
+    adapter = TypeAdapter(List[MachineStatus])
+    data = _large_status("machine-0000", directories, processes)
+    status = MachineStatus(**data)
+    # fields declared `str = None` etc. do not validate an explicit null,
+    # so the validated hops get the status without them
+    body = status.model_dump_json(exclude_none=True).encode()
+
+    def timed(fn) -> float:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - start) / repeat * 1e3
+
+    hops = dict(
+        # the one validation that has to happen
+        ingest=timed(lambda: MachineStatus.model_validate_json(body)),
+        # `response_model=List[MachineStatus]`: dumped, validated, dumped again
+        response_validated=timed(
+            lambda: adapter.dump_json(
+                adapter.validate_python([status.model_dump(exclude_none=True)])
+            )
+        ),
+        response_trusted=timed(lambda: adapter.dump_json([status])),
+        # included in the web and load hops below
+        json_decode=timed(lambda: json.loads(body)),
+        # web/main.py parsing the response
+        web_validated=timed(lambda: MachineStatus.parse_obj(json.loads(body))),
+        web_trusted=timed(lambda: MachineStatus.from_trusted(json.loads(body))),
+        # startup, decoding snapshots and the write-ahead log
+        load_validated=timed(lambda: MachineStatus(**json.loads(body))),
+        load_trusted=timed(lambda: MachineStatus.from_trusted(json.loads(body))),
+    )
+    before = (
+        hops["ingest"]
+        + hops["response_validated"]
+        + hops["web_validated"]
+        + hops["load_validated"]
+    )
+    after = (
+        hops["ingest"]
+        + hops["response_trusted"]
+        + hops["web_trusted"]
+        + hops["load_trusted"]
+    )
+    return dict(
+        directories=directories,
+        processes=processes,
+        report_bytes=len(body),
+        ms_per_report={name: round(ms, 4) for name, ms in hops.items()},
+        total_ms_per_report=dict(before=round(before, 4), after=round(after, 4)),
+    )
+
+
+###############################################################################
+## Load: HTTP latency and memory as the fleet grows
+
+
+def _realistic_status(
+    machine_id: str, report_key: str, gpus: int, processes: int, directories: int
+) -> dict:
+    status = _large_status(machine_id, directories, processes)
+    status["report_key"] = report_key
+    status["gpu_status"] = [
+        dict(
+            index=i,
+            gpu_name="NVIDIA A100-SXM4-80GB",
+            gpu_usage=(i * 37 % 100) / 100,
+            temperature=40 + i,
+            memory_free=20000.0,
+            memory_total=81920.0,
+            memory_usage=0.75,
+        )
+        for i in range(gpus)
+    ]
+    for process in status["gpu_compute_processes"]:
+        process.update(gpu_index=process["pid"] % gpus, gpu_mem_used=4096.0)
+    return status
+
+
+def _latency_summary(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+    return dict(
+        requests=len(latencies),
+        p50_ms=round(latencies[len(latencies) // 2] * 1e3, 3),
+        p99_ms=round(
+            latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1e3, 3
+        ),
+        mean_ms=round(statistics.fmean(latencies) * 1e3, 3),
+    )
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def bench_load(
+    fleet: List[int],
+    gpus: int,
+    processes: int,
+    directories: int,
+    concurrency: int,
+    reads: int,
+) -> dict:
+    """
+    Grow a fleet of machines step by step (every step adds machines up to the
+    next fleet size, then has the whole fleet report once) against the real app
+    through an in-process ASGI client, and measure per step:
+    /report throughput and latency, /server_status and /gpu_record latency,
+    and the resident memory of the process.
+    Runs in a temporary directory, so no real data is touched.
+    """
+    import httpx
+
+    os.chdir(tempfile.mkdtemp(prefix="declare-servers-load-"))
+    import main
+    from database import configs
+    from metrics import process_rss_bytes
+
+    report_key = configs["report_key"]
+    view = dict(view_key=configs["view_key"])
+
+    async def timed(client, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(method, url, kwargs):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.request(method, url, **kwargs)
+                return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[send(*request) for request in requests])
+        duration = time.perf_counter() - start
+        return (
+            [latency for latency, _ in results],
+            Counter(c for _, c in results),
+            duration,
+        )
+
+    async def run():
+        steps = []
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for machines in fleet:
+                # every machine of the fleet reports once
+                reports = [
+                    (
+                        "POST",
+                        "/report",
+                        dict(
+                            json=_realistic_status(
+                                f"machine-{i:05d}",
+                                report_key,
+                                gpus,
+                                processes,
+                                directories,
+                            )
+                        ),
+                    )
+                    for i in range(machines)
+                ]
+                latencies, codes, duration = await timed(client, reports, concurrency)
+                step = dict(
+                    machines=machines,
+                    report=dict(
+                        _latency_summary(latencies),
+                        reports_per_second=round(machines / duration, 1),
+                        status_codes=dict(codes),
+                    ),
+                )
+                for name, url, params in (
+                    ("server_status", "/server_status", view),
+                    ("gpu_record", "/gpu_record", dict(view, limit=1000)),
+                ):
+                    # sequential, it is the latency of one dashboard poll
+                    latencies, codes, _ = await timed(
+                        client, [("GET", url, dict(params=params))] * reads, 1
+                    )
+                    step[name] = dict(
+                        _latency_summary(latencies), status_codes=dict(codes)
+                    )
+                step["rss_mb"] = round(process_rss_bytes() / 1024 / 1024, 1)
+                steps.append(step)
+        return steps
+
+    rss_before = process_rss_bytes()
+    steps = asyncio.run(run())
+    return dict(
+        revision=_git_revision(),
+        python=platform.python_version(),
+        started_at=datetime.now().isoformat(),
+        gpus=gpus,
+        processes=processes,
+        directories=directories,
+        concurrency=concurrency,
+        initial_rss_mb=round(rss_before / 1024 / 1024, 1),
+        steps=steps,
+    )
+
+
+###############################################################################
+## Database: time and memory per operation, by fleet and history size
+
+
+def _measure(fn: Callable, repeat: int) -> dict:
+    """Time per call over `repeat` calls, and peak memory of one more (traced) call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    duration = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(
+        ms_per_op=round(duration * 1e3, 4),
+        peak_memory_mb=round(peak / 1024 / 1024, 3),
+    )
+
+
+def bench_database(
+    machines: int, processes: int, history: int, storage: str, repeat: int
+) -> dict:
+    """
+    `Database` operations on a fleet of `machines`, each having reported
+    `history` times with `processes` GPU processes per report: ingest, reads
+    for the dashboard, snapshots, and loading a snapshot back from storage.
+    Runs in a fresh temporary directory, so no real data is touched.
+    """
+    os.chdir(tempfile.mkdtemp(prefix="declare-servers-db-"))
+    from data_model import MachineStatus
+    from database import Database, configs
+    from storage import create_storage
+
+    configs = dict(configs, storage=storage)
+    db = Database(storage=create_storage(configs))
+    start_time = datetime.now() - timedelta(
+        seconds=history * configs["report_interval"]
+    )
+    # the statuses are built up front, only `add` is measured
+    reports = [
+        MachineStatus(
+            **_fake_status(
+                f"machine-{i % machines:05d}", configs["report_key"], processes
+            ),
+            created_at=start_time
+            + timedelta(seconds=i * configs["report_interval"] / machines),
+        )
+        for i in range(machines * (history + 1 + repeat))
+    ]
+    fill, extra = reports[: machines * history], iter(reports[machines * history :])
+
+    result = dict(
+        machines=machines, processes=processes, history=history, storage=storage
+    )
+    start = time.perf_counter()
+    for status in fill:
+        db.add(status)
+    result["add"] = dict(
+        ms_per_op=round((time.perf_counter() - start) / len(fill) * 1e3, 4)
+    )
+    # steady state: every machine has a full history, appends evict
+    result["add_steady"] = _measure(lambda: db.add(next(extra)), repeat)
+
+    result["get_status"] = _measure(db.get_status, repeat)
+    result["get_gpu_record"] = _measure(db.get_gpu_record, repeat)
+    result["gpu_records"] = len(db.gpu_record)
+    result["save"] = _measure(db.save, max(1, repeat // 10))
+    result["snapshot_bytes"] = db.save_stats["last_snapshot_bytes"]
+    db.storage.close()
+
+    def load_status_data():
+        loaded = create_storage(configs)
+        # decode everything, JSON snapshots decode histories lazily
+        sum(
+            len(status_list)
+            for status_list in loaded.load_status_data(db.max_records).values()
+        )
+        loaded.close()
+
+    def load_gpu_record():
+        loaded = create_storage(configs)
+        loaded.load_gpu_record(GPURecordBuffer(db.max_gpu_records))
+        loaded.close()
+
+    result["load_status_data"] = _measure(load_status_data, max(1, repeat // 10))
+    result["load_gpu_record"] = _measure(load_gpu_record, max(1, repeat // 10))
+    return result
+
+
+###############################################################################
+## Main
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    gpu_record = subparsers.add_parser("gpu_record")
+    gpu_record.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    gpu_record.add_argument("--steady-appends", type=int, default=2000)
+
+    ingest = subparsers.add_parser("ingest")
+    ingest.add_argument("--reports", type=int, default=5000)
+    ingest.add_argument("--machines", type=int, default=50)
+    ingest.add_argument("--concurrency", type=int, default=64)
+
+    compression = subparsers.add_parser("compression")
+    compression.add_argument("--directories", type=int, default=300)
+    compression.add_argument("--processes", type=int, default=20)
+    compression.add_argument("--machines", type=int, default=50)
+
+    load = subparsers.add_parser("load")
+    load.add_argument("--fleet", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    load.add_argument("--gpus", type=int, default=8)
+    load.add_argument("--processes", type=int, default=16)
+    load.add_argument("--directories", type=int, default=100)
+    load.add_argument("--concurrency", type=int, default=64)
+    load.add_argument("--reads", type=int, default=20)
+    load.add_argument("--output", help="also write the results to this JSON file")
+
+    database = subparsers.add_parser("database")
+    database.add_argument("--machines", type=int, nargs="+", default=[10, 100, 1000])
+    database.add_argument("--processes", type=int, nargs="+", default=[0, 20])
+    database.add_argument("--history", type=int, nargs="+", default=[10, 100])
+    database.add_argument("--storage", nargs="+", default=["json"])
+    database.add_argument("--repeat", type=int, default=20)
+
+    validation = subparsers.add_parser("validation")
+    validation.add_argument("--directories", type=int, default=300)
+    validation.add_argument("--processes", type=int, default=20)
+    validation.add_argument("--repeat", type=int, default=200)
+
+    args = parser.parse_args()
+    if args.benchmark == "gpu_record":
+        results = [bench_gpu_record(rows, args.steady_appends) for rows in args.rows]
+    elif args.benchmark == "ingest":
+        results = bench_ingest(args.reports, args.machines, args.concurrency)
+    elif args.benchmark == "compression":
+        results = bench_compression(args.directories, args.processes, args.machines)
+    elif args.benchmark == "load":
+        results = bench_load(
+            args.fleet,
+            args.gpus,
+            args.processes,
+            args.directories,
+            args.concurrency,
+            args.reads,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    elif args.benchmark == "validation":
+        results = bench_validation(args.directories, args.processes, args.repeat)
+    elif args.benchmark == "database":
+        results = [
+            bench_database(machines, processes, history, storage, args.repeat)
+            for machines, processes, history, storage in product(
+                args.machines, args.processes, args.history, args.storage
+            )
+        ]
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
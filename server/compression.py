@@ -0,0 +1,154 @@
+import gzip
+import json
+import zlib
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is always available
+    zstandard = None
+
+###############################################################################
+### Request body decompression
+#
+# Clients may compress what they post (`Content-Encoding: gzip` or `zstd`).
+# Responses are compressed by starlette's GZipMiddleware, see main.py.
+
+# decompressed bodies larger than this are rejected (e.g. zip bombs)
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+def supported_encodings() -> list:
+    encodings = ["gzip"]
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def compress(data: bytes, encoding: str, level: int = None) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6 if level is None else level)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(
+            data
+        )
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def decompress(data: bytes, encoding: str, max_size: int = MAX_BODY_SIZE) -> bytes:
+    """
+    Decompress a request body.
+
+    Raises:
+        ValueError: unsupported encoding, corrupt data, or more than `max_size` bytes
+    """
+    if encoding == "gzip":
+        # a body may be several concatenated gzip members, like zstd frames
+        members, size, remaining = [], 0, data
+        while True:
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            try:
+                member = decompressor.decompress(remaining, max_size - size + 1)
+            except zlib.error as e:
+                raise ValueError(f"Invalid gzip body: {e}")
+            size += len(member)
+            if size > max_size:
+                raise ValueError(f"Decompressed body exceeds {max_size} bytes")
+            if not decompressor.eof:
+                raise ValueError("Invalid gzip body: truncated")
+            members.append(member)
+            remaining = decompressor.unused_data
+            if not remaining:
+                return b"".join(members)
+    if encoding == "zstd" and zstandard is not None:
+        try:
+            # a body may be several concatenated frames (e.g. a streaming client)
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                data, read_across_frames=True
+            )
+            body = reader.read(max_size + 1)
+            if len(body) > max_size:
+                raise ValueError(f"Decompressed body exceeds {max_size} bytes")
+            # the reader returns what it can of a truncated frame without an
+            # error: check that every frame ends, the body is at most `max_size`
+            remaining = data
+            while remaining:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+                decompressor.decompress(remaining)
+                if not decompressor.eof:
+                    raise ValueError("Invalid zstd body: truncated")
+                remaining = decompressor.unused_data
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Invalid zstd body: {e}")
+        return body
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+class RequestDecompressionMiddleware:
+    """
+    ASGI middleware that decompresses request bodies with a Content-Encoding,
+    so endpoints always see plain JSON. Unsupported encodings get a 415,
+    bodies that cannot be decompressed a 400.
+    """
+
+    def __init__(self, app, max_size: int = MAX_BODY_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        encoding = headers.get(b"content-encoding", b"identity").decode().lower()
+        if encoding == "identity":
+            return await self.app(scope, receive, send)
+
+        if encoding not in supported_encodings():
+            return await self._reject(send, 415, f"Unsupported encoding: {encoding}")
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        try:
+            # up to `max_size` bytes of CPU work, kept off the event loop
+            body = await run_in_threadpool(
+                decompress, b"".join(chunks), encoding, self.max_size
+            )
+        except ValueError as e:
+            return await self._reject(send, 400, str(e))
+
+        scope = dict(
+            scope,
+            headers=[
+                (key, value)
+                for key, value in scope["headers"]
+                if key not in (b"content-encoding", b"content-length")
+            ]
+            + [(b"content-length", str(len(body)).encode())],
+        )
+
+        pending = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive_body():
+            # the body once, then whatever comes next (e.g. http.disconnect)
+            return pending.pop() if pending else await receive()
+
+        await self.app(scope, receive_body, send)
+
+    @staticmethod
+    async def _reject(send, status: int, detail: str):
+        body = json.dumps({"detail": detail}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
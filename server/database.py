@@ -1,13 +1,23 @@
+import atexit
+import contextlib
 import json
-import os
-from collections import defaultdict
-from datetime import datetime, timedelta
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
-import pandas as pd
+from pydantic import TypeAdapter
 
-from data_model import MachineStatus
+from data_model import MachineProfile, MachineSample, MachineStatus
+from downsample import downsample
+from gpu_record import GPURecordBuffer
+from ledger import GPUHourLedger
+from metrics import DATABASE_ADD, DATABASE_SAVE
+from persister import SnapshotWorker
+from storage import create_storage
+from timeseries import TimeSeriesStore
 
 curr_dir = Path(__file__).resolve().parent.parent
 CONFIG_PATH = curr_dir / "config.json"
@@ -21,93 +31,447 @@ with CONFIG_PATH.open(mode="r") as f:
 ### Databse Definition and Initialization
 
 
+STATUS_LIST_ADAPTER = TypeAdapter(List[MachineStatus])
+
+
 class Database:
-    def __init__(self, record_filename, gpu_record_filename):
+    def __init__(self, storage):
         self.last_updated = datetime.now()
-        self.record_filename = record_filename
-        self.gpu_record_filename = gpu_record_filename
-        self.STATUS_DATA: Dict[str, List[MachineStatus]] = self.load_status_data()
+        # bytes of statuses persisted since the last compaction was requested
+        self._appended_bytes = 0
+        self.storage = storage
+        # bumped on every applied status, identifies the state of `get_status()`
+        self.version = 0
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._status_cache: Tuple[int, bytes, str] = None
         self.max_records = 10
-        self.max_gpu_records = 1e5
-        self.gpu_record: List[Dict] = self.load_gpu_record()
+        self.max_gpu_records = int(1e5)
+        self.STATUS_DATA: Dict[str, List[MachineStatus]] = storage.load_status_data(
+            self.max_records
+        )
+        self.gpu_record = GPURecordBuffer(self.max_gpu_records)
+        storage.load_gpu_record(self.gpu_record)
+        self.gpu_ledger = GPUHourLedger(
+            max_gap=configs.get("ledger_max_gap", 3 * configs["report_interval"]),
+            retention_days=configs.get("ledger_days", 365),
+        )
+        state = storage.load_state()
+        self.gpu_ledger.load(state.get("gpu_ledger", {}))
+        self.timeseries = TimeSeriesStore(
+            report_interval=configs["report_interval"],
+            raw_days=configs.get("timeseries_raw_days", 1),
+            rollups=configs.get("timeseries_rollups", [[300, 30], [3600, 365]]),
+        )
+        self.timeseries.load(storage.load_timeseries())
+        # registered profile of every machine, with its content hash
+        self.profiles: Dict[str, Tuple[str, MachineProfile]] = {}
+        for data in state.get("profiles", []):
+            self._set_profile(MachineProfile.from_trusted(data))
+        # latest status of every machine, read without locking by `get_status()`
+        self._latest: Dict[str, MachineStatus] = {}
+        # called with (previous status, status) for every status applied after
+        # startup, in order per machine; must be cheap and must not raise
+        self.listeners: List[
+            Callable[[Optional[MachineStatus], MachineStatus], None]
+        ] = []
 
-    def add(self, status: MachineStatus):
-        machine_id = status.machine_id
-        status_list = self.STATUS_DATA[machine_id]
-        status_list.append(status)
-        current_time = datetime.now()
+        # Statuses are sharded by machine_id: the shard lock of a machine
+        # serializes its storage append and status list, so reports of different
+        # machines are ingested concurrently; the utilization history of a
+        # machine is also only touched under its shard lock. `_shared_lock`
+        # guards what all machines write to (GPU records, ledger, version,
+        # compaction schedule);
+        # it is held briefly and never while acquiring a shard lock.
+        # `_save_lock` makes sure only one snapshot is written at a time.
+        self._shards = [
+            threading.Lock() for _ in range(configs.get("database_shards", 16))
+        ]
+        self._shared_lock = threading.Lock()
+        self._save_lock = threading.Lock()
 
-        for process in status.gpu_compute_processes:
-            self.gpu_record.append(
-                dict(user=process.user, time=status.created_at, machine_id=machine_id)
-            )
+        # every accepted status is persisted by the storage backend first,
+        # snapshots are only written when the storage is compacted
+        self.replay()
+        atexit.register(self.storage.close)
 
-        # Each status list of certain length
-        while len(status_list) >= self.max_records:
-            status_list.pop(0)
+        self.save_stats = dict(
+            saves=0,
+            last_saved_at=None,
+            last_duration=None,  # seconds
+            max_duration=None,  # seconds
+            last_snapshot_bytes=None,
+            last_status_records=None,
+            last_gpu_records=None,
+        )
+        self.snapshot_worker = SnapshotWorker(self)
+        self.snapshot_worker.start()
 
-        # only keep the gpu record history for two weeks
-        days_later = status_list[0].created_at + timedelta(days=configs["history_days"])
-        if current_time >= days_later:
-            self.gpu_record.pop(0)
-        while len(self.gpu_record) >= self.max_gpu_records:
-            self.gpu_record.pop(0)
+    def _shard(self, machine_id: str) -> int:
+        return hash(machine_id) % len(self._shards)
 
-        # only update machine_status.json file every hour
-        one_hour_later = self.last_updated + timedelta(
-            seconds=configs["write_interval"]
-        )
-        if current_time >= one_hour_later:
+    @contextlib.contextmanager
+    def _locked(self, shards, shared: bool = False):
+        """Hold the given shard locks (and `_shared_lock`), always taken in the same order"""
+        with contextlib.ExitStack() as locks:
+            for shard in sorted(set(shards)):
+                locks.enter_context(self._shards[shard])
+            if shared:
+                locks.enter_context(self._shared_lock)
+            yield
+
+    def add(self, status: MachineStatus) -> bool:
+        """
+        Add a status, unless it is not newer than the latest status of its
+        machine (e.g. a report that was overtaken by a later one), as in
+        `add_many` and on replay.
+
+        Returns:
+            bool: whether the status was added
+        """
+        start = time.perf_counter()
+        record = status.model_dump_json()
+        with self._shards[self._shard(status.machine_id)]:
+            status_list = self.STATUS_DATA.get(status.machine_id)
+            if status_list and status.created_at <= status_list[-1].created_at:
+                return False
+            self.storage.append(status, record)
+            self._apply([status])
+        self._schedule_compaction(len(record))
+        DATABASE_ADD.observe(time.perf_counter() - start, method="add")
+        return True
+
+    def add_many(self, statuses: List[MachineStatus]) -> int:
+        """
+        Add a batch of statuses, possibly of several machines (e.g. samples a
+        client buffered while offline, or a gateway relaying a rack), with one
+        acquisition of the locks and one storage append.
+        Statuses are applied oldest first; those not newer than the latest
+        status of their machine are skipped, as they would be on replay.
+
+        Returns:
+            int: the number of statuses added
+        """
+        start = time.perf_counter()
+        statuses = sorted(statuses, key=lambda status: status.created_at)
+        with self._locked(self._shard(status.machine_id) for status in statuses):
+            latest = {}
+            accepted = []
+            for status in statuses:
+                machine_id = status.machine_id
+                if machine_id not in latest:
+                    status_list = self.STATUS_DATA.get(machine_id)
+                    latest[machine_id] = (
+                        status_list[-1].created_at if status_list else None
+                    )
+                if (
+                    latest[machine_id] is not None
+                    and status.created_at <= latest[machine_id]
+                ):
+                    continue
+                latest[machine_id] = status.created_at
+                accepted.append(status)
+            records = [status.model_dump_json() for status in accepted]
+            self.storage.append_many(accepted, records)
+            self._apply(accepted)
+        self._schedule_compaction(sum(len(record) for record in records))
+        DATABASE_ADD.observe(time.perf_counter() - start, method="add_many")
+        return len(accepted)
+
+    def _schedule_compaction(self, appended: int):
+        # compact the storage periodically, or earlier once `compact_wal_bytes`
+        # were appended since the last compaction (so a burst of reports does
+        # not grow the log, and the replay on startup, without bound);
+        # the snapshot is written by the background worker
+        current_time = datetime.now()
+        with self._shared_lock:
+            self._appended_bytes += appended
+            next_compaction = self.last_updated + timedelta(
+                seconds=configs.get("compact_interval", configs["write_interval"])
+            )
+            if current_time < next_compaction and self._appended_bytes < configs.get(
+                "compact_wal_bytes", 64 << 20
+            ):
+                return
             self.last_updated = current_time
-            self.save()
-
-    def load_status_data(self):
-        try:
-            if os.path.exists(self.record_filename):
-                with open(self.record_filename, "r") as f:
-                    data = json.load(f)
-                    status_data = {
-                        key: [MachineStatus.parse_obj(json.loads(o)) for o in values]
-                        for key, values in data.items()
-                    }
-                    return defaultdict(list, status_data)
-            return defaultdict(list)
-        except Exception as e:
-            print(e)
-            return defaultdict(list)
-
-    def load_gpu_record(self):
-        if os.path.exists(self.gpu_record_filename):
-            df = pd.read_csv(self.gpu_record_filename)
-            records = df.to_dict(orient="records")
-            return records
-        else:
-            return []
+            self._appended_bytes = 0
+        self.snapshot_worker.request()
+
+    def _set_profile(self, profile: MachineProfile) -> str:
+        profile_hash = profile.content_hash()
+        self.profiles[profile.machine_id] = (profile_hash, profile)
+        return profile_hash
+
+    def register_profile(self, profile: MachineProfile) -> str:
+        """Register (or replace) the profile of a machine, return its content hash"""
+        with self._shards[self._shard(profile.machine_id)]:
+            return self._set_profile(profile)
+
+    def join_sample(self, sample: MachineSample) -> Optional[MachineStatus]:
+        """
+        The status made of a sample and the registered profile of its machine,
+        None if the machine has no registered profile with the sample's hash.
+        Samples are joined on write, the status is persisted like any other.
+        """
+        profile_hash, profile = self.profiles.get(sample.machine_id, (None, None))
+        if profile is None or profile_hash != sample.profile_hash:
+            return None
+        return MachineStatus.from_parts(profile, sample)
+
+    def replay(self):
+        replayed = 0
+        for record in self.storage.replay():
+            try:
+                # records were validated before they were logged
+                status = MachineStatus.from_trusted(json.loads(record))
+            except Exception as e:
+                # most likely a torn write at the tail of the last log segment
+                print(f"Skipping unreadable WAL record: {e}")
+                continue
+            # the snapshot may already contain records of a segment that was
+            # not deleted yet, statuses are never older than the latest one
+            status_list = self.STATUS_DATA.get(status.machine_id)
+            if status_list and status.created_at <= status_list[-1].created_at:
+                continue
+            self._apply([status])
+            replayed += 1
+        if replayed:
+            print(f"Replayed {replayed} status reports from the write-ahead log")
+
+    def _apply(self, statuses: List[MachineStatus]):
+        """Apply statuses to the in-memory data, called with their shard locks held"""
+        for status in statuses:
+            status_list = self.STATUS_DATA[status.machine_id]
+            status_list.append(status)
+            # Each status list of certain length
+            while len(status_list) >= self.max_records:
+                status_list.pop(0)
+            self.timeseries.add(status)
+            previous = self._latest.get(status.machine_id)
+            self._latest[status.machine_id] = status
+            for listener in self.listeners:
+                listener(previous, status)
+        current_time = datetime.now()
+
+        with self._shared_lock:
+            # bumped after `_latest` is updated, so a version never names stale data
+            self.version += len(statuses)
+            for status in statuses:
+                for process in status.gpu_compute_processes or []:
+                    self.gpu_record.append(
+                        process.user, status.created_at, status.machine_id
+                    )
+                self.gpu_ledger.add(status)
+
+            # only keep the gpu record history for `history_days`,
+            # the ring buffer itself caps it at `max_gpu_records`
+            self.gpu_record.evict_before(
+                current_time - timedelta(days=configs["history_days"])
+            )
+
+    def snapshot(self) -> dict:
+        """
+        Take a consistent copy of the in-memory data and start a new log segment.
+        Only the containers are copied, statuses are never mutated once added,
+        so holding the locks here costs O(machines + gpu records) memcpy.
+
+        The utilization history arrays are copied afterwards, one shard at a
+        time, so ingestion only waits for the machines of one shard. A history
+        may then include statuses logged after the new segment started: the
+        store ignores them when they are replayed.
+        """
+        with self._locked(range(len(self._shards)), shared=True):
+            snapshot = dict(
+                token=self.storage.rotate(),
+                status_data=self.STATUS_DATA.copy(),
+                gpu_columns=self.gpu_record.to_codes(),
+                state=dict(
+                    gpu_ledger=self.gpu_ledger.to_dict(),
+                    profiles=[
+                        profile.model_dump(mode="json")
+                        for _, profile in self.profiles.values()
+                    ],
+                ),
+            )
+        shards = {}
+        for machine_id in self.timeseries.machines.copy():
+            shards.setdefault(self._shard(machine_id), []).append(machine_id)
+        snapshot["timeseries"] = {}
+        for shard, machine_ids in shards.items():
+            with self._shards[shard]:
+                for machine_id in machine_ids:
+                    snapshot["timeseries"][machine_id] = self.timeseries.state(
+                        machine_id
+                    )
+        return snapshot
 
     def save(self):
-        with open(self.record_filename, "w") as f:
-            json.dump(self.to_dict(), f)
+        """
+        Compact the storage: write a full snapshot of everything received so far
+        and drop what it supersedes (log segments, rows past `history_days`).
+        Serialization and file I/O happen outside of the database locks, so `add` is
+        never blocked by a snapshot being written.
+        """
+        with self._save_lock:
+            start = time.perf_counter()
+            snapshot = self.snapshot()
 
-        df = pd.DataFrame(self.gpu_record)
-        df.to_csv(self.gpu_record_filename, index=False)
+            snapshot_bytes = self.storage.write_snapshot(
+                snapshot["token"],
+                snapshot["status_data"],
+                snapshot["gpu_columns"],
+                snapshot["state"],
+                snapshot["timeseries"],
+            )
+
+            duration = time.perf_counter() - start
+            DATABASE_SAVE.observe(duration)
+            self.save_stats.update(
+                saves=self.save_stats["saves"] + 1,
+                last_saved_at=datetime.now(),
+                last_duration=duration,
+                max_duration=max(duration, self.save_stats["max_duration"] or 0),
+                last_snapshot_bytes=snapshot_bytes,
+                last_status_records=sum(
+                    len(status_list)
+                    for status_list in snapshot["status_data"].values()
+                    if isinstance(status_list, list)
+                ),
+                last_gpu_records=len(snapshot["gpu_columns"]["time"]),
+            )
+            print(
+                f"Saved snapshot in {duration:.3f}s "
+                f"({self.save_stats['last_snapshot_bytes']} bytes)"
+            )
 
     def get_status(self) -> List[MachineStatus]:
-        machine_ids = sorted(list(self.STATUS_DATA.keys()), reverse=True)
-        machine_status = [
-            self.STATUS_DATA[machine_id][-1] for machine_id in machine_ids
-        ]
+        """
+        Latest status of every machine, without taking any lock: `_latest` is
+        only ever updated by single item assignments, and copying it is atomic.
+        """
+        latest = self._latest.copy()
+        for machine_id in list(self.STATUS_DATA.keys()):
+            if machine_id not in latest:
+                # loaded on startup and not reported since
+                status_list = self.STATUS_DATA[machine_id]
+                if status_list:
+                    latest[machine_id] = self._latest.setdefault(
+                        machine_id, status_list[-1]
+                    )
+        machine_ids = sorted(latest.keys(), reverse=True)
+        machine_status = [latest[machine_id] for machine_id in machine_ids]
         return machine_status
 
-    def get_gpu_record(self) -> list[dict]:
-        return self.gpu_record
+    def get_status_json(self) -> Tuple[bytes, str]:
+        """
+        `get_status()` serialized to JSON, and an ETag for it.
+        The bytes are cached until the next status is applied, so repeated polls
+        do not re-serialize (or re-validate) any MachineStatus.
+        """
+        cache = self._status_cache
+        if cache is None or cache[0] != self.version:
+            version = self.version
+            body = STATUS_LIST_ADAPTER.dump_json(self.get_status())
+            cache = self._status_cache = (
+                version,
+                body,
+                # weak, the body may be sent gzip encoded as well
+                f'W/"{self._boot_id}-{version}"',
+            )
+        return cache[1], cache[2]
+
+    def get_status_history(
+        self, machine_id: str, since: datetime = None, until: datetime = None
+    ) -> List[MachineStatus]:
+        history = self.storage.query_status(machine_id, since=since, until=until)
+        if history is None:
+            # storage has no index, only the in-memory statuses are available
+            history = [
+                status
+                for status in list(self.STATUS_DATA.get(machine_id, []))
+                if (since is None or status.created_at >= since)
+                and (until is None or status.created_at <= until)
+            ]
+        return history
+
+    def get_gpu_record(
+        self,
+        machine_id: str = None,
+        user: str = None,
+        since: datetime = None,
+        until: datetime = None,
+    ) -> list[dict]:
+        records, _ = self.query_gpu_record(
+            machine_id=machine_id, user=user, since=since, until=until
+        )
+        return records
+
+    def query_gpu_record(
+        self,
+        machine_id: str = None,
+        user: str = None,
+        since: datetime = None,
+        until: datetime = None,
+        cursor: int = None,
+        limit: int = None,
+        fields: Tuple[str, ...] = GPURecordBuffer.FIELDS,
+    ) -> Tuple[List[dict], Optional[int]]:
+        """
+        GPU records matching all given filters, oldest first, at most `limit` of them.
+        Pass the returned cursor back to get the next page; cursors are only
+        meaningful to the server process (and storage backend) that issued them.
+        """
+        query = dict(
+            machine_id=machine_id,
+            user=user,
+            since=since,
+            until=until,
+            cursor=cursor,
+            limit=limit,
+            fields=fields,
+        )
+        result = self.storage.query_gpu_record(**query)
+        if result is None:
+            # storage has no index, use the in-memory ring buffer and its indexes
+            with self._shared_lock:
+                result = self.gpu_record.query(**query)
+        return result
 
-    def to_dict(self) -> dict:
-        return {
-            key: [status.json() for status in status_list]
-            for key, status_list in self.STATUS_DATA.items()
-        }
+    def get_gpu_usage(
+        self, machine_id: str = None, since: date = None, until: date = None
+    ) -> List[dict]:
+        return self.gpu_ledger.rows(machine_id=machine_id, since=since, until=until)
+
+    def get_timeseries(
+        self,
+        machine_id: str,
+        metric: str,
+        gpu_index: int = -1,
+        since: datetime = None,
+        until: datetime = None,
+        step: int = None,
+        points: int = None,
+        method: str = "lttb",
+    ) -> Optional[dict]:
+        """
+        Utilization history of one series of a machine, see `TimeSeriesStore.query`,
+        reduced to at most `points` points with `method` (see downsample.py).
+        Times are returned as datetimes, None if the machine never reported it.
+        """
+        with self._shards[self._shard(machine_id)]:
+            result = self.timeseries.query(
+                machine_id,
+                metric,
+                gpu_index=gpu_index,
+                since=since.timestamp() if since else None,
+                until=until.timestamp() if until else None,
+                step=step,
+            )
+        if result is not None and points is not None:
+            step = result.pop("step")
+            result = dict(downsample(result, points, method), step=step)
+        if result is not None:
+            result["time"] = [datetime.fromtimestamp(time) for time in result["time"]]
+        return result
 
 
-DB = Database(
-    record_filename="./machine_status.json", gpu_record_filename="./gpu_status.json"
-)
+DB = Database(storage=create_storage(configs))
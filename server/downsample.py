@@ -0,0 +1,100 @@
+from typing import Dict
+
+import numpy as np
+
+###############################################################################
+### Downsampling of time series for charts
+#
+# Both methods select points of the series (they never interpolate), so the
+# result can be plotted exactly like the original:
+#
+#   - lttb:   Largest-Triangle-Three-Buckets, keeps the visual shape of a line
+#   - minmax: the lowest and the highest point of every bucket, keeps spikes
+#
+# The first and the last point are always kept.
+
+METHODS = ("lttb", "minmax")
+
+
+def _bucket_edges(n: int, buckets: int) -> np.ndarray:
+    """Edges of `buckets` (nearly) equal buckets over the points 1 .. n - 2"""
+    return np.linspace(1, n - 1, buckets + 1).astype(np.int64)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the `points` points of (x, y) picked by Largest-Triangle-Three-Buckets.
+
+    The inner points are split into `points - 2` buckets; from every bucket the
+    point forming the largest triangle with the point picked in the previous
+    bucket and the mean of the next bucket is kept. The picks depend on each
+    other, so buckets are walked in order, but all candidates of a bucket are
+    scored at once and the bucket means are computed up front.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    edges = _bucket_edges(n, points - 2)
+    sizes = np.diff(edges)
+    # mean of every bucket, and of the last point as the "bucket" after the last
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / sizes, y[-1])
+
+    picked = np.empty(points, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        cx, cy = mean_x[bucket + 1], mean_y[bucket + 1]
+        # twice the area of the triangles (a, candidate, c)
+        area = np.abs(
+            (x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a])
+        )
+        a = picked[bucket + 1] = start + int(np.argmax(area))
+    return picked
+
+
+def minmax(low: np.ndarray, high: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the lowest `low` and the highest `high` point of every bucket,
+    at most `points` of them, in order. Pass the same array twice for a plain
+    series, or the min and max columns of rollups.
+    """
+    n = len(low)
+    if points >= n or points < 3:
+        return np.arange(n)
+    if points == 3:
+        # no room for a (lowest, highest) pair: keep the highest inner point
+        return np.array([0, 1 + int(np.argmax(high[1:-1])), n - 1])
+    edges = _bucket_edges(n, (points - 2) // 2)
+    # bucket of every inner point, and the lowest / highest value of its bucket
+    bucket = np.repeat(np.arange(len(edges) - 1), np.diff(edges))
+    bucket_low = np.minimum.reduceat(low[:-1], edges[:-1])[bucket]
+    bucket_high = np.maximum.reduceat(high[:-1], edges[:-1])[bucket]
+    lowest = _first_in_bucket(low[1:-1] == bucket_low, bucket) + 1
+    highest = _first_in_bucket(high[1:-1] == bucket_high, bucket) + 1
+    return np.unique(np.concatenate([[0, n - 1], lowest, highest]))
+
+
+def _first_in_bucket(mask: np.ndarray, bucket: np.ndarray) -> np.ndarray:
+    """Index of the first True of `mask` in every bucket"""
+    index = np.flatnonzero(mask)
+    _, first = np.unique(bucket[index], return_index=True)
+    return index[first]
+
+
+def downsample(series: Dict[str, np.ndarray], points: int, method: str = "lttb"):
+    """
+    `series` (arrays of equal length: time as epoch seconds, min, mean, max)
+    reduced to at most `points` rows with the given method.
+
+    Raises:
+        ValueError: unknown method
+    """
+    if method == "lttb":
+        index = lttb(series["time"], series["mean"], points)
+    elif method == "minmax":
+        index = minmax(series["min"], series["max"], points)
+    else:
+        raise ValueError(f"Unknown method {method}, available: {', '.join(METHODS)}")
+    return {key: value[index] for key, value in series.items()}
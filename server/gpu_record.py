@@ -0,0 +1,248 @@
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class StringTable:
+    """
+    Intern table mapping strings (users, machine ids) to small integer codes.
+    Codes are never reused, so the table only grows with the number of
+    distinct values, not with the number of records.
+    """
+
+    def __init__(self, values: List[str] = None):
+        self.values: List[str] = []
+        self.codes: Dict[str, int] = {}
+        for value in values or []:
+            self.code(value)
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(self.values, dtype=object)[codes]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class GPURecordBuffer:
+    """
+    Fixed-capacity columnar ring buffer of GPU process records.
+
+    Each record is (user, time, machine_id). Times are kept in a datetime64[us]
+    column and users / machine ids are interned into int32 codes, so a record
+    costs 16 bytes instead of a dict and its strings.
+    Appending is O(1); once the buffer is full the oldest record is overwritten.
+    Records are expected to arrive in (roughly) chronological order, which is
+    what makes eviction from the head by time correct.
+
+    Every record gets a sequence number (its position in the stream of appended
+    records, stable until it is evicted). Sequence numbers are used as
+    pagination cursors and by the per-machine / per-user indexes, which hold the
+    sequence numbers of the records of each machine and user in order. The
+    oldest record is always at the left end of its deques, so indexes are
+    maintained in O(1) per append and eviction.
+    """
+
+    FIELDS = ("user", "time", "machine_id")
+
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self.time = np.zeros(self.capacity, dtype="datetime64[us]")
+        self.user = np.zeros(self.capacity, dtype=np.int32)
+        self.machine = np.zeros(self.capacity, dtype=np.int32)
+        self.users = StringTable()
+        self.machines = StringTable()
+        self._head = 0  # position of the oldest record
+        self._size = 0
+        self._first_seq = 0  # sequence number of the oldest record
+        self._user_index: Dict[int, Deque[int]] = defaultdict(deque)
+        self._machine_index: Dict[int, Deque[int]] = defaultdict(deque)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, user: str, time: datetime, machine_id: str):
+        if self._size == self.capacity:
+            # overwrite the oldest record
+            self._evict_head()
+        pos = (self._head + self._size) % self.capacity
+        seq = self._first_seq + self._size
+        self._size += 1
+        self.time[pos] = np.datetime64(time, "us")
+        self.user[pos] = user_code = self.users.code(user)
+        self.machine[pos] = machine_code = self.machines.code(machine_id)
+        self._user_index[user_code].append(seq)
+        self._machine_index[machine_code].append(seq)
+
+    def _evict_head(self):
+        self._user_index[self.user[self._head]].popleft()
+        self._machine_index[self.machine[self._head]].popleft()
+        self._head = (self._head + 1) % self.capacity
+        self._first_seq += 1
+        self._size -= 1
+
+    def extend(self, users, times, machine_ids):
+        """Vectorized bulk append, used when loading records from disk"""
+        times = np.asarray(times, dtype="datetime64[us]")
+        if len(times) == 0:
+            return
+        self._extend_codes(
+            times,
+            self._intern(self.users, users),
+            self._intern(self.machines, machine_ids),
+        )
+
+    def extend_codes(self, time, user, machine, users, machines):
+        """
+        Bulk append of columns as returned by `to_codes` (possibly of another
+        buffer), without decoding the interned strings.
+        """
+        if len(time) == 0:
+            return
+        user_map = np.array([self.users.code(v) for v in users], dtype=np.int32)
+        machine_map = np.array(
+            [self.machines.code(v) for v in machines], dtype=np.int32
+        )
+        self._extend_codes(
+            np.asarray(time, dtype="datetime64[us]"),
+            user_map[user],
+            machine_map[machine],
+        )
+
+    def _extend_codes(self, times, user_codes, machine_codes):
+        n = len(times)
+        if n >= self.capacity:
+            # only the newest `capacity` records survive
+            self.time[:] = times[-self.capacity :]
+            self.user[:] = user_codes[-self.capacity :]
+            self.machine[:] = machine_codes[-self.capacity :]
+            self._first_seq += self._size + n - self.capacity
+            self._head, self._size = 0, self.capacity
+        else:
+            positions = (self._head + self._size + np.arange(n)) % self.capacity
+            self.time[positions] = times
+            self.user[positions] = user_codes
+            self.machine[positions] = machine_codes
+            overflow = max(0, self._size + n - self.capacity)
+            self._head = (self._head + overflow) % self.capacity
+            self._first_seq += overflow
+            self._size = min(self.capacity, self._size + n)
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._user_index.clear()
+        self._machine_index.clear()
+        seqs = range(self._first_seq, self._first_seq + self._size)
+        users = self._ordered(self.user).tolist()
+        machines = self._ordered(self.machine).tolist()
+        for seq, user_code, machine_code in zip(seqs, users, machines):
+            self._user_index[user_code].append(seq)
+            self._machine_index[machine_code].append(seq)
+
+    @staticmethod
+    def _intern(table: StringTable, values) -> np.ndarray:
+        uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        codes = np.array(
+            [table.code(value) for value in uniques.tolist()], dtype=np.int32
+        )
+        return codes[inverse]
+
+    def evict_before(self, cutoff: datetime) -> int:
+        """Drop records older than `cutoff` from the head, return the number dropped"""
+        cutoff = np.datetime64(cutoff, "us")
+        evicted = 0
+        while self._size and self.time[self._head] < cutoff:
+            self._evict_head()
+            evicted += 1
+        return evicted
+
+    def _ordered(self, column: np.ndarray) -> np.ndarray:
+        """Return a copy of `column` ordered from oldest to newest"""
+        end = self._head + self._size
+        if end <= self.capacity:
+            return column[self._head : end].copy()
+        return np.concatenate((column[self._head :], column[: end - self.capacity]))
+
+    def to_codes(self) -> dict:
+        """Ordered columns with users / machines still interned, plus the string tables"""
+        return dict(
+            time=self._ordered(self.time),
+            user=self._ordered(self.user),
+            machine=self._ordered(self.machine),
+            users=list(self.users.values),
+            machines=list(self.machines.values),
+        )
+
+    def query(
+        self,
+        machine_id: str = None,
+        user: str = None,
+        since: datetime = None,
+        until: datetime = None,
+        cursor: int = None,
+        limit: int = None,
+        fields: Tuple[str, ...] = FIELDS,
+    ) -> Tuple[List[dict], Optional[int]]:
+        """
+        Records matching all given filters, oldest first.
+
+        Machine / user filters are answered from the indexes, so the cost is
+        proportional to the records of that machine or user, not to the buffer.
+        `cursor` is the sequence number of the last record of the previous page.
+
+        Returns:
+            records (List[dict]): matching records with the requested `fields`
+            next_cursor (int): cursor of the next page, None if this is the last one
+        """
+        # candidate sequence numbers, from the most selective index available
+        candidates = []
+        if machine_id is not None:
+            code = self.machines.codes.get(machine_id)
+            candidates.append(self._machine_index.get(code, ()))
+        if user is not None:
+            code = self.users.codes.get(user)
+            candidates.append(self._user_index.get(code, ()))
+        if candidates:
+            index = min(candidates, key=len)
+            if len(index) == 0:
+                return [], None
+            seqs = np.fromiter(index, dtype=np.int64, count=len(index))
+        else:
+            seqs = np.arange(self._first_seq, self._first_seq + self._size)
+
+        if cursor is not None:
+            seqs = seqs[np.searchsorted(seqs, cursor, side="right") :]
+        positions = (self._head + seqs - self._first_seq) % self.capacity
+
+        mask = np.ones(len(seqs), dtype=bool)
+        if len(candidates) == 2:
+            mask &= self.machine[positions] == self.machines.codes[machine_id]
+            mask &= self.user[positions] == self.users.codes[user]
+        if since is not None:
+            mask &= self.time[positions] >= np.datetime64(since, "us")
+        if until is not None:
+            mask &= self.time[positions] <= np.datetime64(until, "us")
+        seqs, positions = seqs[mask], positions[mask]
+
+        next_cursor = None
+        if limit is not None and len(seqs) > limit:
+            seqs, positions = seqs[:limit], positions[:limit]
+            next_cursor = int(seqs[-1])
+
+        columns = dict(
+            user=lambda: self.users.lookup(self.user[positions]).tolist(),
+            time=lambda: self.time[positions].tolist(),
+            machine_id=lambda: self.machines.lookup(self.machine[positions]).tolist(),
+        )
+        values = [columns[field]() for field in fields]
+        records = [dict(zip(fields, row)) for row in zip(*values)]
+        return records, next_cursor
@@ -0,0 +1,85 @@
+import logging
+import math
+import queue
+import threading
+import time
+from typing import List
+
+from data_model import MachineStatus
+
+logger = logging.getLogger(__name__)
+
+
+class IngestQueue(threading.Thread):
+    """
+    Bounded queue between the report endpoints and `Database`, drained by a
+    background thread that applies statuses in batches (`Database.add_many`).
+
+    Endpoints only validate and enqueue, so their latency does not depend on
+    storage or lock contention. When the queue is full, `submit_many` refuses the
+    statuses and `retry_after()` tells clients when to come back, instead of
+    piling up threads in the request threadpool. A batch of more than `maxsize`
+    statuses never fits, callers are expected to refuse it up front.
+    """
+
+    def __init__(self, db, maxsize: int, batch_size: int):
+        super().__init__(name="ingest-worker", daemon=True)
+        self.db = db
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        # serializes `submit_many`, so a batch is enqueued entirely or not at all
+        self._submit_lock = threading.Lock()
+        self.stats = dict(
+            accepted=0, rejected=0, applied=0, skipped=0, failed=0, batches=0
+        )
+        self._drain_rate = None  # statuses per second, exponential moving average
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def submit_many(self, statuses: List[MachineStatus]) -> bool:
+        """Enqueue all statuses, or none of them if they do not fit"""
+        with self._submit_lock:
+            if self.maxsize - self._queue.qsize() < len(statuses):
+                self.stats["rejected"] += len(statuses)
+                return False
+            for status in statuses:
+                self._queue.put_nowait(status)
+            self.stats["accepted"] += len(statuses)
+        return True
+
+    def retry_after(self) -> int:
+        """Seconds until the queue is expected to have drained, at least 1"""
+        if not self._drain_rate:
+            return 1
+        return max(1, math.ceil(self._queue.qsize() / self._drain_rate))
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            try:
+                added = self.db.add_many(batch)
+            except Exception:
+                logger.exception(f"Failed to apply {len(batch)} status reports")
+                self.stats["failed"] += len(batch)
+                continue
+            duration = max(time.perf_counter() - start, 1e-6)
+
+            rate = len(batch) / duration
+            self._drain_rate = (
+                rate
+                if self._drain_rate is None
+                else 0.9 * self._drain_rate + 0.1 * rate
+            )
+            self.stats["applied"] += added
+            # not newer than the latest status of their machine
+            self.stats["skipped"] += len(batch) - added
+            self.stats["batches"] += 1
@@ -0,0 +1,97 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Tuple
+
+from data_model import MachineStatus
+
+LedgerKey = Tuple[str, str, str, int]  # (machine_id, user, day, gpu_index)
+
+
+class GPUHourLedger:
+    """
+    Running GPU-hours per (machine, user, day, gpu_index), maintained at ingest.
+
+    Every report accounts for the time elapsed since the previous report of the
+    same machine: each (user, gpu_index) pair seen in the report is charged that
+    much time, so uneven report intervals are weighted correctly. A user running
+    several processes on one GPU is charged once. Gaps longer than `max_gap`
+    seconds (machine or client offline) are capped, and intervals that cross
+    midnight are split between the two days.
+    """
+
+    def __init__(self, max_gap: float, retention_days: int):
+        self.max_gap = max_gap
+        self.retention_days = retention_days
+        self.hours: Dict[LedgerKey, float] = defaultdict(float)
+        self.last_report: Dict[str, datetime] = {}
+        self._oldest_day: str = None
+
+    def add(self, status: MachineStatus):
+        machine_id = status.machine_id
+        current = status.created_at
+        previous = self.last_report.get(machine_id)
+        self.last_report[machine_id] = current
+        if previous is None or current <= previous:
+            return
+
+        start = max(previous, current - timedelta(seconds=self.max_gap))
+        usage = set()
+        for process in status.gpu_compute_processes or []:
+            gpu_index = -1 if process.gpu_index is None else process.gpu_index
+            usage.add((process.user or "", gpu_index))
+        if not usage:
+            return
+
+        for day, seconds in self._split_by_day(start, current):
+            for user, gpu_index in usage:
+                self.hours[(machine_id, user, day, gpu_index)] += seconds / 3600
+
+        self._prune(current.date())
+
+    @staticmethod
+    def _split_by_day(start: datetime, end: datetime) -> List[Tuple[str, float]]:
+        chunks = []
+        while start.date() < end.date():
+            midnight = datetime.combine(
+                start.date() + timedelta(days=1), datetime.min.time()
+            )
+            chunks.append(
+                (start.date().isoformat(), (midnight - start).total_seconds())
+            )
+            start = midnight
+        chunks.append((start.date().isoformat(), (end - start).total_seconds()))
+        return chunks
+
+    def _prune(self, today: date):
+        oldest_day = (today - timedelta(days=self.retention_days)).isoformat()
+        if oldest_day == self._oldest_day:
+            return
+        self._oldest_day = oldest_day
+        for key in [key for key in self.hours if key[2] < oldest_day]:
+            del self.hours[key]
+
+    def rows(
+        self, machine_id: str = None, since: date = None, until: date = None
+    ) -> List[dict]:
+        since = since.isoformat() if since else ""
+        until = until.isoformat() if until else "9999-12-31"
+        return [
+            dict(machine_id=m, user=user, day=day, gpu_index=gpu_index, hours=hours)
+            for (m, user, day, gpu_index), hours in sorted(list(self.hours.items()))
+            if (machine_id is None or m == machine_id) and since <= day <= until
+        ]
+
+    def to_dict(self) -> dict:
+        return dict(
+            hours=[[*key, hours] for key, hours in self.hours.items()],
+            last_report={
+                machine_id: time.isoformat()
+                for machine_id, time in self.last_report.items()
+            },
+        )
+
+    def load(self, data: dict):
+        for machine_id, user, day, gpu_index, hours in data.get("hours", []):
+            self.hours[(machine_id, user, day, gpu_index)] = hours
+        for machine_id, time in data.get("last_report", {}).items():
+            self.last_report[machine_id] = datetime.fromisoformat(time)
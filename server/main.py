@@ -1,17 +1,25 @@
 import json
 import os
 import sys
-from datetime import datetime
+from datetime import date, datetime
 from logging import INFO
 from pathlib import Path
 from typing import List
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from puts import get_logger
 
-from data_model import MachineStatus
+from compression import RequestDecompressionMiddleware
+from data_model import MachineProfile, MachineSample, MachineStatus
 from database import DB as db
+from database import STATUS_LIST_ADAPTER
+from gpu_record import GPURecordBuffer
+from ingest import IngestQueue
+from metrics import CONTENT_TYPE, REPORT_LATENCY, LatencyMiddleware, render
+from stream import StatusBroadcaster
 
 logger = get_logger()
 logger.setLevel(INFO)
@@ -44,6 +52,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# clients may compress their reports, and large responses
+# (/server_status, /gpu_record, ...) are gzipped for clients that accept it
+app.add_middleware(RequestDecompressionMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+REPORT_PATHS = ("/report", "/report/batch", "/profile", "/sample")
+app.add_middleware(LatencyMiddleware, histogram=REPORT_LATENCY, paths=REPORT_PATHS)
 
 
 # print timezone and current time
@@ -70,6 +85,49 @@ async def get_status():
     return list(db.STATUS_DATA.values())
 
 
+###############################################################################
+## Ingestion
+#
+# In the default "sync" ingest mode, the report endpoints apply statuses to the
+# database before responding (201). In "queue" mode they only validate and
+# enqueue them (202), and answer 503 with Retry-After when the queue is full
+# (413 for a batch larger than the whole queue, which would never fit).
+
+ingest_queue: IngestQueue = None
+if configs.get("ingest_mode", "sync") == "queue":
+    ingest_queue = IngestQueue(
+        db,
+        maxsize=configs.get("ingest_queue_size", 10000),
+        batch_size=configs.get("ingest_batch_size", 256),
+    )
+    ingest_queue.start()
+
+
+def enqueue(statuses: List[MachineStatus]) -> JSONResponse:
+    if len(statuses) > ingest_queue.maxsize:
+        return JSONResponse(
+            status_code=413,
+            content={
+                "detail": f"Batch of {len(statuses)} reports exceeds the ingest "
+                f"queue size of {ingest_queue.maxsize}"
+            },
+        )
+    if ingest_queue.submit_many(statuses):
+        return JSONResponse(
+            status_code=202, content={"msg": "Accepted", "queued": len(statuses)}
+        )
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Ingest queue is full"},
+        headers={"Retry-After": str(ingest_queue.retry_after())},
+    )
+
+
+# pushes every accepted status to the /stream connections
+broadcaster = StatusBroadcaster(snapshot=lambda: db.get_status_json()[0])
+db.listeners.append(broadcaster.publish)
+
+
 ###############################################################################
 ## ENDPOINTS
 
@@ -83,11 +141,81 @@ def report_status(status: MachineStatus):
     """
     try:
         if status.report_key == configs["report_key"]:
-            db.add(status)
+            if ingest_queue is not None:
+                return enqueue([status])
+            accepted = db.add(status)
             logger.debug(
                 f"Received status report from: {status.name} (report_key: {status.report_key})"
             )
-            return {"msg": "OK"}
+            return {"msg": "OK", "accepted": int(accepted)}
+        else:
+            raise ValueError("Report key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/report/batch", status_code=201)
+def report_status_batch(statuses: List[MachineStatus]):
+    """
+    POST Endpoint for a batch of status reports, e.g. samples a client buffered
+    while offline or the reports of several machines relayed by one gateway.
+    All reports must carry the valid report_key, they are applied in one pass.
+    """
+    try:
+        if all(status.report_key == configs["report_key"] for status in statuses):
+            if ingest_queue is not None:
+                return enqueue(statuses)
+            accepted = db.add_many(statuses)
+            logger.debug(f"Received {len(statuses)} status reports, {accepted} added")
+            return {"msg": "OK", "accepted": accepted}
+        else:
+            raise ValueError("Report key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/profile", status_code=201)
+def register_profile(profile: MachineProfile):
+    """
+    POST Endpoint for registering the static part of a machine's status.
+    Returns the profile_hash the machine has to send along with its samples.
+    """
+    try:
+        if profile.report_key == configs["report_key"]:
+            profile_hash = db.register_profile(profile)
+            logger.debug(f"Registered profile of: {profile.name} ({profile_hash})")
+            return {"msg": "OK", "profile_hash": profile_hash}
+        else:
+            raise ValueError("Report key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/sample", status_code=201)
+def report_sample(sample: MachineSample):
+    """
+    POST Endpoint for the dynamic part of a status report, joined with the
+    registered profile of the machine.
+    Responds with 409 when the machine has no registered profile with the
+    sample's profile_hash, the client is expected to register its profile again.
+    """
+    try:
+        if sample.report_key == configs["report_key"]:
+            status = db.join_sample(sample)
+            if status is None:
+                return JSONResponse(
+                    status_code=409, content={"detail": "Profile not registered"}
+                )
+            if ingest_queue is not None:
+                return enqueue([status])
+            accepted = db.add(status)
+            return {"msg": "OK", "accepted": int(accepted)}
         else:
             raise ValueError("Report key not correct")
     except ValueError as e:
@@ -98,17 +226,78 @@ def report_status(status: MachineStatus):
 
 ###############################################################################
 ## Web ENDPOINTS
+#
+# Endpoints that take the database locks or query the storage backend are
+# plain `def`, so FastAPI runs them in its thread pool instead of blocking the
+# event loop (and with it ingestion and the live stream).
 
 
 @app.get("/server_status", status_code=200, response_model=List[MachineStatus])
-async def view_status(view_key):
+def view_status(view_key, request: Request):
     """
     GET Endpoint for receiving view request from web (users).
     Incoming view request needs to have a valid view_key.
+    The response carries an ETag, polls with a matching If-None-Match get a 304.
+    The ETag is weak: GZipMiddleware may send the same status gzip encoded.
     """
     try:
         if view_key == configs["view_key"]:
-            return db.get_status()
+            body, etag = db.get_status_json()
+            headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+            if_none_match = request.headers.get("if-none-match", "")
+            if etag in (tag.strip() for tag in if_none_match.split(",")):
+                return Response(status_code=304, headers=headers)
+            return Response(
+                content=body, media_type="application/json", headers=headers
+            )
+        else:
+            raise ValueError("View key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/stream", status_code=200)
+async def stream_status(view_key, request: Request):
+    """
+    GET Endpoint for live dashboards (server-sent events): a `snapshot` event
+    with the latest status of every machine, then a `status` event with the
+    changed fields of every status accepted from then on (see stream.py).
+    """
+    try:
+        if view_key == configs["view_key"]:
+            return StreamingResponse(
+                broadcaster.events(request.is_disconnected),
+                media_type="text/event-stream",
+                # no caching or buffering by proxies (e.g. nginx)
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        else:
+            raise ValueError("View key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/status_history", status_code=200, response_model=List[MachineStatus])
+def view_status_history(
+    view_key, machine_id: str, since: datetime = None, until: datetime = None
+):
+    """
+    GET Endpoint for the stored statuses of one machine within [since, until].
+    How far back it goes depends on the storage backend (see storage.py).
+    Statuses are serialized as they are, `response_model` only documents the
+    response: validating them again would re-run the masking validators.
+    """
+    try:
+        if view_key == configs["view_key"]:
+            history = db.get_status_history(machine_id, since=since, until=until)
+            return Response(
+                content=STATUS_LIST_ADAPTER.dump_json(history),
+                media_type="application/json",
+            )
         else:
             raise ValueError("View key not correct")
     except ValueError as e:
@@ -118,10 +307,135 @@ async def view_status(view_key):
 
 
 @app.get("/gpu_record", status_code=200, response_model=List[dict])
-async def view_gpu_record(view_key):
+def view_gpu_record(
+    view_key,
+    response: Response,
+    machine_id: str = None,
+    user: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: int = None,
+    limit: int = Query(default=None, ge=1),
+    fields: str = None,
+):
+    """
+    GET Endpoint for GPU process records, oldest first.
+    Records can be filtered by machine_id, user and time range [since, until],
+    and projected to a comma separated list of `fields` (user, time, machine_id).
+    With `limit`, the cursor of the next page is returned in the X-Next-Cursor header.
+    """
+    try:
+        if view_key == configs["view_key"]:
+            if fields:
+                fields = tuple(field.strip() for field in fields.split(","))
+                unknown = set(fields) - set(GPURecordBuffer.FIELDS)
+                if unknown:
+                    raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+            else:
+                fields = GPURecordBuffer.FIELDS
+            records, next_cursor = db.query_gpu_record(
+                machine_id=machine_id,
+                user=user,
+                since=since,
+                until=until,
+                cursor=cursor,
+                limit=limit,
+                fields=fields,
+            )
+            if next_cursor is not None:
+                response.headers["X-Next-Cursor"] = str(next_cursor)
+            return records
+        else:
+            raise ValueError("View key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/gpu_usage", status_code=200, response_model=List[dict])
+def view_gpu_usage(
+    view_key, machine_id: str = None, since: date = None, until: date = None
+):
+    """
+    GET Endpoint for the GPU-hour ledger: one row per (machine_id, user, day, gpu_index)
+    with the GPU-hours accumulated at ingest.
+    """
     try:
         if view_key == configs["view_key"]:
-            return db.get_gpu_record()
+            return db.get_gpu_usage(machine_id=machine_id, since=since, until=until)
+        else:
+            raise ValueError("View key not correct")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/timeseries", status_code=200, response_model=dict)
+def view_timeseries(
+    view_key,
+    machine_id: str,
+    metric: str,
+    gpu_index: int = -1,
+    since: datetime = None,
+    until: datetime = None,
+    step: int = None,
+    points: int = Query(default=None, ge=3),
+    method: str = "lttb",
+):
+    """
+    GET Endpoint for the utilization history of one machine: `metric` is one of
+    cpu_usage, cpu_temp, ram_usage (gpu_index -1), or gpu_usage, memory_usage,
+    temperature of the GPU at `gpu_index`.
+    `step` picks the resolution (0 for raw values, or the step in seconds of a
+    rollup), by default the finest one that covers `since`.
+    With `points`, the series is downsampled to at most that many points for
+    charts, with `method` lttb (line shape) or minmax (keeps spikes).
+    """
+    try:
+        if view_key == configs["view_key"]:
+            result = db.get_timeseries(
+                machine_id,
+                metric,
+                gpu_index=gpu_index,
+                since=since,
+                until=until,
+                step=step,
+                points=points,
+                method=method,
+            )
+            if result is None:
+                raise HTTPException(status_code=404, detail="Series not found")
+            return dict(
+                step=result["step"],
+                time=result["time"],
+                min=result["min"].tolist(),
+                mean=result["mean"].tolist(),
+                max=result["max"].tolist(),
+            )
+        else:
+            raise ValueError("View key not correct")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics", status_code=200)
+def view_metrics(view_key):
+    """
+    GET Endpoint for Prometheus-style scraping: the latest per-machine gauges
+    (CPU, RAM, GPUs, disks) and server internals (ingest latency, database
+    add / save durations, GPU records, process RSS).
+    """
+    try:
+        if view_key == configs["view_key"]:
+            return PlainTextResponse(
+                render(db, ingest_queue), headers={"Content-Type": CONTENT_TYPE}
+            )
         else:
             raise ValueError("View key not correct")
     except ValueError as e:
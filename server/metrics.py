@@ -0,0 +1,252 @@
+import bisect
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+###############################################################################
+### Prometheus text exposition
+#
+# A minimal, dependency-free take on prometheus_client: histograms are
+# registered at import time by the modules they measure, gauges are collected
+# when /metrics is scraped (see `render`).
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """Cumulative histogram of durations (seconds), optionally per label values"""
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+        self._lock = threading.Lock()
+        # label values -> ([count per bucket, ..., count above the last], sum)
+        self._series: Dict[Labels, Tuple[List[int], float]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._series.items()
+            ]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = (("le", _format_value(bound)),)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labels + le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Histogram] = []
+
+
+class Samples:
+    """Gauge / counter samples collected at scrape time, grouped by metric"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Tuple[str, str, List[Tuple[Labels, float]]]] = {}
+
+    def add(self, metric: str, help: str, value, kind: str = "gauge", **labels):
+        if value is None:
+            return
+        self._metrics.setdefault(metric, (help, kind, []))[2].append(
+            (tuple(labels.items()), value)
+        )
+
+    def collect(self) -> List[str]:
+        lines = []
+        for name, (help, kind, samples) in self._metrics.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+def process_rss_bytes() -> int:
+    """Resident set size of this process"""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+###############################################################################
+### Server internals
+
+REPORT_LATENCY = Histogram(
+    "server_report_request_seconds",
+    "Time to handle a report request (parsing, validation, ingestion)",
+)
+DATABASE_ADD = Histogram(
+    "server_database_add_seconds",
+    "Time spent in Database.add / Database.add_many, per call",
+)
+DATABASE_SAVE = Histogram(
+    "server_database_save_seconds",
+    "Time to write a database snapshot",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+
+class LatencyMiddleware:
+    """
+    ASGI middleware that observes the time to handle requests to `paths` (until
+    the response is sent) in `histogram`, by path and response status.
+    Other requests are passed on untouched.
+    """
+
+    def __init__(self, app, histogram: Histogram, paths: Iterable[str]):
+        self.app = app
+        self.histogram = histogram
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500  # unless the app starts a response
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.histogram.observe(
+                time.perf_counter() - start, path=scope["path"], status=str(status)
+            )
+
+
+def render(db, ingest_queue=None) -> str:
+    """The whole /metrics page: fleet gauges, server internals and histograms"""
+    samples = Samples()
+    for status in db.get_status():
+        machine = dict(machine_id=status.machine_id, name=status.name or "")
+        if status.created_at is not None:
+            samples.add(
+                "machine_last_report_timestamp_seconds",
+                "Time of the latest report of the machine",
+                status.created_at.timestamp(),
+                **machine,
+            )
+        samples.add(
+            "machine_cpu_usage_ratio", "CPU usage [0, 1]", status.cpu_usage, **machine
+        )
+        samples.add(
+            "machine_cpu_temperature_celsius",
+            "CPU temperature",
+            status.cpu_temp,
+            **machine,
+        )
+        samples.add(
+            "machine_ram_usage_ratio", "RAM usage [0, 1]", status.ram_usage, **machine
+        )
+        for gpu in status.gpu_status or []:
+            labels = dict(machine, gpu=gpu.index, gpu_name=gpu.gpu_name or "")
+            samples.add(
+                "machine_gpu_utilization_ratio",
+                "GPU utilization [0, 1]",
+                gpu.gpu_usage,
+                **labels,
+            )
+            samples.add(
+                "machine_gpu_memory_usage_ratio",
+                "GPU memory usage [0, 1]",
+                gpu.memory_usage,
+                **labels,
+            )
+            samples.add(
+                "machine_gpu_memory_total_mb",
+                "GPU memory in MB",
+                gpu.memory_total,
+                **labels,
+            )
+            samples.add(
+                "machine_gpu_temperature_celsius",
+                "GPU temperature",
+                gpu.temperature,
+                **labels,
+            )
+        disks = [status.disk_system] if status.disk_system else []
+        for disk in disks + list(status.disk_external or []):
+            samples.add(
+                "machine_disk_usage_ratio",
+                "Disk usage [0, 1]",
+                disk.usage,
+                **machine,
+                directory=disk.directory,
+            )
+
+    samples.add("server_machines", "Machines with a status", len(db.STATUS_DATA))
+    samples.add("server_gpu_records", "GPU records in memory", len(db.gpu_record))
+    samples.add(
+        "server_statuses_applied_total", "Statuses applied", db.version, "counter"
+    )
+    samples.add(
+        "server_snapshots_total", "Snapshots written", db.save_stats["saves"], "counter"
+    )
+    samples.add(
+        "server_last_snapshot_bytes",
+        "Size of the last snapshot",
+        db.save_stats["last_snapshot_bytes"],
+    )
+    samples.add("server_process_rss_bytes", "Resident set size", process_rss_bytes())
+    if ingest_queue is not None:
+        samples.add("server_ingest_queue_length", "Queued statuses", len(ingest_queue))
+        for key, value in ingest_queue.stats.items():
+            samples.add(
+                f"server_ingest_{key}_total",
+                f"Statuses (batches) {key} by the ingest queue",
+                value,
+                "counter",
+            )
+
+    lines = samples.collect()
+    for histogram in REGISTRY:
+        lines += histogram.collect()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,31 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotWorker(threading.Thread):
+    """
+    Background thread that writes database snapshots off the request path.
+
+    `request()` only sets a flag, so it is safe to call from a request handler;
+    several requests made while a snapshot is being written collapse into one
+    follow-up snapshot.
+    """
+
+    def __init__(self, db):
+        super().__init__(name="snapshot-worker", daemon=True)
+        self.db = db
+        self._requested = threading.Event()
+
+    def request(self):
+        self._requested.set()
+
+    def run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            try:
+                self.db.save()
+            except Exception:
+                logger.exception("Failed to write database snapshot")
@@ -0,0 +1,352 @@
+import json
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from data_model import MachineStatus
+
+###############################################################################
+### Binary snapshot format
+#
+#   header   : MAGIC (6 bytes) | format version (u16) | number of sections (u32)
+#   section  : name length (u16) | name (utf-8) | payload length (u64) | payload
+#
+# Sections of version 1:
+#   status     : per machine, machine_id length (u16) | machine_id | history
+#                length (u32) | history as a JSON array of serialized statuses
+#   gpu_record : number of records (u64) | users JSON length (u32) | machines
+#                JSON length (u32) | users JSON | machines JSON | time (int64,
+#                microseconds) | user codes (int32) | machine codes (int32)
+#   state      : JSON object of the derived state (e.g. the GPU-hour ledger)
+#   timeseries : per machine, machine_id length (u16) | machine_id | arrays
+#                length (u64) | utilization history as packed arrays
+#
+# Packed arrays (see `pack_arrays`) are a JSON structure in which every numpy
+# array is replaced by its dtype and shape, followed by the raw bytes of the
+# arrays in the order they appear:
+#   header length (u32) | header JSON | array bytes ...
+#
+# Everything is little-endian. Readers skip sections they do not know, so new
+# sections can be added without bumping the version.
+
+MAGIC = b"DSSNAP"
+VERSION = 1
+
+_HEADER = struct.Struct("<6sHI")
+_SECTION_NAME = struct.Struct("<H")
+_SECTION_SIZE = struct.Struct("<Q")
+_MACHINE_ID = struct.Struct("<H")
+_HISTORY_SIZE = struct.Struct("<I")
+_GPU_HEADER = struct.Struct("<QII")
+_ARRAYS_HEADER = struct.Struct("<I")
+_ARRAYS_SIZE = struct.Struct("<Q")
+
+
+def _unpack(fmt: struct.Struct, data: memoryview, offset: int) -> tuple:
+    try:
+        return fmt.unpack_from(data, offset)
+    except struct.error:
+        raise ValueError("Truncated snapshot") from None
+
+
+def _slice(data: memoryview, offset: int, size: int) -> memoryview:
+    if offset + size > len(data):
+        raise ValueError("Truncated snapshot")
+    return data[offset : offset + size]
+
+
+def encode_history(status_list: Iterable[MachineStatus]) -> bytes:
+    return b"[" + b",".join(s.model_dump_json().encode() for s in status_list) + b"]"
+
+
+def decode_history(payload: bytes) -> List[MachineStatus]:
+    return [MachineStatus.from_trusted(data) for data in json.loads(payload)]
+
+
+class LazyStatusData(dict):
+    """
+    `Database.STATUS_DATA` that decodes the history of a machine on first access.
+
+    Values start out as the encoded history (bytes, see `encode_history`) and are
+    replaced by the list of statuses the first time they are read, so loading a
+    snapshot costs no model construction at all. Missing keys get an empty list,
+    like the `defaultdict(list)` this replaces.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # a history must be decoded once, or concurrent readers and writers
+        # could end up with different lists
+        self._decode_lock = threading.Lock()
+
+    def _decode(self, key, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            with self._decode_lock:
+                value = dict.__getitem__(self, key)
+                if isinstance(value, (bytes, bytearray, memoryview)):
+                    value = decode_history(value)
+                    dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        return self._decode(key, self.setdefault(key, []))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def copy(self) -> dict:
+        """
+        Shallow copy for snapshots: histories are copied as lists, those not
+        decoded yet are kept encoded (`write_snapshot` writes them as they are).
+        """
+        return {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in dict.items(self)
+        }
+
+    def values(self):
+        return [self[key] for key in list(self.keys())]
+
+    def items(self):
+        return [(key, self[key]) for key in list(self.keys())]
+
+
+def _pack_section(name: str, payload: bytes) -> bytes:
+    name = name.encode()
+    return (
+        _SECTION_NAME.pack(len(name))
+        + name
+        + _SECTION_SIZE.pack(len(payload))
+        + payload
+    )
+
+
+def _pack_status(status_data: Dict[str, List[MachineStatus] | bytes]) -> bytes:
+    chunks = []
+    for machine_id, status_list in status_data.items():
+        machine_id = machine_id.encode()
+        if isinstance(status_list, (bytes, bytearray, memoryview)):
+            history = bytes(status_list)  # never decoded since it was loaded
+        else:
+            history = encode_history(status_list)
+        chunks += [
+            _MACHINE_ID.pack(len(machine_id)),
+            machine_id,
+            _HISTORY_SIZE.pack(len(history)),
+            history,
+        ]
+    return b"".join(chunks)
+
+
+def _unpack_status(payload: memoryview) -> LazyStatusData:
+    status_data = LazyStatusData()
+    offset = 0
+    while offset < len(payload):
+        (size,) = _unpack(_MACHINE_ID, payload, offset)
+        offset += _MACHINE_ID.size
+        machine_id = bytes(_slice(payload, offset, size)).decode()
+        offset += size
+        (size,) = _unpack(_HISTORY_SIZE, payload, offset)
+        offset += _HISTORY_SIZE.size
+        dict.__setitem__(status_data, machine_id, bytes(_slice(payload, offset, size)))
+        offset += size
+    return status_data
+
+
+def _pack_gpu_record(gpu_codes: dict) -> bytes:
+    users = json.dumps(gpu_codes["users"]).encode()
+    machines = json.dumps(gpu_codes["machines"]).encode()
+    return b"".join(
+        [
+            _GPU_HEADER.pack(len(gpu_codes["time"]), len(users), len(machines)),
+            users,
+            machines,
+            gpu_codes["time"].astype("datetime64[us]").view("<i8").tobytes(),
+            gpu_codes["user"].astype("<i4").tobytes(),
+            gpu_codes["machine"].astype("<i4").tobytes(),
+        ]
+    )
+
+
+def _unpack_gpu_record(payload: memoryview) -> dict:
+    n, users_size, machines_size = _unpack(_GPU_HEADER, payload, 0)
+    offset = _GPU_HEADER.size
+    users = json.loads(bytes(_slice(payload, offset, users_size)))
+    offset += users_size
+    machines = json.loads(bytes(_slice(payload, offset, machines_size)))
+    offset += machines_size
+    if len(payload) - offset != 16 * n:
+        raise ValueError("Truncated snapshot")
+    time = np.frombuffer(payload, dtype="<i8", count=n, offset=offset)
+    offset += 8 * n
+    user = np.frombuffer(payload, dtype="<i4", count=n, offset=offset)
+    offset += 4 * n
+    machine = np.frombuffer(payload, dtype="<i4", count=n, offset=offset)
+    return dict(
+        time=time.view("datetime64[us]"),
+        user=user,
+        machine=machine,
+        users=users,
+        machines=machines,
+    )
+
+
+def pack_arrays(tree) -> bytes:
+    """Pack a JSON-like structure holding numpy arrays, without encoding the arrays"""
+    arrays = []
+
+    def describe(value):
+        if isinstance(value, np.ndarray):
+            arrays.append(np.ascontiguousarray(value))
+            return {"__array__": [value.dtype.str, list(value.shape)]}
+        if isinstance(value, dict):
+            return {key: describe(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [describe(item) for item in value]
+        return value
+
+    header = json.dumps(describe(tree)).encode()
+    return b"".join(
+        [_ARRAYS_HEADER.pack(len(header)), header]
+        + [array.tobytes() for array in arrays]
+    )
+
+
+def unpack_arrays(payload) -> dict:
+    """
+    Unpack what `pack_arrays` packed. Arrays are read-only views of `payload`,
+    copy them before changing them.
+    """
+    payload = memoryview(payload)
+    (size,) = _unpack(_ARRAYS_HEADER, payload, 0)
+    header = json.loads(bytes(_slice(payload, _ARRAYS_HEADER.size, size)))
+    offset = _ARRAYS_HEADER.size + size
+
+    def restore(value):
+        nonlocal offset
+        if isinstance(value, dict):
+            if "__array__" in value:
+                dtype, shape = value["__array__"]
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape, dtype=np.int64))
+                array = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+                offset += count * dtype.itemsize
+                return array.reshape(shape)
+            return {key: restore(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [restore(item) for item in value]
+        return value
+
+    return restore(header)
+
+
+def _pack_timeseries(timeseries: dict) -> bytes:
+    chunks = []
+    for machine_id, history in timeseries.items():
+        machine_id = machine_id.encode()
+        arrays = pack_arrays(history)
+        chunks += [
+            _MACHINE_ID.pack(len(machine_id)),
+            machine_id,
+            _ARRAYS_SIZE.pack(len(arrays)),
+            arrays,
+        ]
+    return b"".join(chunks)
+
+
+def _unpack_timeseries(payload: memoryview) -> dict:
+    timeseries = {}
+    offset = 0
+    while offset < len(payload):
+        (size,) = _unpack(_MACHINE_ID, payload, offset)
+        offset += _MACHINE_ID.size
+        machine_id = bytes(_slice(payload, offset, size)).decode()
+        offset += size
+        (size,) = _unpack(_ARRAYS_SIZE, payload, offset)
+        offset += _ARRAYS_SIZE.size
+        timeseries[machine_id] = unpack_arrays(_slice(payload, offset, size))
+        offset += size
+    return timeseries
+
+
+def write_snapshot(
+    filename: str,
+    status_data: dict,
+    gpu_codes: dict,
+    state: dict,
+    timeseries: dict = None,
+) -> int:
+    """Write a snapshot atomically (temporary file + rename), return its size in bytes"""
+    sections = [
+        _pack_section("status", _pack_status(status_data)),
+        _pack_section("gpu_record", _pack_gpu_record(gpu_codes)),
+        _pack_section("state", json.dumps(state).encode()),
+        _pack_section("timeseries", _pack_timeseries(timeseries or {})),
+    ]
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+        for section in sections:
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    return os.path.getsize(filename)
+
+
+def read_snapshot(filename: str) -> dict:
+    """
+    Read a snapshot written by `write_snapshot`.
+
+    Returns:
+        dict: with the keys "status" (LazyStatusData), "gpu_record" (columns and
+              string tables as written by `GPURecordBuffer.to_codes`), "state"
+              and "timeseries" (`TimeSeriesStore.state` of every machine)
+
+    Raises:
+        ValueError: the file is not a snapshot, has an unsupported version, or
+            is truncated or corrupt
+    """
+    with open(filename, "rb") as f:
+        data = memoryview(f.read())
+
+    magic, version, n_sections = _unpack(_HEADER, data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a snapshot file")
+    if version > VERSION:
+        raise ValueError(f"Unsupported snapshot version {version} in {filename}")
+
+    snapshot = dict(status=LazyStatusData(), gpu_record=None, state={}, timeseries={})
+    offset = _HEADER.size
+    for _ in range(n_sections):
+        (size,) = _unpack(_SECTION_NAME, data, offset)
+        offset += _SECTION_NAME.size
+        name = bytes(_slice(data, offset, size)).decode()
+        offset += size
+        (size,) = _unpack(_SECTION_SIZE, data, offset)
+        offset += _SECTION_SIZE.size
+        payload = _slice(data, offset, size)
+        offset += size
+
+        try:
+            if name == "status":
+                snapshot["status"] = _unpack_status(payload)
+            elif name == "gpu_record":
+                snapshot["gpu_record"] = _unpack_gpu_record(payload)
+            elif name == "state":
+                snapshot["state"] = json.loads(bytes(payload))
+            elif name == "timeseries":
+                snapshot["timeseries"] = _unpack_timeseries(payload)
+        except ValueError as e:
+            raise ValueError(f"Corrupt {name} section in {filename}: {e}") from None
+        except (KeyError, TypeError) as e:
+            # valid JSON of the wrong structure
+            raise ValueError(f"Corrupt {name} section in {filename}: {e!r}") from None
+    if offset != len(data):
+        raise ValueError(f"Unexpected data after the last section of {filename}")
+    return snapshot
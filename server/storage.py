@@ -0,0 +1,454 @@
+import csv
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from data_model import MachineStatus
+from gpu_record import GPURecordBuffer
+from snapshot import LazyStatusData, pack_arrays, read_snapshot, unpack_arrays
+from snapshot import write_snapshot as write_snapshot_file
+from wal import WriteAheadLog
+
+###############################################################################
+### Storage backends
+#
+# `Database` keeps the hot data in memory (the last statuses of each machine and
+# the GPU record ring buffer) and hands persistence to a storage backend:
+#
+#   load_status_data(max_records)       statuses to start with, per machine
+#   load_gpu_record(buffer)             fill the GPU record ring buffer
+#   load_state()                        state derived at ingest (e.g. the GPU-hour ledger)
+#   load_timeseries()                   utilization history, `TimeSeriesStore.state` per machine
+#   replay()                            serialized statuses to re-apply on startup
+#   append(status, record)              persist one accepted status
+#   append_many(statuses, records)      persist a batch of accepted statuses at once
+#   rotate()                            called under the database lock before a snapshot
+#   write_snapshot(token, ...)          compaction / retention, returns its size in bytes
+#                                       (GPU records as `GPURecordBuffer.to_codes()`)
+#
+# Everything loaded on startup reflects the same point in time (the last
+# snapshot), `replay()` yields the statuses received after it. The utilization
+# history may be a little newer, it ignores statuses it already holds.
+#   query_status(...)                   indexed range queries, or None when the
+#   query_gpu_record(...)               backend has no index and memory must be used
+#                                       (GPU records are paginated by an opaque cursor)
+
+
+class JSONStorage:
+    """
+    The file store: a binary snapshot (see `snapshot.py`) of the statuses, the
+    GPU records and the derived state, and a write-ahead log of the serialized
+    statuses received since the last snapshot.
+
+    Snapshots of older versions (a JSON file of statuses and a CSV file of GPU
+    records) are still read, and removed once the first binary snapshot has
+    been written.
+    """
+
+    def __init__(
+        self,
+        snapshot_filename,
+        record_filename,
+        gpu_record_filename,
+        wal_dirname,
+        configs,
+    ):
+        self.snapshot_filename = snapshot_filename
+        self.legacy_filenames = (record_filename, gpu_record_filename)
+        self.wal = WriteAheadLog(
+            wal_dirname,
+            fsync_interval=configs.get("wal_fsync_interval", 1.0),
+            fsync_batch=configs.get("wal_fsync_batch", 64),
+        )
+        self._loaded: Optional[dict] = None
+
+    def _load(self) -> dict:
+        """Read the snapshot once, the `load_*` methods each take their part of it"""
+        if self._loaded is None:
+            try:
+                if os.path.exists(self.snapshot_filename):
+                    self._loaded = read_snapshot(self.snapshot_filename)
+                else:
+                    self._loaded = self._load_legacy(*self.legacy_filenames)
+            except Exception as e:
+                print(e)
+                self._loaded = dict(
+                    status=LazyStatusData(), gpu_record=None, state={}, timeseries={}
+                )
+        return self._loaded
+
+    @staticmethod
+    def _load_legacy(record_filename, gpu_record_filename) -> dict:
+        loaded = dict(status=LazyStatusData(), gpu_record=None, state={}, timeseries={})
+        if os.path.exists(record_filename):
+            with open(record_filename, "r") as f:
+                for key, values in json.load(f).items():
+                    loaded["status"][key] = [
+                        MachineStatus.from_trusted(json.loads(o)) for o in values
+                    ]
+        if os.path.exists(gpu_record_filename):
+            with open(gpu_record_filename, "r", newline="") as f:
+                rows = [
+                    (
+                        row["user"],
+                        datetime.fromisoformat(row["time"]),
+                        row["machine_id"],
+                    )
+                    for row in csv.DictReader(f)
+                ]
+            if rows:
+                loaded["gpu_record"] = dict(
+                    zip(("user", "time", "machine_id"), zip(*rows))
+                )
+        return loaded
+
+    def load_status_data(self, max_records: int) -> Dict[str, List[MachineStatus]]:
+        return self._load()["status"]
+
+    def load_gpu_record(self, buffer: GPURecordBuffer):
+        gpu_record = self._load()["gpu_record"]
+        if gpu_record is None:
+            return
+        if "users" in gpu_record:
+            buffer.extend_codes(**gpu_record)
+        else:
+            buffer.extend(
+                gpu_record["user"], gpu_record["time"], gpu_record["machine_id"]
+            )
+
+    def load_state(self) -> dict:
+        return self._load()["state"]
+
+    def load_timeseries(self) -> Dict[str, dict]:
+        return self._load()["timeseries"]
+
+    def replay(self) -> Iterator[str]:
+        return self.wal.replay()
+
+    def append(self, status: MachineStatus, record: str):
+        self.wal.append(record)
+
+    def append_many(self, statuses: List[MachineStatus], records: List[str]):
+        self.wal.append_many(records)
+
+    def rotate(self) -> int:
+        return self.wal.rotate()
+
+    def write_snapshot(
+        self,
+        token: int,
+        status_data: dict,
+        gpu_columns: dict,
+        state: dict,
+        timeseries: Dict[str, dict],
+    ) -> int:
+        snapshot_bytes = write_snapshot_file(
+            self.snapshot_filename, status_data, gpu_columns, state, timeseries
+        )
+        self.wal.checkpoint(token)
+        for filename in self.legacy_filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        return snapshot_bytes
+
+    def query_status(self, machine_id, since=None, until=None):
+        return None
+
+    def query_gpu_record(self, **query):
+        return None
+
+    def close(self):
+        self.wal.close()
+
+
+class SQLiteStorage:
+    """
+    SQLite store in WAL mode. Every status and GPU process record is a row,
+    indexed by (machine_id, created_at) and (user, created_at), so history is
+    no longer bounded by what fits in memory and range queries are index
+    lookups. Snapshots reduce to storing the derived state (the utilization
+    history as packed arrays, a row per machine) and the `history_days`
+    retention DELETE.
+    Times are stored as POSIX timestamps of the server's local time.
+
+    The `watermark` in the meta table holds the newest row id of both tables
+    covered by the stored derived state: rows up to it are loaded as is, newer
+    rows are replayed. Row ids, not times: `created_at` is set before a status
+    is appended (or by the client, for batches), so a row appended after the
+    snapshot may carry an older time than rows the snapshot covers.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS status (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS status_machine_time ON status (machine_id, created_at);
+    CREATE INDEX IF NOT EXISTS status_time ON status (created_at);
+
+    CREATE TABLE IF NOT EXISTS gpu_record (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        machine_id TEXT NOT NULL,
+        user TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS gpu_record_machine_time ON gpu_record (machine_id, created_at);
+    CREATE INDEX IF NOT EXISTS gpu_record_user_time ON gpu_record (user, created_at);
+    CREATE INDEX IF NOT EXISTS gpu_record_time ON gpu_record (created_at);
+
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS timeseries (
+        machine_id TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    );
+    """
+
+    def __init__(self, filename, configs):
+        self.filename = filename
+        self.history_days = configs["history_days"]
+        # one connection shared by request handlers and the snapshot worker
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.watermark = self._load_watermark()
+
+    def _get_meta(self, key: str, default: str = None) -> str:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def _load_watermark(self) -> Dict[str, int]:
+        watermark = dict(status=0, gpu_record=0)
+        try:
+            stored = json.loads(self._get_meta("watermark", "{}"))
+        except ValueError:
+            stored = None
+        if isinstance(stored, dict):
+            watermark.update(stored)
+        return watermark
+
+    def load_status_data(self, max_records: int) -> Dict[str, List[MachineStatus]]:
+        with self._lock:
+            rows = self.conn.execute(
+                """
+                SELECT machine_id, data FROM (
+                    SELECT machine_id, data, created_at, ROW_NUMBER() OVER (
+                        PARTITION BY machine_id ORDER BY created_at DESC
+                    ) AS recency
+                    FROM status
+                    WHERE id <= ?
+                )
+                WHERE recency < ?
+                ORDER BY machine_id, created_at
+                """,
+                (self.watermark["status"], max_records),
+            ).fetchall()
+        # statuses were validated on ingest, only decode a machine's history when used
+        histories = defaultdict(list)
+        for machine_id, data in rows:
+            histories[machine_id].append(data)
+        status_data = LazyStatusData()
+        for machine_id, history in histories.items():
+            dict.__setitem__(status_data, machine_id, f"[{','.join(history)}]".encode())
+        return status_data
+
+    def load_gpu_record(self, buffer: GPURecordBuffer):
+        with self._lock:
+            rows = self.conn.execute(
+                """
+                SELECT user, created_at, machine_id FROM (
+                    SELECT * FROM gpu_record WHERE id <= ?
+                    ORDER BY id DESC LIMIT ?
+                ) ORDER BY id
+                """,
+                (self.watermark["gpu_record"], buffer.capacity),
+            ).fetchall()
+        if rows:
+            users, times, machine_ids = zip(*rows)
+            buffer.extend(
+                users, [datetime.fromtimestamp(t) for t in times], machine_ids
+            )
+
+    def load_state(self) -> dict:
+        return json.loads(self._get_meta("state", "{}"))
+
+    def load_timeseries(self) -> Dict[str, dict]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT machine_id, data FROM timeseries"
+            ).fetchall()
+        return {machine_id: unpack_arrays(data) for machine_id, data in rows}
+
+    def replay(self) -> Iterator[str]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT data FROM status WHERE id > ? ORDER BY id",
+                (self.watermark["status"],),
+            ).fetchall()
+        return (data for (data,) in rows)
+
+    def append(self, status: MachineStatus, record: str):
+        self.append_many([status], [record])
+
+    def append_many(self, statuses: List[MachineStatus], records: List[str]):
+        # one transaction for the whole batch
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO status (machine_id, created_at, data) VALUES (?, ?, ?)",
+                [
+                    (status.machine_id, status.created_at.timestamp(), record)
+                    for status, record in zip(statuses, records)
+                ],
+            )
+            self.conn.executemany(
+                "INSERT INTO gpu_record (machine_id, user, created_at) VALUES (?, ?, ?)",
+                [
+                    (
+                        status.machine_id,
+                        process.user or "",
+                        status.created_at.timestamp(),
+                    )
+                    for status in statuses
+                    for process in status.gpu_compute_processes or []
+                ],
+            )
+
+    def rotate(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                table: self.conn.execute(
+                    f"SELECT COALESCE(MAX(id), 0) FROM {table}"
+                ).fetchone()[0]
+                for table in ("status", "gpu_record")
+            }
+
+    def write_snapshot(
+        self,
+        token: Dict[str, int],
+        status_data: dict,
+        gpu_columns: dict,
+        state: dict,
+        timeseries: Dict[str, dict],
+    ) -> int:
+        cutoff = datetime.now().timestamp() - self.history_days * 86400
+        # packed outside of the connection lock, queries go on meanwhile
+        timeseries = [
+            (machine_id, pack_arrays(history))
+            for machine_id, history in timeseries.items()
+        ]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("state", json.dumps(state)), ("watermark", json.dumps(token))],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO timeseries (machine_id, data) VALUES (?, ?)",
+                timeseries,
+            )
+            self.watermark = token
+            self.conn.execute("DELETE FROM status WHERE created_at < ?", (cutoff,))
+            self.conn.execute("DELETE FROM gpu_record WHERE created_at < ?", (cutoff,))
+        with self._lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return os.path.getsize(self.filename)
+
+    @staticmethod
+    def _time_range(since: Optional[datetime], until: Optional[datetime]):
+        return (
+            since.timestamp() if since else float("-inf"),
+            until.timestamp() if until else float("inf"),
+        )
+
+    def query_status(self, machine_id, since=None, until=None) -> List[MachineStatus]:
+        with self._lock:
+            rows = self.conn.execute(
+                """
+                SELECT data FROM status
+                WHERE machine_id = ? AND created_at BETWEEN ? AND ?
+                ORDER BY created_at
+                """,
+                (machine_id, *self._time_range(since, until)),
+            ).fetchall()
+        return [MachineStatus.from_trusted(json.loads(data)) for (data,) in rows]
+
+    def query_gpu_record(
+        self,
+        machine_id=None,
+        user=None,
+        since=None,
+        until=None,
+        cursor=None,
+        limit=None,
+        fields=GPURecordBuffer.FIELDS,
+    ):
+        conditions, params = ["created_at BETWEEN ? AND ?"], [
+            *self._time_range(since, until)
+        ]
+        if machine_id is not None:
+            conditions.append("machine_id = ?")
+            params.append(machine_id)
+        if user is not None:
+            conditions.append("user = ?")
+            params.append(user)
+        if cursor is not None:
+            conditions.append("id > ?")
+            params.append(cursor)
+        # fetch one row more than asked for to know whether there is a next page
+        params.append(-1 if limit is None else limit + 1)
+        with self._lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT id, user, created_at, machine_id FROM gpu_record
+                WHERE {" AND ".join(conditions)}
+                ORDER BY id
+                LIMIT ?
+                """,
+                params,
+            ).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        records = []
+        for _, user, created_at, machine_id in rows:
+            record = dict(
+                user=user,
+                time=datetime.fromtimestamp(created_at),
+                machine_id=machine_id,
+            )
+            records.append({field: record[field] for field in fields})
+        return records, next_cursor
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def create_storage(configs) -> "JSONStorage | SQLiteStorage":
+    backend = configs.get("storage", "json")
+    if backend == "json":
+        return JSONStorage(
+            snapshot_filename="./server_snapshot.bin",
+            record_filename="./machine_status.json",
+            gpu_record_filename="./gpu_status.json",
+            wal_dirname="./wal",
+            configs=configs,
+        )
+    if backend == "sqlite":
+        return SQLiteStorage(filename="./machine_status.sqlite3", configs=configs)
+    raise ValueError(f"Unknown storage backend: {backend}")
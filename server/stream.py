@@ -0,0 +1,116 @@
+import asyncio
+import json
+import threading
+from typing import AsyncIterator, Callable, List, Optional
+
+from data_model import MachineStatus
+
+###############################################################################
+### Server-sent events
+#
+# Every subscriber of /stream first gets a `snapshot` event with the latest
+# status of every machine (the /server_status body), then a `status` event per
+# status accepted by the database, holding only the top-level fields that
+# changed since the previous status of that machine:
+#
+#   event: status
+#   data: {"machine_id": "...", "changes": {"created_at": "...", "cpu_usage": 0.42, ...}}
+#
+# Applying the changes to the machine's status (adding the machine if it is
+# new) keeps a subscriber in sync. Changes set values, so applying one twice is
+# harmless. Subscribers that cannot keep up are disconnected, and resync from a
+# new snapshot when they reconnect.
+
+
+def format_event(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+def status_changes(previous: Optional[MachineStatus], status: MachineStatus) -> dict:
+    """Top-level fields of `status` that differ from `previous`, JSON-ready"""
+    if previous is None:
+        return status.model_dump(mode="json")
+    changed = {
+        field
+        for field in MachineStatus.model_fields
+        if getattr(status, field, None) != getattr(previous, field, None)
+    }
+    return status.model_dump(mode="json", include=changed)
+
+
+class StatusBroadcaster:
+    """
+    Fans out accepted statuses to the open /stream connections.
+
+    `publish` is called by the database from whatever thread ingests the
+    status, with the machine's shard lock held: it only hands the statuses to
+    the event loop, where the event is encoded once and put in every
+    subscriber's queue, so ingestion never waits for encoding or a slow
+    connection.
+    """
+
+    def __init__(self, snapshot: Callable[[], bytes], max_queue: int = 256):
+        self.snapshot = snapshot
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers: List[asyncio.Queue] = []
+        self._loop: asyncio.AbstractEventLoop = None
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, previous: Optional[MachineStatus], status: MachineStatus):
+        if not self._subscribers:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._broadcast, previous, status)
+        except RuntimeError:
+            pass  # the event loop is closed, the server is shutting down
+
+    def _broadcast(self, previous: Optional[MachineStatus], status: MachineStatus):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        data = json.dumps(
+            dict(machine_id=status.machine_id, changes=status_changes(previous, status))
+        ).encode()
+        event = format_event("status", data)
+        for subscriber in subscribers:
+            self._offer(subscriber, event)
+
+    def _offer(self, subscriber: asyncio.Queue, event: bytes):
+        if subscriber.qsize() < self.max_queue:
+            subscriber.put_nowait(event)
+        elif self._unsubscribe(subscriber):
+            # too slow, `events` ends the connection after what is queued
+            subscriber.put_nowait(None)
+
+    def _unsubscribe(self, subscriber: asyncio.Queue) -> bool:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+                return True
+        return False
+
+    async def events(
+        self, is_disconnected: Callable, keepalive: float = 15.0
+    ) -> AsyncIterator[bytes]:
+        """The event stream of one connection"""
+        self._loop = asyncio.get_running_loop()
+        subscriber = asyncio.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+        try:
+            yield format_event("snapshot", self.snapshot())
+            while not await is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield event
+        finally:
+            self._unsubscribe(subscriber)
@@ -0,0 +1,410 @@
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from data_model import MachineStatus
+
+###############################################################################
+### Multi-resolution utilization history
+#
+# An RRD-style store of the utilization of every machine, and of every GPU of
+# every machine. Each machine has:
+#
+#   - a raw archive: every reported value for `raw_seconds` (e.g. a day)
+#   - rollup archives: min / mean / max per `step` seconds for a fixed number of
+#     steps (e.g. 5 minutes for a month, an hour for a year)
+#
+# Rollups are consolidated incrementally at ingest: the bucket in progress is
+# kept as running min / sum / count / max, and written to its row once a value
+# of a later bucket arrives. Rows are a ring indexed by `slot % capacity` (slot
+# is the bucket number since the epoch). The capacity starts small and doubles,
+# re-placing the rows held, as the history spans more slots, up to `rows`; the
+# raw archive grows the same way. Once an archive holds its full retention,
+# memory per machine is fixed and nothing is ever trimmed or copied.
+
+HOST_METRICS = ("cpu_usage", "cpu_temp", "ram_usage")
+GPU_METRICS = ("gpu_usage", "memory_usage", "temperature")
+
+Series = Tuple[str, int]  # (metric, gpu_index), gpu_index is -1 for host metrics
+
+
+def status_values(status: MachineStatus) -> Dict[Series, float]:
+    """The values of every series in a status, missing ones are NaN"""
+    values = {}
+    for metric in HOST_METRICS:
+        values[(metric, -1)] = getattr(status, metric, None)
+    for gpu in status.gpu_status or []:
+        if gpu.index is None:
+            continue
+        for metric in GPU_METRICS:
+            values[(metric, gpu.index)] = getattr(gpu, metric, None)
+    return {
+        series: math.nan if value is None else float(value)
+        for series, value in values.items()
+    }
+
+
+def _add_columns(array: np.ndarray, n_columns: int, fill) -> np.ndarray:
+    """`array` with its second axis grown to `n_columns`, new columns set to `fill`"""
+    shape = list(array.shape)
+    shape[1] = n_columns - array.shape[1]
+    return np.concatenate([array, np.full(shape, fill, dtype=array.dtype)], axis=1)
+
+
+def _grow(array: np.ndarray, capacity: int, fill) -> np.ndarray:
+    """A new array of `capacity` rows with the columns of `array`, set to `fill`"""
+    return np.full((capacity, *array.shape[1:]), fill, dtype=array.dtype)
+
+
+class RawArchive:
+    """
+    Ring buffer of the reported values of the last `seconds`, oldest first.
+    It starts small and doubles when full, up to `max_capacity` values.
+    """
+
+    def __init__(self, seconds: float, max_capacity: int, n_columns: int = 0):
+        self.seconds = seconds
+        self.max_capacity = int(max_capacity)
+        self.capacity = min(64, self.max_capacity)
+        self.time = np.zeros(self.capacity, dtype=np.float64)  # epoch seconds
+        self.values = np.full((self.capacity, n_columns), np.nan, dtype=np.float32)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add_columns(self, n_columns: int):
+        self.values = _add_columns(self.values, n_columns, np.nan)
+
+    def _resize(self, capacity: int):
+        order = self._order()
+        time, values = _grow(self.time, capacity, 0), _grow(
+            self.values, capacity, np.nan
+        )
+        time[: self._size], values[: self._size] = self.time[order], self.values[order]
+        self.time, self.values, self.capacity, self._head = time, values, capacity, 0
+
+    def append(self, time: float, values: np.ndarray):
+        while self._size and self.time[self._head] < time - self.seconds:
+            self._head = (self._head + 1) % self.capacity
+            self._size -= 1
+        if self._size == self.capacity:
+            if self.capacity < self.max_capacity:
+                self._resize(min(2 * self.capacity, self.max_capacity))
+            else:
+                self._head = (self._head + 1) % self.capacity
+                self._size -= 1
+        pos = (self._head + self._size) % self.capacity
+        self.time[pos] = time
+        self.values[pos] = values
+        self._size += 1
+
+    def _order(self) -> np.ndarray:
+        return (self._head + np.arange(self._size)) % self.capacity
+
+    def query(self, column: int, since: float, until: float) -> dict:
+        order = self._order()
+        time, values = self.time[order], self.values[order, column]
+        mask = (time >= since) & (time <= until) & ~np.isnan(values)
+        values = values[mask].astype(np.float64)
+        return dict(time=time[mask], min=values, mean=values, max=values)
+
+    def state(self) -> dict:
+        order = self._order()
+        return dict(time=self.time[order], values=self.values[order])
+
+    def load(self, data: dict):
+        time = data["time"][-self.max_capacity :]
+        values = data["values"][-self.max_capacity :]
+        self._resize(max(self.capacity, len(time)))
+        self._size = len(time)
+        self.time[: self._size] = time
+        self.values[: self._size] = values
+
+
+class RollupArchive:
+    """
+    Min / mean / max of every column per `step` seconds, for the last `rows`
+    steps. Rows are stored as float16, which is plenty for ratios and
+    temperatures, and halves the memory of the (long) rollups.
+    The ring starts small and doubles as the history gets longer, so a machine
+    that reported for a day does not hold a year worth of empty rows.
+    """
+
+    MIN, MEAN, MAX = range(3)
+
+    def __init__(self, step: int, rows: int, n_columns: int = 0):
+        self.step = int(step)
+        self.rows = int(rows)
+        self.capacity = min(16, self.rows)
+        self.data = np.full((self.capacity, n_columns, 3), np.nan, dtype=np.float16)
+        self.first_slot: Optional[int] = None  # slot of the first bucket
+        self.last_slot: Optional[int] = None  # slot of the bucket in progress
+        self._reset(n_columns)
+
+    def _reset(self, n_columns: int):
+        self._count = np.zeros(n_columns, dtype=np.int64)
+        self._sum = np.zeros(n_columns, dtype=np.float64)
+        self._min = np.full(n_columns, np.inf, dtype=np.float64)
+        self._max = np.full(n_columns, -np.inf, dtype=np.float64)
+
+    def add_columns(self, n_columns: int):
+        self.data = _add_columns(self.data, n_columns, np.nan)
+        self._count = np.concatenate(
+            [self._count, np.zeros(n_columns - len(self._count), dtype=np.int64)]
+        )
+        self._sum = np.concatenate([self._sum, np.zeros(n_columns - len(self._sum))])
+        self._min = np.concatenate(
+            [self._min, np.full(n_columns - len(self._min), np.inf)]
+        )
+        self._max = np.concatenate(
+            [self._max, np.full(n_columns - len(self._max), -np.inf)]
+        )
+
+    def _slots(self) -> np.ndarray:
+        """Slots of the rows held, oldest first, up to the bucket in progress"""
+        if self.last_slot is None:
+            return np.zeros(0, dtype=np.int64)
+        first = max(self.first_slot, self.last_slot - self.capacity + 1)
+        return np.arange(first, self.last_slot + 1)
+
+    def _resize(self, span: int):
+        """Grow the ring to hold `span` slots (up to `rows`)"""
+        capacity = self.capacity
+        while capacity < min(span, self.rows):
+            capacity *= 2
+        capacity = min(capacity, self.rows)
+        if capacity == self.capacity:
+            return
+        slots = self._slots()
+        data = _grow(self.data, capacity, np.nan)
+        data[slots % capacity] = self.data[slots % self.capacity]
+        self.data, self.capacity = data, capacity
+
+    def _consolidate(self) -> np.ndarray:
+        """Min / mean / max of the bucket in progress, NaN for columns without values"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            empty = self._count == 0
+            row = np.stack([self._min, self._sum / self._count, self._max], axis=-1)
+        row[empty] = np.nan
+        return row
+
+    def update(self, time: float, values: np.ndarray):
+        slot = int(time // self.step)
+        if self.last_slot is None:
+            self.first_slot = self.last_slot = slot
+        elif slot < self.last_slot:
+            return  # the bucket was already written
+        elif slot > self.last_slot:
+            self.data[self.last_slot % self.capacity] = self._consolidate()
+            self._resize(slot - self.first_slot + 1)
+            # buckets without any report stay empty
+            skipped = np.arange(
+                self.last_slot + 1, min(slot, self.last_slot + self.capacity) + 1
+            )
+            self.data[skipped % self.capacity] = np.nan
+            self.last_slot = slot
+            self._reset(len(self._count))
+
+        present = ~np.isnan(values)
+        self._count += present
+        self._sum += np.where(present, values, 0)
+        self._min = np.fmin(self._min, np.where(present, values, np.inf))
+        self._max = np.fmax(self._max, np.where(present, values, -np.inf))
+
+    def query(self, column: int, since: float, until: float) -> dict:
+        slots = self._slots()
+        rows = self.data[slots % self.capacity, column].astype(np.float64)
+        if len(rows):
+            rows[-1] = self._consolidate()[column]
+        time = slots.astype(np.float64) * self.step
+        mask = (
+            (time + self.step > since) & (time <= until) & ~np.isnan(rows[:, self.MEAN])
+        )
+        rows = rows[mask]
+        return dict(
+            time=time[mask],
+            min=rows[:, self.MIN],
+            mean=rows[:, self.MEAN],
+            max=rows[:, self.MAX],
+        )
+
+    def state(self) -> dict:
+        slots = self._slots()
+        return dict(
+            step=self.step,
+            # rows of the slots up to `last_slot`, oldest first
+            data=self.data[slots % self.capacity],
+            last_slot=self.last_slot,
+            count=self._count.copy(),
+            sum=self._sum.copy(),
+            min=self._min.copy(),
+            max=self._max.copy(),
+        )
+
+    def load(self, data: dict):
+        if data["step"] != self.step or data["last_slot"] is None:
+            return  # the configuration changed, start this archive over
+        stored = data["data"][-self.rows :]
+        self.last_slot = data["last_slot"]
+        self.first_slot = self.last_slot - len(stored) + 1
+        self._resize(len(stored))
+        self.data[self._slots() % self.capacity] = stored
+        # the arrays of a snapshot are read-only
+        self._count = data["count"].copy()
+        self._sum = data["sum"].copy()
+        self._min = data["min"].copy()
+        self._max = data["max"].copy()
+
+
+class MachineHistory:
+    """The raw and rollup archives of one machine, one column per series"""
+
+    def __init__(
+        self, raw_seconds: float, raw_capacity: int, rollups: List[Tuple[int, int]]
+    ):
+        self.columns: Dict[Series, int] = {}
+        self.latest: float = None  # time of the latest report
+        self.raw = RawArchive(raw_seconds, raw_capacity)
+        self.rollups = [RollupArchive(step, rows) for step, rows in rollups]
+
+    def _column(self, series: Series) -> int:
+        column = self.columns.get(series)
+        if column is None:
+            column = self.columns[series] = len(self.columns)
+            # a new GPU, or a metric of the machine reported for the first time
+            self.raw.add_columns(len(self.columns))
+            for archive in self.rollups:
+                archive.add_columns(len(self.columns))
+        return column
+
+    def add(self, time: float, values: Dict[Series, float]):
+        if self.latest is not None and time <= self.latest:
+            return  # e.g. a status replayed after a snapshot that includes it
+        columns = [self._column(series) for series in values]
+        row = np.full(len(self.columns), np.nan, dtype=np.float64)
+        row[columns] = list(values.values())
+        self.latest = time
+        self.raw.append(time, row)
+        for archive in self.rollups:
+            archive.update(time, row)
+
+    def state(self) -> dict:
+        return dict(
+            columns=[[metric, gpu_index] for metric, gpu_index in self.columns],
+            latest=self.latest,
+            raw=self.raw.state(),
+            rollups=[archive.state() for archive in self.rollups],
+        )
+
+    def load(self, data: dict):
+        for metric, gpu_index in data["columns"]:
+            self._column((metric, gpu_index))
+        self.latest = data["latest"]
+        self.raw.load(data["raw"])
+        for archive, archive_data in zip(self.rollups, data["rollups"]):
+            archive.load(archive_data)
+
+
+class TimeSeriesStore:
+    """
+    Utilization history of every machine (see the top of this module).
+
+    Args:
+        report_interval: expected seconds between reports, sizes the raw archive
+        raw_days: how long every reported value is kept
+        rollups: (step in seconds, retention in days) of every rollup archive
+    """
+
+    def __init__(
+        self,
+        report_interval: float,
+        raw_days: float = 1,
+        rollups: List[Tuple[int, float]] = ((300, 30), (3600, 365)),
+    ):
+        self.raw_seconds = raw_days * 86400
+        # reports come with jitter and bursts, leave room for twice as many
+        self.raw_capacity = max(1, math.ceil(2 * self.raw_seconds / report_interval))
+        self.rollups = sorted(
+            (int(step), math.ceil(days * 86400 / step)) for step, days in rollups
+        )
+        self.machines: Dict[str, MachineHistory] = {}
+
+    def add(self, status: MachineStatus):
+        """
+        Add the values of a status, unless it is not newer than the latest
+        status added for its machine. The store takes no lock: callers
+        serialize the calls for one machine (the database holds its shard lock).
+        """
+        history = self.machines.get(status.machine_id)
+        if history is None:
+            history = self.machines[status.machine_id] = MachineHistory(
+                self.raw_seconds, self.raw_capacity, self.rollups
+            )
+        history.add(status.created_at.timestamp(), status_values(status))
+
+    def query(
+        self,
+        machine_id: str,
+        metric: str,
+        gpu_index: int = -1,
+        since: float = None,
+        until: float = None,
+        step: int = None,
+    ) -> Optional[dict]:
+        """
+        The history of one series within [since, until] (epoch seconds), as
+        arrays of bucket start `time` and `min` / `mean` / `max` (all the same
+        for raw values). `step` picks the archive: 0 for raw values, or the step
+        of a rollup; by default the finest archive that reaches back to `since`.
+
+        Returns:
+            dict: the arrays and the `step` they were taken from, or None if the
+                machine never reported the series
+        """
+        history = self.machines.get(machine_id)
+        if history is None or (metric, gpu_index) not in history.columns:
+            return None
+        column = history.columns[(metric, gpu_index)]
+        until = math.inf if until is None else until
+        archives = {0: history.raw, **{a.step: a for a in history.rollups}}
+        if step is None:
+            step = self._pick_step(history.latest, since)
+        if step not in archives:
+            raise ValueError(
+                f"Unknown step {step}, available: {', '.join(map(str, archives))}"
+            )
+        since = -math.inf if since is None else since
+        result = archives[step].query(column, since, until)
+        result["step"] = step
+        return result
+
+    def _pick_step(self, latest: float, since: Optional[float]) -> int:
+        """The finest archive whose retention covers `since`, else the coarsest"""
+        coarsest = self.rollups[-1][0] if self.rollups else 0
+        if since is None:
+            return coarsest
+        if since >= latest - self.raw_seconds:
+            return 0
+        for step, rows in self.rollups:
+            if since >= latest - step * rows:
+                return step
+        return coarsest
+
+    def state(self, machine_id: str) -> Optional[dict]:
+        """
+        A copy of the archives of a machine, as numpy arrays (see `load`), None
+        if it never reported
+        """
+        history = self.machines.get(machine_id)
+        return history.state() if history else None
+
+    def load(self, data: Dict[str, dict]):
+        """Restore the `state` of every machine, {machine_id: state}"""
+        for machine_id, history_data in data.items():
+            history = self.machines[machine_id] = MachineHistory(
+                self.raw_seconds, self.raw_capacity, self.rollups
+            )
+            history.load(history_data)
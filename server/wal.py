@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of status reports, split into numbered segment files.
+
+    Every record is one line of text (a serialized MachineStatus). Records are
+    flushed to the OS on every append, so a crash of the server process loses
+    nothing; fsync is batched and runs once `fsync_batch` records have
+    accumulated, and at most `fsync_interval` seconds after an append (from a
+    timer if no append follows), which bounds what a power loss can take with it.
+    A torn last line left by a crash is cut off when the log is opened again,
+    so new records never get appended onto it.
+
+    Compaction works together with the snapshot files of `Database`:
+        1. `rotate()` starts a new segment and returns its sequence number
+        2. the caller writes a snapshot covering everything before that segment
+        3. `checkpoint(sequence)` records that and deletes the older segments
+    `replay()` yields the records of all segments since the last checkpoint.
+    Appends, syncs and rotations may come from different threads.
+    """
+
+    SEGMENT_SUFFIX = ".wal"
+    CHECKPOINT_FILENAME = "CHECKPOINT"
+
+    def __init__(self, directory, fsync_interval: float = 1.0, fsync_batch: int = 64):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+
+        self.checkpointed = self._read_checkpoint()
+        segments = self.segments()
+        self.sequence = max(segments[-1] if segments else 0, self.checkpointed)
+        if self.sequence in segments:
+            self._truncate_torn_tail(self._segment_path(self.sequence))
+        self._file = self._segment_path(self.sequence).open(mode="ab")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer: threading.Timer = None
+        self._lock = threading.RLock()
+
+    def _segment_path(self, sequence: int) -> Path:
+        return self.directory / f"{sequence:010d}{self.SEGMENT_SUFFIX}"
+
+    def _read_checkpoint(self) -> int:
+        checkpoint_path = self.directory / self.CHECKPOINT_FILENAME
+        try:
+            return int(checkpoint_path.read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @staticmethod
+    def _truncate_torn_tail(path: Path, chunk_size: int = 1 << 16):
+        """Cut a segment after its last complete line"""
+        with path.open(mode="r+b") as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - chunk_size)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                logger.warning(
+                    f"Truncating a torn record of {size - end} bytes in {path}"
+                )
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(path.stem)
+            for path in self.directory.glob(f"*{self.SEGMENT_SUFFIX}")
+            if path.stem.isdigit()
+        )
+
+    def append(self, record: str):
+        self.append_many([record])
+
+    def append_many(self, records: List[str]):
+        """Append several records with a single write and flush"""
+        lines = b"".join(record.encode("utf-8") + b"\n" for record in records)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            self._unsynced += len(records)
+            if (
+                self._unsynced >= self.fsync_batch
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self.sync()
+            elif self._sync_timer is None:
+                # no append may follow for a while, sync these records anyway
+                self._sync_timer = threading.Timer(
+                    self.fsync_interval, self._sync_pending
+                )
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+    def _sync_pending(self):
+        with self._lock:
+            self._sync_timer = None
+            if self._unsynced and not self._file.closed:
+                # runs on the timer thread, nobody would see the exception
+                try:
+                    self.sync()
+                except OSError:
+                    logger.exception(f"Failed to sync {self._file.name}")
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def rotate(self) -> int:
+        """Close the current segment and start a new one, return its sequence number"""
+        with self._lock:
+            self.sync()
+            self._file.close()
+            self.sequence += 1
+            self._file = self._segment_path(self.sequence).open(mode="ab")
+            return self.sequence
+
+    def checkpoint(self, sequence: int):
+        """Mark every segment before `sequence` as covered by a snapshot and delete them"""
+        checkpoint_path = self.directory / self.CHECKPOINT_FILENAME
+        tmp_path = checkpoint_path.with_suffix(".tmp")
+        with tmp_path.open(mode="w") as f:
+            f.write(str(sequence))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, checkpoint_path)
+        self.checkpointed = sequence
+
+        for segment in self.segments():
+            if segment < sequence:
+                self._segment_path(segment).unlink(missing_ok=True)
+
+    def replay(self) -> Iterator[str]:
+        """
+        Yield the records written since the last checkpoint, oldest first.
+        Torn lines are cut off on open, but the caller is still expected to
+        skip records it cannot parse (e.g. a segment damaged on disk).
+        """
+        for segment in self.segments():
+            if segment < self.checkpointed:
+                continue
+            with self._segment_path(segment).open(mode="rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line.decode("utf-8", errors="replace")
+
+    def close(self):
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            if not self._file.closed:
+                self.sync()
+                self._file.close()
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "server"
+
+# the client modules import each other by their flat names, as in client/main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "client"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+# server modules without a client module of the same name (e.g. compression.py)
+sys.path.append(str(SERVER_DIR))
+
+
+@pytest.fixture(scope="session")
+def server_cwd(tmp_path_factory):
+    """
+    Working directory of the tests of server modules: importing `database`
+    creates the storage of its module-level database in the working directory.
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    yield Path.cwd()
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def server_main(server_cwd):
+    """server/main.py, loaded by its path as the client has a `main` module too"""
+    spec = importlib.util.spec_from_file_location("server_main", SERVER_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,122 @@
+"""
+Stands in for `py3nvml.py3nvml` on machines without a GPU, e.g.
+
+    collector = NVMLCollector(FakeNVML([FakeDevice(processes=[(1234, 2048)])]))
+"""
+
+from typing import List, Optional, Tuple
+
+from gpu_nvml import MIB
+
+
+class NVMLError(Exception):
+    pass
+
+
+class _Struct:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeDevice:
+    def __init__(
+        self,
+        name: str = "NVIDIA A100-SXM4-80GB",
+        uuid: str = None,
+        utilization: int = 50,  # percent
+        temperature: int = 45,  # Celsius
+        memory_total: int = 80 * 1024,  # MiB
+        memory_used: int = 20 * 1024,  # MiB
+        processes: List[Tuple[int, Optional[int]]] = (),  # (pid, MiB used)
+    ):
+        self.name = name
+        self.uuid = uuid
+        self.utilization = utilization
+        self.temperature = temperature
+        self.memory_total = memory_total
+        self.memory_used = memory_used
+        self.processes = list(processes)
+
+
+class FakeNVML:
+    """The subset of the py3nvml API used by `NVMLCollector`"""
+
+    NVML_TEMPERATURE_GPU = 0
+    NVMLError = NVMLError
+
+    def __init__(
+        self,
+        devices: List[FakeDevice] = (),
+        driver_version: str = "535.104.05",
+        cuda_version: int = 12020,
+        fail_init: bool = False,
+    ):
+        self.devices = list(devices)
+        for index, device in enumerate(self.devices):
+            device.uuid = device.uuid or f"GPU-00000000-0000-0000-0000-{index:012d}"
+        self.driver_version = driver_version
+        self.cuda_version = cuda_version
+        self.fail_init = fail_init
+        self.initialized = False
+        self.init_calls = 0
+
+    def _check(self):
+        if not self.initialized:
+            raise NVMLError("Uninitialized")
+
+    def nvmlInit(self):
+        self.init_calls += 1
+        if self.fail_init:
+            raise NVMLError("Driver Not Loaded")
+        self.initialized = True
+
+    def nvmlShutdown(self):
+        self._check()
+        self.initialized = False
+
+    def nvmlSystemGetDriverVersion(self) -> str:
+        self._check()
+        return self.driver_version
+
+    def nvmlSystemGetCudaDriverVersion(self) -> int:
+        self._check()
+        return self.cuda_version
+
+    def nvmlDeviceGetCount(self) -> int:
+        self._check()
+        return len(self.devices)
+
+    def nvmlDeviceGetHandleByIndex(self, index: int) -> FakeDevice:
+        self._check()
+        return self.devices[index]
+
+    def nvmlDeviceGetName(self, device: FakeDevice) -> str:
+        self._check()
+        return device.name
+
+    def nvmlDeviceGetUUID(self, device: FakeDevice) -> str:
+        self._check()
+        return device.uuid
+
+    def nvmlDeviceGetUtilizationRates(self, device: FakeDevice):
+        self._check()
+        return _Struct(gpu=device.utilization, memory=0)
+
+    def nvmlDeviceGetTemperature(self, device: FakeDevice, sensor: int) -> int:
+        self._check()
+        return device.temperature
+
+    def nvmlDeviceGetMemoryInfo(self, device: FakeDevice):
+        self._check()
+        return _Struct(
+            total=device.memory_total * MIB,
+            used=device.memory_used * MIB,
+            free=(device.memory_total - device.memory_used) * MIB,
+        )
+
+    def nvmlDeviceGetComputeRunningProcesses(self, device: FakeDevice) -> list:
+        self._check()
+        return [
+            _Struct(pid=pid, usedGpuMemory=None if used is None else used * MIB)
+            for pid, used in device.processes
+        ]
@@ -0,0 +1,59 @@
+import gzip
+
+import pytest
+from compression import compress, decompress, supported_encodings
+
+BODY = b'{"machine_id": "m0", "cpu_usage": 0.5}' * 1000
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_round_trip(encoding):
+    assert decompress(compress(BODY, encoding), encoding) == BODY
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_truncated_body(encoding):
+    data = compress(BODY, encoding)
+    for size in (len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError, match="truncated"):
+            decompress(data[:size], encoding)
+
+
+@pytest.mark.parametrize("encoding", supported_encodings())
+def test_max_size(encoding):
+    with pytest.raises(ValueError, match="exceeds"):
+        decompress(compress(BODY, encoding), encoding, max_size=len(BODY) - 1)
+    assert decompress(compress(BODY, encoding), encoding, len(BODY)) == BODY
+
+
+def test_corrupt_gzip():
+    data = bytearray(gzip.compress(BODY))
+    data[len(data) // 2] ^= 0xFF
+    with pytest.raises(ValueError, match="Invalid gzip body"):
+        decompress(bytes(data), "gzip")
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError, match="Unsupported"):
+        decompress(BODY, "br")
+
+
+@pytest.mark.skipif("zstd" not in supported_encodings(), reason="zstandard missing")
+def test_zstd_frames():
+    data = compress(BODY[:5], "zstd") + compress(BODY[5:], "zstd")
+    assert decompress(data, "zstd") == BODY
+    with pytest.raises(ValueError, match="truncated"):
+        decompress(data[:-1], "zstd")
+    with pytest.raises(ValueError, match="exceeds"):
+        decompress(data, "zstd", max_size=len(BODY) - 1)
+
+
+def test_gzip_members():
+    data = gzip.compress(BODY[:5]) + gzip.compress(BODY[5:])
+    assert decompress(data, "gzip") == BODY
+    with pytest.raises(ValueError, match="truncated"):
+        decompress(data[:-1], "gzip")
+    with pytest.raises(ValueError, match="exceeds"):
+        decompress(data, "gzip", max_size=len(BODY) - 1)
+    with pytest.raises(ValueError, match="Invalid gzip body"):
+        decompress(data + b"trailing", "gzip")
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from data_model import GPUComputeProcess, MachineStatus
+
+CONFIGS = dict(history_days=30, wal_fsync_batch=1)
+T0 = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+
+
+def _status(machine_id: str, seconds: float, processes: int = 1) -> MachineStatus:
+    # users as the server stores them, already masked by validation
+    return MachineStatus(
+        machine_id=machine_id,
+        created_at=T0 + timedelta(seconds=seconds),
+        cpu_usage=0.5,
+        gpu_compute_processes=[
+            GPUComputeProcess.from_trusted(dict(user="alice", gpu_index=0))
+            for _ in range(processes)
+        ],
+    )
+
+
+def _seconds(db, machine_id: str) -> list:
+    return [
+        (status.created_at - T0).total_seconds()
+        for status in db.STATUS_DATA[machine_id]
+    ]
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def open_db(request, server_cwd, tmp_path):
+    """Opens a database on the storage of `tmp_path`, again for every call (a restart)"""
+    from database import Database
+    from storage import JSONStorage, SQLiteStorage
+
+    opened = []
+
+    def open_db():
+        if opened:
+            opened[-1].storage.close()
+        if request.param == "json":
+            storage = JSONStorage(
+                snapshot_filename=str(tmp_path / "snapshot.bin"),
+                record_filename=str(tmp_path / "machine_status.json"),
+                gpu_record_filename=str(tmp_path / "gpu_status.json"),
+                wal_dirname=str(tmp_path / "wal"),
+                configs=CONFIGS,
+            )
+        else:
+            storage = SQLiteStorage(str(tmp_path / "status.sqlite3"), CONFIGS)
+        opened.append(Database(storage))
+        return opened[-1]
+
+    yield open_db
+    opened[-1].storage.close()
+
+
+def test_add_many_applies_oldest_first(open_db):
+    db = open_db()
+    assert db.add(_status("m0", 60))
+    batch = [
+        _status("m0", 180),
+        _status("m1", 30),
+        _status("m0", 120),
+        _status("m0", 30),  # older than the latest status of m0
+        _status("m0", 120),  # not newer than the one before
+    ]
+    assert db.add_many(batch) == 3
+    assert _seconds(db, "m0") == [60, 120, 180]
+    assert _seconds(db, "m1") == [30]
+    assert db.version == 4
+    assert len(db.gpu_record) == 4
+
+    assert db.add_many([_status("m0", 150), _status("m1", 30)]) == 0
+    assert not db.add(_status("m0", 180))
+    assert db.version == 4
+
+    # only the added statuses were persisted
+    db = open_db()
+    assert _seconds(db, "m0") == [60, 120, 180]
+    assert _seconds(db, "m1") == [30]
+
+
+def test_concurrent_reports(open_db):
+    """
+    Reports of many machines added concurrently, one by one and in batches,
+    with a snapshot written half-way. Reports of a machine overtaken by a later
+    one are dropped, the invariants hold for the reports that were added.
+    """
+    db = open_db()
+    machines = 20
+    statuses = [_status(f"m{i % machines}", i) for i in range(2000)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        singles = [pool.submit(db.add, status) for status in statuses[:1000]]
+        save = pool.submit(db.save)
+        batches = [
+            pool.submit(db.add_many, statuses[i : i + 10])
+            for i in range(1000, len(statuses), 10)
+        ]
+    save.result()
+    added = sum(f.result() for f in singles) + sum(f.result() for f in batches)
+
+    assert 0 < added <= len(statuses)
+    assert db.version == added
+    assert len(db.gpu_record) == added  # one process per status
+    assert len(db.get_status()) == machines
+    for machine_id, status_list in db.STATUS_DATA.items():
+        assert 0 < len(status_list) < db.max_records
+        times = [status.created_at for status in status_list]
+        assert times == sorted(set(times))
+        assert status_list[-1] is db._latest[machine_id]
+
+    # a restart from the snapshot and the log gives back the same state
+    before = {s.machine_id: s.model_dump_json() for s in db.get_status()}
+    gpu_records = len(db.gpu_record)
+    db = open_db()
+    assert {s.machine_id: s.model_dump_json() for s in db.get_status()} == before
+    assert len(db.gpu_record) == gpu_records
@@ -0,0 +1,113 @@
+import os
+import time
+
+import disk_scan
+import pytest
+from disk_scan import DiskScanner
+
+
+@pytest.fixture
+def scanned(monkeypatch):
+    """The directories listed by `_scan_dir`, cleared by the test as it goes"""
+    scanned = []
+    scan_dir = disk_scan._scan_dir
+
+    def _scan_dir(directory):
+        scanned.append(os.path.basename(directory))
+        return scan_dir(directory)
+
+    monkeypatch.setattr(disk_scan, "_scan_dir", _scan_dir)
+    return scanned
+
+
+def _tree(root, sizes: dict):
+    for path, size in sizes.items():
+        path = root / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+
+
+def test_usage_rescans_changed_directories(tmp_path, scanned):
+    root = tmp_path / "home"
+    _tree(root, {"a.txt": 10, "alice/b.bin": 100, "alice/data/c.bin": 1000})
+    scanner = DiskScanner(tmp_path / "disk_scan.json")
+    assert scanner.usage(str(root)) == 1110
+    assert sorted(scanned) == ["alice", "data", "home"]
+    scanner.save()  # one scan pass, as in the client
+
+    scanned.clear()
+    assert scanner.usage(str(root)) == 1110
+    assert scanned == []
+    scanner.save()
+
+    # a file created in a directory changes its mtime, not the mtime of its parent
+    (root / "alice" / "data" / "d.bin").write_bytes(b"x" * 5)
+    assert scanner.usage(str(root)) == 1115
+    assert scanned == ["data"]
+    scanner.save()
+
+    # a file that grows in place is only seen once the entry is too old
+    scanned.clear()
+    with (root / "a.txt").open("ab") as f:
+        f.write(b"x" * 10)
+    assert scanner.usage(str(root)) == 1115
+    scanner.save()
+    scanner.max_age = 0
+    time.sleep(0.01)
+    assert scanner.usage(str(root)) == 1125
+    assert sorted(scanned) == ["alice", "data", "home"]
+
+
+def test_usage_rescans_a_replaced_directory(tmp_path, scanned):
+    root = tmp_path / "home"
+    _tree(root, {"alice/b.bin": 100, "bob/c.bin": 1000})
+    scanner = DiskScanner(tmp_path / "disk_scan.json")
+    assert scanner.usage(str(root / "alice")) == 100
+    scanner.save()
+
+    # another directory at the same path, with the same mtime
+    mtime_ns = os.stat(root / "alice").st_mtime_ns
+    os.rename(root / "alice", root / "alice.old")
+    os.rename(root / "bob", root / "alice")
+    os.utime(root / "alice", ns=(mtime_ns, mtime_ns))
+    scanned.clear()
+    assert scanner.usage(str(root / "alice")) == 1000
+    assert scanned == ["alice"]
+
+
+def test_save_keeps_the_scanned_directories(tmp_path, scanned):
+    path = tmp_path / "disk_scan.json"
+    root = tmp_path / "home"
+    _tree(root, {"alice/b.bin": 100, "bob/c.bin": 1000})
+    scanner = DiskScanner(path)
+    scanner.usage(str(root / "alice"))
+    scanner.usage(str(root / "bob"))
+    scanner.save()
+
+    # a restart reuses the cache of the file
+    scanner = DiskScanner(path)
+    scanned.clear()
+    assert scanner.usage(str(root / "alice")) == 100
+    assert scanned == []
+    scanner.save()  # bob was not scanned since the last save
+
+    scanner = DiskScanner(path)
+    assert scanner.usage(str(root / "bob")) == 1000
+    assert scanner.usage(str(root / "alice")) == 100
+    assert scanned == ["bob"]
+
+
+def test_detail_all(tmp_path):
+    home, data = tmp_path / "home", tmp_path / "data"
+    _tree(home, {"alice/b.bin": 100, "bob/c.bin": 1000, "notes.txt": 10})
+    _tree(data, {"datasets/d.bin": 500})
+    scanner = DiskScanner(tmp_path / "disk_scan.json")
+    # a volume listed twice is scanned once
+    details = scanner.detail_all([str(home), str(data), str(home)], workers=3)
+    assert details == {
+        str(home): [("bob", 1000), ("alice", 100), ("notes.txt", 10)],
+        str(data): [("datasets", 500)],
+    }
+    assert scanner.detail_all([str(tmp_path / "missing")]) == {
+        str(tmp_path / "missing"): []
+    }
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from downsample import downsample, lttb, minmax
+
+
+def _series(n: int) -> dict:
+    time = np.arange(n, dtype=np.float64) * 60
+    mean = np.sin(np.arange(n) / 5)
+    return dict(time=time, min=mean - 0.1, mean=mean, max=mean + 0.1)
+
+
+def test_short_series_are_kept():
+    x = np.arange(5, dtype=np.float64)
+    assert lttb(x, x, 10).tolist() == [0, 1, 2, 3, 4]
+    assert lttb(x, x, 2).tolist() == [0, 1, 2, 3, 4]
+    assert minmax(x, x, 5).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_lttb_keeps_the_ends_and_a_spike():
+    x = np.arange(100, dtype=np.float64)
+    y = np.zeros(100)
+    y[37] = 10
+    picked = lttb(x, y, 10)
+    assert len(picked) == 10
+    assert picked[0] == 0 and picked[-1] == 99
+    assert 37 in picked
+    assert np.all(np.diff(picked) > 0)
+
+
+def test_lttb_one_point_per_bucket():
+    x = np.arange(1000, dtype=np.float64)
+    picked = lttb(x, np.sin(x / 10), 52)
+    edges = np.linspace(1, 999, 51).astype(np.int64)
+    inner = picked[1:-1]
+    assert np.all((inner >= edges[:-1]) & (inner < edges[1:]))
+
+
+@pytest.mark.parametrize("points", [3, 4, 5, 10, 11, 99])
+def test_minmax_stays_within_points(points):
+    low = high = np.sin(np.arange(100) / 3)
+    picked = minmax(low, high, points)
+    assert len(picked) <= points
+    assert picked[0] == 0 and picked[-1] == 99
+    assert np.all(np.diff(picked) > 0)
+
+
+def test_minmax_keeps_the_extremes():
+    low = np.zeros(100)
+    high = np.zeros(100)
+    low[20], high[70] = -5, 5
+    picked = minmax(low, high, 8)
+    assert 20 in picked and 70 in picked
+
+
+def test_downsample():
+    series = _series(500)
+    result = downsample(series, 50, "lttb")
+    assert set(result) == set(series)
+    assert len(result["time"]) == 50
+    # points are selected, never interpolated
+    index = np.searchsorted(series["time"], result["time"])
+    for key in series:
+        np.testing.assert_array_equal(result[key], series[key][index])
+    assert len(downsample(series, 50, "minmax")["time"]) <= 50
+    with pytest.raises(ValueError, match="Unknown method"):
+        downsample(series, 50, "average")
@@ -0,0 +1,72 @@
+from fake_nvml import FakeDevice, FakeNVML
+from gpu_nvml import NVMLCollector
+
+
+def test_collect_reads_all_devices_and_processes():
+    nvml = FakeNVML(
+        [
+            FakeDevice(utilization=75, memory_used=40 * 1024, processes=[(1234, 2048)]),
+            FakeDevice(processes=[(1235, 512)]),
+        ]
+    )
+    gpu_status, processes = NVMLCollector(nvml).collect()
+
+    assert [gpu.index for gpu in gpu_status] == [0, 1]
+    assert gpu_status[0].gpu_usage == 0.75
+    assert gpu_status[0].memory_total == 80 * 1024
+    assert gpu_status[0].memory_free == 40 * 1024
+    assert gpu_status[0].memory_usage == 0.5
+    assert gpu_status[0].temperature == 45.0
+    assert [(p.pid, p.gpu_index, p.gpu_mem_used) for p in processes] == [
+        (1234, 0, 2048.0),
+        (1235, 1, 512.0),
+    ]
+    assert processes[1].gpu_uuid == nvml.devices[1].uuid
+
+
+def test_hidden_process_memory_is_reported_as_zero():
+    # NVML hides the memory of other users' processes from unprivileged clients
+    nvml = FakeNVML([FakeDevice(processes=[(1234, None)])])
+    _, processes = NVMLCollector(nvml).collect()
+
+    assert processes[0].gpu_mem_used == 0.0
+    # the server rejects a null gpu_mem_used
+    assert '"gpu_mem_used":0.0' in processes[0].model_dump_json()
+
+
+def test_library_is_initialized_once():
+    nvml = FakeNVML([FakeDevice()])
+    collector = NVMLCollector(nvml)
+    collector.collect()
+    collector.collect()
+    collector.driver_version()
+
+    assert nvml.init_calls == 1
+
+
+def test_driver_version_in_nvidia_smi_words():
+    collector = NVMLCollector(FakeNVML([FakeDevice()], driver_version="535.104.05"))
+
+    assert collector.driver_version() == (
+        "Driver Version: 535.104.05    CUDA Version: 12.2"
+    )
+
+
+def test_unavailable_nvml_returns_none():
+    collector = NVMLCollector(FakeNVML(fail_init=True))
+
+    assert collector.collect() is None
+    assert collector.error == "Driver Not Loaded"
+    assert NVMLCollector(FakeNVML([])).collect() is None
+
+
+def test_error_closes_and_next_collect_retries():
+    nvml = FakeNVML([FakeDevice()])
+    collector = NVMLCollector(nvml)
+    collector.collect()
+    nvml.initialized = False  # e.g. the driver was reloaded
+
+    assert collector.collect() is None
+    assert collector.error == "Uninitialized"
+    assert collector.collect() is not None
+    assert nvml.init_calls == 2
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+from gpu_record import GPURecordBuffer
+
+T0 = datetime(2024, 1, 1)
+
+
+def _fill(buffer: GPURecordBuffer, n: int):
+    """n records, alternating users on 3 machines, one minute apart"""
+    for i in range(n):
+        buffer.append(f"user{i % 2}", T0 + timedelta(minutes=i), f"m{i % 3}")
+
+
+def _times(records):
+    return [(record["time"] - T0) // timedelta(minutes=1) for record in records]
+
+
+def test_ring_wrap_keeps_the_newest():
+    buffer = GPURecordBuffer(5)
+    _fill(buffer, 12)
+    records, cursor = buffer.query()
+    assert len(buffer) == 5
+    assert cursor is None
+    assert _times(records) == [7, 8, 9, 10, 11]
+    assert records[0] == dict(
+        user="user1", time=T0 + timedelta(minutes=7), machine_id="m1"
+    )
+
+
+def test_query_by_user_and_machine_after_wrap():
+    buffer = GPURecordBuffer(7)
+    _fill(buffer, 20)  # records 13 .. 19 are left
+    assert _times(buffer.query(user="user0")[0]) == [14, 16, 18]
+    assert _times(buffer.query(machine_id="m1")[0]) == [13, 16, 19]
+    assert _times(buffer.query(machine_id="m1", user="user1")[0]) == [13, 19]
+    assert buffer.query(user="nobody") == ([], None)
+
+
+def test_query_time_range_and_fields():
+    buffer = GPURecordBuffer(100)
+    _fill(buffer, 10)
+    records, _ = buffer.query(
+        since=T0 + timedelta(minutes=3),
+        until=T0 + timedelta(minutes=5),
+        fields=("machine_id",),
+    )
+    assert records == [
+        dict(machine_id="m0"),
+        dict(machine_id="m1"),
+        dict(machine_id="m2"),
+    ]
+
+
+def test_pagination_across_wrap():
+    buffer = GPURecordBuffer(8)
+    _fill(buffer, 30)
+    pages, cursor = [], None
+    while True:
+        records, cursor = buffer.query(user="user1", cursor=cursor, limit=2)
+        pages.append(_times(records))
+        if cursor is None:
+            break
+    assert pages == [[23, 25], [27, 29]]
+
+
+def test_evict_before():
+    buffer = GPURecordBuffer(10)
+    _fill(buffer, 10)
+    assert buffer.evict_before(T0 + timedelta(minutes=4)) == 4
+    assert _times(buffer.query()[0]) == [4, 5, 6, 7, 8, 9]
+    assert _times(buffer.query(machine_id="m0")[0]) == [6, 9]
+
+
+def test_extend_codes_round_trip():
+    buffer = GPURecordBuffer(6)
+    _fill(buffer, 9)
+    loaded = GPURecordBuffer(4)
+    loaded.append("other", T0 - timedelta(minutes=1), "m9")
+    loaded.extend_codes(**buffer.to_codes())
+    assert loaded.query() == (buffer.query()[0][-4:], None)
+    assert _times(loaded.query(user="user0")[0]) == [6, 8]
+
+
+def test_extend_wraps_like_append():
+    appended, extended = GPURecordBuffer(5), GPURecordBuffer(5)
+    _fill(appended, 8)
+    _fill(extended, 2)
+    extended.extend(
+        [f"user{i % 2}" for i in range(2, 8)],
+        [T0 + timedelta(minutes=i) for i in range(2, 8)],
+        [f"m{i % 3}" for i in range(2, 8)],
+    )
+    assert extended.query() == appended.query()
+    assert extended.query(machine_id="m2") == appended.query(machine_id="m2")
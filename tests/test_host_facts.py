@@ -0,0 +1,69 @@
+import time
+
+from host_facts import HostFacts
+
+
+def _facts(path, fingerprint: dict, ttl: float = 3600) -> HostFacts:
+    return HostFacts(path, ttl=ttl, fingerprint=lambda: dict(fingerprint))
+
+
+def _discover(calls: list, value="Ubuntu 22.04"):
+    def discover():
+        calls.append(value)
+        return value
+
+    return discover
+
+
+def test_facts_are_kept_until_the_host_changes(tmp_path):
+    path = tmp_path / "host_facts.json"
+    fingerprint = dict(kernel="6.1", cuda="/usr/local/cuda-12.2@1")
+    calls = []
+    facts = _facts(path, fingerprint)
+    assert facts.check()  # nothing discovered yet
+    assert facts.get("distro", _discover(calls)) == "Ubuntu 22.04"
+    assert not facts.check()
+    assert facts.get("distro", _discover(calls)) == "Ubuntu 22.04"
+    assert len(calls) == 1
+
+    # a restart reuses the facts of the file
+    facts = _facts(path, fingerprint)
+    assert not facts.check()
+    assert facts.get("distro", _discover(calls)) == "Ubuntu 22.04"
+    assert len(calls) == 1
+
+    fingerprint["cuda"] = "/usr/local/cuda-12.4@2"
+    assert facts.check()
+    assert facts.get("distro", _discover(calls)) == "Ubuntu 22.04"
+    assert len(calls) == 2
+
+
+def test_facts_expire_after_the_ttl(tmp_path, monkeypatch):
+    facts = _facts(tmp_path / "host_facts.json", dict(kernel="6.1"), ttl=60)
+    facts.check()
+    facts.get("distro", lambda: "Ubuntu 22.04")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert not facts.check()
+    monkeypatch.setattr(time, "time", lambda: now + 90)
+    assert facts.check()
+    assert facts.facts == {}
+
+
+def test_failed_lookups_are_not_kept(tmp_path):
+    facts = _facts(tmp_path / "host_facts.json", dict(kernel="6.1"))
+    facts.check()
+    calls = []
+    assert facts.get("public_ip", _discover(calls, value=None)) is None
+    assert facts.get("public_ip", _discover(calls, value="1.2.3.4")) == "1.2.3.4"
+    assert facts.get("public_ip", _discover(calls, value="5.6.7.8")) == "1.2.3.4"
+    assert calls == [None, "1.2.3.4"]
+
+
+def test_broken_file_is_ignored(tmp_path):
+    path = tmp_path / "host_facts.json"
+    path.write_text("{not json")
+    facts = _facts(path, dict(kernel="6.1"))
+    assert facts.check()
+    facts.get("distro", lambda: "Ubuntu 22.04")
+    assert _facts(path, dict(kernel="6.1")).facts == dict(distro="Ubuntu 22.04")
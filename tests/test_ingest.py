@@ -0,0 +1,80 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from data_model import MachineStatus
+from ingest import IngestQueue
+
+T0 = datetime(2024, 3, 1, 12)
+
+
+class _Database:
+    """Stands in for `Database`: the first status of every batch is not newer"""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.running = threading.Event()
+        self.running.set()
+
+    def add_many(self, statuses):
+        self.running.wait()
+        time.sleep(self.delay)
+        if any(status.machine_id == "broken" for status in statuses):
+            raise ValueError("broken status")
+        return len(statuses) - 1
+
+
+def _statuses(n: int, machine_id: str = "m0"):
+    return [
+        MachineStatus(machine_id=machine_id, created_at=T0 + timedelta(minutes=i))
+        for i in range(n)
+    ]
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_submit_many_is_all_or_nothing():
+    ingest_queue = IngestQueue(_Database(), maxsize=3, batch_size=2)  # not started
+    assert ingest_queue.submit_many(_statuses(2))
+    assert not ingest_queue.submit_many(_statuses(2))
+    assert len(ingest_queue) == 2
+    assert ingest_queue.submit_many(_statuses(1))
+    assert ingest_queue.stats["accepted"] == 3
+    assert ingest_queue.stats["rejected"] == 2
+    assert ingest_queue.retry_after() == 1  # nothing drained yet
+
+
+def test_worker_counts_applied_skipped_and_failed():
+    ingest_queue = IngestQueue(_Database(), maxsize=100, batch_size=4)
+    ingest_queue.start()
+    stats = ingest_queue.stats
+    for status in _statuses(10):
+        ingest_queue.submit_many([status])
+    _wait_for(lambda: stats["applied"] + stats["skipped"] == 10)
+    assert stats["skipped"] == stats["batches"]
+
+    # a failed batch is counted, the worker goes on
+    ingest_queue.submit_many(_statuses(1, machine_id="broken"))
+    _wait_for(lambda: stats["failed"] == 1)
+    ingest_queue.submit_many(_statuses(2))
+    _wait_for(lambda: stats["applied"] + stats["skipped"] == 12)
+
+
+def test_retry_after_follows_the_drain_rate():
+    db = _Database(delay=0.05)  # at most 20 statuses per second
+    ingest_queue = IngestQueue(db, maxsize=100, batch_size=1)
+    ingest_queue.start()
+    ingest_queue.submit_many(_statuses(1))
+    _wait_for(lambda: ingest_queue.stats["batches"] == 1)
+
+    db.running.clear()
+    ingest_queue.submit_many(_statuses(1))
+    _wait_for(lambda: len(ingest_queue) == 0)  # the worker waits in add_many
+    ingest_queue.submit_many(_statuses(40))
+    assert ingest_queue.retry_after() >= 2
+    db.running.set()
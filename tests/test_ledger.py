@@ -0,0 +1,90 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from data_model import GPUComputeProcess, MachineStatus
+from ledger import GPUHourLedger
+
+T0 = datetime(2024, 3, 1, 12)
+
+
+def _status(minutes: float, *processes, machine_id: str = "m0") -> MachineStatus:
+    # users as the server stores them, already masked by validation
+    return MachineStatus(
+        machine_id=machine_id,
+        created_at=T0 + timedelta(minutes=minutes),
+        gpu_compute_processes=[
+            GPUComputeProcess.from_trusted(dict(user=user, gpu_index=gpu_index))
+            for user, gpu_index in processes
+        ],
+    )
+
+
+def _hours(ledger: GPUHourLedger, **query) -> dict:
+    return {
+        (row["user"], row["day"], row["gpu_index"]): row["hours"]
+        for row in ledger.rows(**query)
+    }
+
+
+def test_charges_the_time_since_the_previous_report():
+    ledger = GPUHourLedger(max_gap=3600, retention_days=365)
+    ledger.add(_status(0, ("alice", 0)))  # first report, nothing to charge yet
+    ledger.add(_status(30, ("alice", 0), ("alice", 0), ("bob", 1)))
+    ledger.add(_status(90, ("bob", 1)))
+    assert _hours(ledger) == {
+        ("alice", "2024-03-01", 0): pytest.approx(0.5),
+        ("bob", "2024-03-01", 1): pytest.approx(1.5),
+    }
+
+
+def test_caps_gaps_and_ignores_old_reports():
+    ledger = GPUHourLedger(max_gap=600, retention_days=365)
+    ledger.add(_status(0, ("alice", 0)))
+    ledger.add(_status(120, ("alice", 0)))  # offline for two hours
+    ledger.add(_status(60, ("alice", 0)))  # older than the previous report
+    assert _hours(ledger) == {("alice", "2024-03-01", 0): pytest.approx(10 / 60)}
+
+
+def test_splits_intervals_at_midnight():
+    ledger = GPUHourLedger(max_gap=7200, retention_days=365)
+    ledger.add(_status(11 * 60 + 30, ("alice", 0)))  # 23:30
+    ledger.add(_status(12 * 60 + 30, ("alice", 0)))  # 00:30 the next day
+    assert _hours(ledger) == {
+        ("alice", "2024-03-01", 0): pytest.approx(0.5),
+        ("alice", "2024-03-02", 0): pytest.approx(0.5),
+    }
+    assert _hours(ledger, since=date(2024, 3, 2)) == {
+        ("alice", "2024-03-02", 0): pytest.approx(0.5)
+    }
+
+
+def test_machines_are_separate_and_retention():
+    ledger = GPUHourLedger(max_gap=3600, retention_days=2)
+    for machine_id in ("m0", "m1"):
+        ledger.add(_status(0, ("alice", 0), machine_id=machine_id))
+        ledger.add(_status(60, ("alice", 0), machine_id=machine_id))
+    assert _hours(ledger, machine_id="m1") == {
+        ("alice", "2024-03-01", 0): pytest.approx(1)
+    }
+
+    later = 3 * 24 * 60
+    ledger.add(_status(later, ("alice", 0)))
+    ledger.add(_status(later + 60, ("alice", 0)))
+    # the reports of the first day are pruned, the gap before `later` is capped
+    assert _hours(ledger, machine_id="m0") == {
+        ("alice", "2024-03-04", 0): pytest.approx(2)
+    }
+    assert _hours(ledger, machine_id="m1") == {}
+
+
+def test_to_dict_round_trip():
+    ledger = GPUHourLedger(max_gap=3600, retention_days=365)
+    ledger.add(_status(0, ("alice", 0)))
+    ledger.add(_status(30, ("alice", 0)))
+
+    loaded = GPUHourLedger(max_gap=3600, retention_days=365)
+    loaded.load(ledger.to_dict())
+    assert loaded.rows() == ledger.rows()
+    # the last report is restored too, so the next report is charged
+    loaded.add(_status(60, ("alice", 0)))
+    assert _hours(loaded) == {("alice", "2024-03-01", 0): pytest.approx(1)}
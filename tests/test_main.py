@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+T0 = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+
+
+@pytest.fixture
+def client(server_main):
+    with TestClient(server_main.app) as client:
+        yield client
+
+
+def _report(server_main, machine_id: str, minutes: int, **fields) -> dict:
+    return dict(
+        machine_id=machine_id,
+        report_key=server_main.configs["report_key"],
+        created_at=(T0 + timedelta(minutes=minutes)).isoformat(),
+        **fields,
+    )
+
+
+def test_profile_and_sample(server_main, client):
+    profile = dict(
+        machine_id="profiled",
+        report_key=server_main.configs["report_key"],
+        hostname="gpu-01",
+        cpu_cores=64,
+    )
+    response = client.post("/profile", json=profile)
+    assert response.status_code == 201
+    profile_hash = response.json()["profile_hash"]
+
+    sample = _report(server_main, "profiled", 0, profile_hash=profile_hash)
+    response = client.post("/sample", json=dict(sample, cpu_usage=0.25))
+    assert response.status_code == 201
+    assert response.json()["accepted"] == 1
+    status = server_main.db.get_status_history("profiled")[-1]
+    assert (status.hostname, status.cpu_cores, status.cpu_usage) == ("gpu-01", 64, 0.25)
+
+    # the profile changed since the client registered it
+    assert client.post("/profile", json=dict(profile, cpu_cores=32)).status_code == 201
+    response = client.post("/sample", json=sample)
+    assert response.status_code == 409
+    unknown = _report(server_main, "unprofiled", 0, profile_hash=profile_hash)
+    assert client.post("/sample", json=unknown).status_code == 409
+    assert client.post("/sample", json=dict(sample, report_key="")).status_code == 400
+
+
+def test_ingest_queue_backpressure(server_main, client, monkeypatch):
+    from ingest import IngestQueue
+
+    # not started, so nothing is drained
+    ingest_queue = IngestQueue(server_main.db, maxsize=3, batch_size=2)
+    monkeypatch.setattr(server_main, "ingest_queue", ingest_queue)
+    reports = [_report(server_main, "queued", minutes) for minutes in range(4)]
+
+    response = client.post("/report/batch", json=reports)
+    assert response.status_code == 413
+    response = client.post("/report/batch", json=reports[:2])
+    assert response.status_code == 202
+    assert response.json()["queued"] == 2
+    # a batch is queued entirely or not at all
+    response = client.post("/report/batch", json=reports[2:])
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert len(ingest_queue) == 2
+
+    assert client.post("/report", json=reports[2]).status_code == 202
+    response = client.post("/report", json=reports[3])
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert ingest_queue.stats["accepted"] == 3
+    assert ingest_queue.stats["rejected"] == 3
+    assert "queued" not in server_main.db.STATUS_DATA
+
+
+def test_report_latency(server_main, client):
+    from metrics import REPORT_LATENCY
+
+    sample = _report(server_main, "unregistered", 0, profile_hash="0" * 16)
+    assert client.post("/sample", json=sample).status_code == 409
+    assert client.get("/").status_code == 200
+    lines = REPORT_LATENCY.collect()
+    count = 'server_report_request_seconds_count{path="/sample",status="409"}'
+    assert any(line.startswith(count) for line in lines)
+    # only report requests are measured
+    assert not any('path="/"' in line for line in lines)
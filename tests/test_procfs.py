@@ -0,0 +1,119 @@
+import pytest
+from procfs import UTMP_STRUCT, UTMP_USER_PROCESS, ProcFS
+
+BOOT_TIME = 2
+DEAD_PROCESS = 8
+
+
+def _utmp_record(ut_type: int, user: str, line: str = "pts/0") -> bytes:
+    return UTMP_STRUCT.pack(
+        ut_type,
+        1000,  # pid
+        line.encode(),
+        line[-4:].encode(),
+        user.encode(),
+        b"10.0.0.1",
+        0,  # exit status
+        0,
+        0,  # session
+        1700000000,  # tv_sec
+        0,
+        0,  # addr_v6
+        0,
+        0,
+        0,
+        b"",
+    )
+
+
+@pytest.fixture
+def root(tmp_path):
+    """A /proc, /etc and /run tree of a 2-core Ubuntu host with 3 sessions"""
+    (tmp_path / "proc").mkdir()
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "run").mkdir()
+    (tmp_path / "proc" / "uptime").write_text("12345.67 98765.43\n")
+    (tmp_path / "proc" / "cpuinfo").write_text(
+        "processor\t: 0\n"
+        "vendor_id\t: AuthenticAMD\n"
+        "model name\t: AMD EPYC 7742 64-Core Processor\n"
+        "\n"
+        "processor\t: 1\n"
+        "vendor_id\t: AuthenticAMD\n"
+        "model name\t: AMD EPYC 7742 64-Core Processor\n"
+    )
+    (tmp_path / "etc" / "os-release").write_text(
+        'NAME="Ubuntu"\n'
+        'VERSION="22.04.4 LTS (Jammy Jellyfish)"\n'
+        'PRETTY_NAME="Ubuntu 22.04.4 LTS"\n'
+        "ID=ubuntu\n"
+    )
+    (tmp_path / "run" / "utmp").write_bytes(
+        _utmp_record(BOOT_TIME, "reboot", "~")
+        + _utmp_record(UTMP_USER_PROCESS, "alice", "pts/0")
+        + _utmp_record(UTMP_USER_PROCESS, "bob", "pts/1")
+        + _utmp_record(UTMP_USER_PROCESS, "alice", "pts/2")
+        + _utmp_record(DEAD_PROCESS, "carol", "pts/3")
+    )
+    return tmp_path
+
+
+def test_utmp_record_size():
+    # sizeof(struct utmp) of glibc on Linux
+    assert UTMP_STRUCT.size == 384
+
+
+def test_uptime(root):
+    procfs = ProcFS(root)
+    assert procfs.uptime() == 12345.67
+    procfs.close()
+
+
+def test_uptime_reuses_the_descriptor(root):
+    procfs = ProcFS(root)
+    procfs.uptime()
+    fd = procfs._fds["/proc/uptime"]
+    (root / "proc" / "uptime").write_text("12400.00 98765.43\n")
+
+    assert procfs.uptime() == 12400.0
+    assert procfs._fds["/proc/uptime"] == fd
+    procfs.close()
+    assert procfs._fds == {}
+
+
+def test_cpu_info(root):
+    assert ProcFS(root).cpu_info() == dict(
+        model="AMD EPYC 7742 64-Core Processor", cores=2
+    )
+
+
+def test_distro(root):
+    assert ProcFS(root).distro() == "Ubuntu 22.04.4 LTS"
+
+
+def test_distro_falls_back_to_usr_lib(root):
+    (root / "etc" / "os-release").unlink()
+    (root / "usr" / "lib").mkdir(parents=True)
+    (root / "usr" / "lib" / "os-release").write_text("PRETTY_NAME='Debian 12'\n")
+
+    assert ProcFS(root).distro() == "Debian 12"
+
+
+def test_online_users_like_users_command(root):
+    # user processes only, sorted, with one entry per session
+    assert ProcFS(root).online_users() == ["alice", "alice", "bob"]
+
+
+def test_online_users_ignores_a_truncated_record(root):
+    utmp = root / "run" / "utmp"
+    utmp.write_bytes(utmp.read_bytes() + _utmp_record(UTMP_USER_PROCESS, "dave")[:100])
+
+    assert ProcFS(root).online_users() == ["alice", "alice", "bob"]
+
+
+def test_missing_files(tmp_path):
+    procfs = ProcFS(tmp_path)
+    assert procfs.uptime() is None
+    assert procfs.cpu_info() is None
+    assert procfs.distro() is None
+    assert procfs.online_users() is None
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from data_model import GPUStatus, MachineStatus
+from gpu_record import GPURecordBuffer
+from snapshot import MAGIC, read_snapshot, write_snapshot
+from timeseries import TimeSeriesStore
+
+T0 = datetime(2024, 3, 1, 12)
+
+
+def _status(machine_id: str, minutes: int) -> MachineStatus:
+    return MachineStatus(
+        machine_id=machine_id,
+        created_at=T0 + timedelta(minutes=minutes),
+        cpu_usage=minutes / 100,
+        gpu_status=[GPUStatus(index=0, gpu_usage=0.5)],
+    )
+
+
+def _write(filename, status_data: dict) -> dict:
+    """Write a snapshot of `status_data`, return the GPU records and timeseries"""
+    buffer = GPURecordBuffer(100)
+    timeseries = TimeSeriesStore(report_interval=60)
+    statuses = [
+        status for status_list in status_data.values() for status in status_list
+    ]
+    for status in sorted(statuses, key=lambda status: status.created_at):
+        buffer.append("alice", status.created_at, status.machine_id)
+        timeseries.add(status)
+    states = {machine_id: timeseries.state(machine_id) for machine_id in status_data}
+    codes = buffer.to_codes()
+    write_snapshot(str(filename), status_data, codes, dict(answer=42), states)
+    return dict(gpu_record=codes, timeseries=states)
+
+
+def test_round_trip(tmp_path):
+    filename = tmp_path / "snapshot.bin"
+    status_data = dict(m0=[_status("m0", 0), _status("m0", 1)], m1=[_status("m1", 2)])
+    written = _write(filename, status_data)
+
+    snapshot = read_snapshot(str(filename))
+    assert snapshot["state"] == dict(answer=42)
+    for key in ("time", "user", "machine"):
+        np.testing.assert_array_equal(
+            snapshot["gpu_record"][key], written["gpu_record"][key]
+        )
+    assert snapshot["gpu_record"]["users"] == written["gpu_record"]["users"]
+    assert snapshot["timeseries"].keys() == written["timeseries"].keys()
+    loaded = TimeSeriesStore(report_interval=60)
+    loaded.load(snapshot["timeseries"])
+    assert loaded.query("m0", "cpu_usage", step=0)["mean"] == pytest.approx([0, 0.01])
+
+    # histories stay encoded until they are read, and are written as they are
+    status = snapshot["status"]
+    assert all(isinstance(value, bytes) for value in dict.values(status))
+    assert status["m1"] == status_data["m1"]
+    copy = status.copy()
+    assert isinstance(copy["m0"], bytes) and isinstance(copy["m1"], list)
+    write_snapshot(str(filename), copy, written["gpu_record"], {})
+    status = read_snapshot(str(filename))["status"]
+    assert dict(status.items()) == status_data
+    assert status["m2"] == []
+
+
+def test_truncated_files_are_rejected(tmp_path):
+    filename = tmp_path / "snapshot.bin"
+    _write(filename, dict(m0=[_status("m0", 0)], m1=[_status("m1", 1)]))
+    data = filename.read_bytes()
+    truncated = tmp_path / "truncated.bin"
+    for size in range(len(data)):
+        truncated.write_bytes(data[:size])
+        with pytest.raises(ValueError):
+            read_snapshot(str(truncated))
+    truncated.write_bytes(data + b"\0")
+    with pytest.raises(ValueError, match="Unexpected data"):
+        read_snapshot(str(truncated))
+
+
+def test_corrupt_files_are_rejected(tmp_path):
+    filename = tmp_path / "snapshot.bin"
+    _write(filename, dict(m0=[_status("m0", 0)]))
+    data = filename.read_bytes()
+    corrupt = tmp_path / "corrupt.bin"
+
+    corrupt.write_bytes(b"NOSNAP" + data[len(MAGIC) :])
+    with pytest.raises(ValueError, match="not a snapshot"):
+        read_snapshot(str(corrupt))
+    corrupt.write_bytes(MAGIC + b"\xff\xff" + data[len(MAGIC) + 2 :])
+    with pytest.raises(ValueError, match="Unsupported snapshot version"):
+        read_snapshot(str(corrupt))
+    state = b'{"answer": 42}'
+    corrupt.write_bytes(data.replace(state, b'{"answer": 4]'))
+    with pytest.raises(ValueError, match="Corrupt state section"):
+        read_snapshot(str(corrupt))
+    corrupt.write_bytes(data.replace(b'"__array__"', b'"__arrays__"', 1))
+    with pytest.raises(ValueError, match="Corrupt timeseries section"):
+        read_snapshot(str(corrupt))
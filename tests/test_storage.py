@@ -0,0 +1,134 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from data_model import GPUComputeProcess, MachineStatus
+from gpu_record import GPURecordBuffer
+from storage import JSONStorage, SQLiteStorage
+
+CONFIGS = dict(history_days=30, wal_fsync_batch=1)
+T0 = datetime.now().replace(microsecond=0) - timedelta(hours=1)
+
+
+def _status(machine_id: str, minutes: int, user: str = "alice") -> MachineStatus:
+    return MachineStatus(
+        machine_id=machine_id,
+        created_at=T0 + timedelta(minutes=minutes),
+        cpu_usage=minutes / 100,
+        gpu_compute_processes=[GPUComputeProcess(user=user, gpu_index=0)],
+    )
+
+
+def _append(storage, statuses):
+    storage.append_many(statuses, [status.model_dump_json() for status in statuses])
+
+
+def _snapshot(storage, status_data: dict, state: dict, timeseries=None) -> int:
+    buffer = GPURecordBuffer(100)
+    statuses = [
+        status for status_list in status_data.values() for status in status_list
+    ]
+    for status in sorted(statuses, key=lambda status: status.created_at):
+        buffer.append("alice", status.created_at, status.machine_id)
+    return storage.write_snapshot(
+        storage.rotate(), status_data, buffer.to_codes(), state, timeseries or {}
+    )
+
+
+def _json_storage(tmp_path) -> JSONStorage:
+    return JSONStorage(
+        snapshot_filename=str(tmp_path / "snapshot.bin"),
+        record_filename=str(tmp_path / "machine_status.json"),
+        gpu_record_filename=str(tmp_path / "gpu_status.json"),
+        wal_dirname=str(tmp_path / "wal"),
+        configs=CONFIGS,
+    )
+
+
+def _sqlite_storage(tmp_path) -> SQLiteStorage:
+    return SQLiteStorage(str(tmp_path / "status.sqlite3"), CONFIGS)
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def open_storage(request, tmp_path):
+    """Opens the storage of `tmp_path`, again for every call (a restart)"""
+    opened = []
+
+    def open_storage():
+        if opened:
+            opened[-1].close()
+        factory = _json_storage if request.param == "json" else _sqlite_storage
+        opened.append(factory(tmp_path))
+        return opened[-1]
+
+    yield open_storage
+    opened[-1].close()
+
+
+def test_round_trip(open_storage):
+    storage = open_storage()
+    snapshotted = [_status("m0", 0), _status("m1", 1), _status("m0", 2)]
+    _append(storage, snapshotted)
+    status_data = dict(m0=[snapshotted[0], snapshotted[2]], m1=[snapshotted[1]])
+    assert _snapshot(storage, status_data, dict(answer=42)) > 0
+    later = [_status("m1", 3, user="bob")]
+    _append(storage, later)
+
+    storage = open_storage()
+    loaded = storage.load_status_data(10)
+    assert sorted(loaded.keys()) == ["m0", "m1"]
+    assert loaded["m0"] == status_data["m0"]
+    assert loaded["m1"] == status_data["m1"]
+    assert storage.load_state() == dict(answer=42)
+    buffer = GPURecordBuffer(100)
+    storage.load_gpu_record(buffer)
+    records, _ = buffer.query(fields=("time", "machine_id"))
+    assert records == [
+        dict(time=status.created_at, machine_id=status.machine_id)
+        for status in snapshotted
+    ]
+    replayed = [MachineStatus.from_trusted(json.loads(r)) for r in storage.replay()]
+    assert [s.created_at for s in replayed] == [later[0].created_at]
+
+
+def test_replay_without_snapshot(open_storage):
+    storage = open_storage()
+    statuses = [_status("m0", minutes) for minutes in range(3)]
+    _append(storage, statuses)
+
+    storage = open_storage()
+    assert dict(storage.load_status_data(10)) == {}
+    assert list(storage.replay()) == [s.model_dump_json() for s in statuses]
+
+
+def test_sqlite_watermark_is_a_row_id(tmp_path):
+    storage = _sqlite_storage(tmp_path)
+    _append(storage, [_status("m0", 10)])
+    _snapshot(storage, dict(m0=[_status("m0", 10)]), {})
+    # appended after the snapshot, but created before the statuses it covers
+    late = _status("m1", 5)
+    _append(storage, [late])
+    storage.close()
+
+    storage = _sqlite_storage(tmp_path)
+    assert list(storage.load_status_data(10).keys()) == ["m0"]
+    assert list(storage.replay()) == [late.model_dump_json()]
+    storage.close()
+
+
+def test_sqlite_query_status(tmp_path):
+    storage = _sqlite_storage(tmp_path)
+    _append(storage, [_status(f"m{minutes % 2}", minutes) for minutes in range(6)])
+    history = storage.query_status(
+        "m0", since=T0 + timedelta(minutes=1), until=T0 + timedelta(minutes=4)
+    )
+    assert [status.cpu_usage for status in history] == [0.02, 0.04]
+    records, cursor = storage.query_gpu_record(machine_id="m1", limit=2)
+    assert [record["time"] for record in records] == [
+        T0 + timedelta(minutes=1),
+        T0 + timedelta(minutes=3),
+    ]
+    records, cursor = storage.query_gpu_record(machine_id="m1", cursor=cursor)
+    assert [record["time"] for record in records] == [T0 + timedelta(minutes=5)]
+    assert cursor is None
+    storage.close()
@@ -0,0 +1,115 @@
+import math
+from datetime import datetime
+
+import numpy as np
+import pytest
+from data_model import GPUStatus, MachineStatus
+from snapshot import pack_arrays, unpack_arrays
+from timeseries import RawArchive, RollupArchive, TimeSeriesStore
+
+T0 = 1_700_000_000 // 3600 * 3600  # on the hour
+
+
+def _status(seconds: float, cpu_usage: float, gpus=()) -> MachineStatus:
+    return MachineStatus(
+        machine_id="m0",
+        created_at=datetime.fromtimestamp(T0 + seconds),
+        cpu_usage=cpu_usage,
+        gpu_status=[GPUStatus(index=i, gpu_usage=usage) for i, usage in gpus],
+    )
+
+
+def test_rollup_min_mean_max():
+    store = TimeSeriesStore(report_interval=60, rollups=[(300, 1)])
+    for minute, usage in enumerate([0.1, 0.3, 0.2, 0.6, 0.8, 0.5, 0.4]):
+        store.add(_status(60 * minute, usage))
+    result = store.query("m0", "cpu_usage", step=300)
+    assert result["step"] == 300
+    assert result["time"].tolist() == [T0, T0 + 300]
+    # the bucket in progress is consolidated on the fly, rows are float16
+    assert result["min"] == pytest.approx([0.1, 0.4], abs=1e-3)
+    assert result["mean"] == pytest.approx([0.4, 0.45], abs=1e-3)
+    assert result["max"] == pytest.approx([0.8, 0.5], abs=1e-3)
+
+
+def test_raw_query_and_step_choice():
+    store = TimeSeriesStore(report_interval=60, raw_days=1, rollups=[(3600, 30)])
+    for minute in range(5):
+        store.add(_status(60 * minute, minute / 10))
+    recent = store.query("m0", "cpu_usage", since=T0 + 90)
+    assert recent["step"] == 0
+    assert recent["mean"] == pytest.approx([0.2, 0.3, 0.4])
+    assert store.query("m0", "cpu_usage", since=T0 - 7 * 86400)["step"] == 3600
+    with pytest.raises(ValueError, match="Unknown step"):
+        store.query("m0", "cpu_usage", step=60)
+    assert store.query("m0", "gpu_usage", 0) is None  # no GPU ever reported
+    assert store.query("m1", "cpu_usage") is None
+
+
+def test_empty_buckets_are_skipped():
+    archive = RollupArchive(step=10, rows=100, n_columns=1)
+    archive.update(T0, np.array([1.0]))
+    archive.update(T0 + 35, np.array([3.0]))
+    result = archive.query(0, -math.inf, math.inf)
+    assert result["time"].tolist() == [T0, T0 + 30]
+    assert result["mean"].tolist() == [1.0, 3.0]
+
+
+def test_rollup_grows_and_wraps():
+    archive = RollupArchive(step=1, rows=100, n_columns=1)
+    assert archive.capacity == 16
+    for second in range(40):
+        archive.update(T0 + second, np.array([float(second)]))
+    assert archive.capacity == 64
+    assert archive.query(0, -math.inf, math.inf)["mean"].tolist() == list(range(40))
+
+    for second in range(40, 250):
+        archive.update(T0 + second, np.array([float(second)]))
+    assert archive.capacity == 100
+    # only the last `rows` buckets are kept
+    assert archive.query(0, -math.inf, math.inf)["mean"].tolist() == list(
+        range(150, 250)
+    )
+
+
+def test_raw_archive_grows_and_expires():
+    archive = RawArchive(seconds=1000, max_capacity=200, n_columns=1)
+    assert archive.capacity == 64
+    for second in range(0, 1500, 10):
+        archive.append(T0 + second, np.array([float(second)]))
+    assert archive.capacity == 128
+    # older than `seconds` before the latest value
+    result = archive.query(0, -math.inf, math.inf)
+    assert result["time"][0] == T0 + 490
+    assert len(archive) == 101
+
+
+def test_new_gpu_adds_a_column():
+    store = TimeSeriesStore(report_interval=60)
+    store.add(_status(0, 0.1, gpus=[(0, 0.5)]))
+    store.add(_status(60, 0.2, gpus=[(0, 0.6), (1, 0.9)]))
+    assert store.query("m0", "gpu_usage", 0, step=0)["mean"] == pytest.approx(
+        [0.5, 0.6]
+    )
+    assert store.query("m0", "gpu_usage", 1, step=0)["mean"] == pytest.approx([0.9])
+
+
+def test_state_round_trip():
+    store = TimeSeriesStore(report_interval=60, rollups=[(300, 1), (3600, 2)])
+    for minute in range(200):
+        store.add(_status(60 * minute, (minute % 7) / 10, gpus=[(0, minute / 200)]))
+    state = store.state("m0")
+    # a copy: later reports do not change it
+    store.add(_status(60 * 200, 0.9))
+    loaded = TimeSeriesStore(report_interval=60, rollups=[(300, 1), (3600, 2)])
+    loaded.load(dict(m0=unpack_arrays(pack_arrays(state))))
+    # replayed statuses the state already holds are ignored
+    loaded.add(_status(60 * 199, 0.0))
+    loaded.add(_status(60 * 200, 0.9))
+
+    for metric, gpu_index in [("cpu_usage", -1), ("gpu_usage", 0)]:
+        for step in (0, 300, 3600):
+            expected = store.query("m0", metric, gpu_index, step=step)
+            result = loaded.query("m0", metric, gpu_index, step=step)
+            for key in ("time", "min", "mean", "max"):
+                np.testing.assert_array_equal(result[key], expected[key])
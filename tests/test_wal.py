@@ -0,0 +1,75 @@
+import time
+
+from wal import WriteAheadLog
+
+
+def test_replay_across_reopen(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"a":1}')
+    wal.append_many(['{"b":2}', '{"c":3}'])
+    wal.close()
+
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"d":4}')
+    assert list(wal.replay()) == ['{"a":1}', '{"b":2}', '{"c":3}', '{"d":4}']
+    wal.close()
+
+
+def test_checkpoint_drops_older_segments(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"a":1}')
+    sequence = wal.rotate()
+    wal.append('{"b":2}')
+    wal.checkpoint(sequence)
+    assert wal.segments() == [sequence]
+    assert list(wal.replay()) == ['{"b":2}']
+    wal.close()
+
+    # the checkpoint survives a restart
+    wal = WriteAheadLog(tmp_path)
+    assert wal.sequence == sequence
+    assert list(wal.replay()) == ['{"b":2}']
+    wal.close()
+
+
+def test_checkpoint_of_an_empty_segment(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"a":1}')
+    wal.checkpoint(wal.rotate())
+    wal.close()
+
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"b":2}')
+    assert list(wal.replay()) == ['{"b":2}']
+    wal.close()
+
+
+def test_torn_record_is_cut_on_open(tmp_path):
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"a":1}')
+    wal.close()
+    # a crash in the middle of a write
+    with (tmp_path / "0000000000.wal").open(mode="ab") as f:
+        f.write(b'{"b":{"c')
+
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"d":4}')
+    assert list(wal.replay()) == ['{"a":1}', '{"d":4}']
+    wal.close()
+
+
+def test_torn_only_record(tmp_path):
+    (tmp_path / "0000000000.wal").write_bytes(b'{"a":')
+    wal = WriteAheadLog(tmp_path)
+    wal.append('{"b":2}')
+    assert list(wal.replay()) == ['{"b":2}']
+    wal.close()
+
+
+def test_sync_after_quiet_period(tmp_path):
+    wal = WriteAheadLog(tmp_path, fsync_interval=0.05, fsync_batch=100)
+    wal.append('{"a":1}')
+    assert wal._unsynced == 1
+    time.sleep(0.3)
+    assert wal._unsynced == 0
+    wal.close()
@@ -1,11 +1,12 @@
 import json
 import sys
+import threading
+import time
 import warnings
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List
 
-import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
@@ -30,20 +31,89 @@ ADMIN_PASSWORD = configs.get("admin_password", "")
 VIEW_KEY = configs.get("view_key", "")
 
 
-def moving_average(data, window_size=5):
-    for _ in range(2):
-        data = np.convolve(data, np.ones(window_size) / window_size, mode="same")
-    return data
+# points per utilization chart, downsampled by the server
+CHART_POINTS = 300
+
+
+class StatusFeed(threading.Thread):
+    """
+    Follows the server's /stream (server-sent events) and keeps the latest
+    status of every machine in memory, shared by all sessions of the web app,
+    so page runs do not fetch /server_status again.
+    """
+
+    def __init__(self, url: str):
+        super().__init__(name="status-feed", daemon=True)
+        self.url = url
+        self.connected = False
+        self._statuses = {}  # machine_id -> status as JSON-ready dict
+        self._lock = threading.Lock()
+
+    def statuses(self) -> List[MachineStatus]:
+        with self._lock:
+            items = sorted(self._statuses.items(), reverse=True)
+        # sent by the server, already validated there
+        return [MachineStatus.from_trusted(status) for _, status in items]
+
+    def _handle(self, event: str, data: str):
+        data = json.loads(data)
+        with self._lock:
+            if event == "snapshot":
+                self._statuses = {status["machine_id"]: status for status in data}
+            elif event == "status":
+                status = dict(self._statuses.get(data["machine_id"], {}))
+                status.update(data["changes"])
+                self._statuses[data["machine_id"]] = status
+
+    def run(self):
+        while True:
+            try:
+                params = {"view_key": VIEW_KEY}
+                with requests.get(self.url, params=params, stream=True) as response:
+                    response.raise_for_status()
+                    event = None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event:"):
+                            event = line[len("event:") :].strip()
+                        elif line.startswith("data:"):
+                            self._handle(event, line[len("data:") :])
+                            self.connected = True
+            except Exception as e:
+                print(f"Status stream disconnected: {e}")
+            # polling takes over until the stream is back and resynced
+            self.connected = False
+            time.sleep(REPORT_INTERVAL)
+
+
+@st.cache_resource
+def get_status_feed() -> StatusFeed:
+    feed = StatusFeed(f"http://localhost:{configs['server_port']}/stream")
+    feed.start()
+    return feed
 
 
 def get_server_status() -> List[MachineStatus]:
+    feed = get_status_feed()
+    if feed.connected:
+        return feed.statuses()
     try:
         params = {"view_key": VIEW_KEY}
         url = f"http://localhost:{configs['server_port']}/server_status/"
-        response = requests.get(url, params=params)
+        # reuse the statuses of the previous run when the server reports no change
+        cached = st.session_state.get("server_status_cache")
+        headers = {"If-None-Match": cached["etag"]} if cached else {}
+        response = requests.get(url, params=params, headers=headers)
+        if response.status_code == 304:
+            print("Machine status not modified")
+            return cached["server_status"]
         if response.status_code == 200:
             items = response.json()
-        server_status = [MachineStatus.parse_obj(item) for item in items]
+        # validated and masked by the server already
+        server_status = [MachineStatus.from_trusted(item) for item in items]
+        if "ETag" in response.headers:
+            st.session_state["server_status_cache"] = dict(
+                etag=response.headers["ETag"], server_status=server_status
+            )
         print("Sucessfully loaded machine status")
         return server_status
     except Exception as e:
@@ -51,20 +121,46 @@ def get_server_status() -> List[MachineStatus]:
         return []
 
 
-def get_gpu_record() -> List[dict]:
+def get_gpu_usage() -> List[dict]:
+    """GPU-hours per (machine_id, user, day, gpu_index), accumulated by the server"""
     try:
         params = {"view_key": VIEW_KEY}
-        url = f"http://localhost:{configs['server_port']}/gpu_record/"
+        url = f"http://localhost:{configs['server_port']}/gpu_usage/"
         response = requests.get(url, params=params)
         if response.status_code == 200:
             items = response.json()
-        print("Sucessfully loaded GPU record")
+        print("Sucessfully loaded GPU usage")
         return items
     except Exception as e:
         print(e)
         return []
 
 
+# shared by all sessions and reruns, a chart changes at most once per report
+@st.cache_data(ttl=REPORT_INTERVAL, show_spinner=False)
+def get_utilization_history(
+    machine_id: str, metric: str, gpu_index: int = -1, hours: float = 24
+) -> pd.Series:
+    """One utilization series of a machine, downsampled by the server"""
+    try:
+        params = {
+            "view_key": VIEW_KEY,
+            "machine_id": machine_id,
+            "metric": metric,
+            "gpu_index": gpu_index,
+            "since": (datetime.now() - timedelta(hours=hours)).isoformat(),
+            "points": CHART_POINTS,
+        }
+        url = f"http://localhost:{configs['server_port']}/timeseries/"
+        response = requests.get(url, params=params)
+        if response.status_code == 200:
+            items = response.json()
+            return pd.Series(items["mean"], index=pd.to_datetime(items["time"]))
+    except Exception as e:
+        print(e)
+    return pd.Series(dtype=float)
+
+
 def percent_color_text(per: float, text: str = None) -> str:
     if not text:
         text = f"{(per * 100):.2f}%"
@@ -211,29 +307,32 @@ def show_details(status: MachineStatus):
 
 def show_gpu_history(df):
     if len(df) > 0:
-        df.loc[:, "time"] = pd.to_datetime(df.loc[:, "time"], format="mixed")
-
-        grouper = [pd.Grouper(key="time", freq="D"), "user"]
-        grouped_df = df.groupby(grouper).size().reset_index(name="count")
-
-        table = grouped_df.pivot_table(
-            index="time", columns="user", values="count", fill_value=0
+        # GPU-hours per day and user, summed over the GPUs of the machine
+        table = df.pivot_table(
+            index="day", columns="user", values="hours", aggfunc="sum", fill_value=0
         )
-        table = table.divide(
-            3600 * 24 / configs["report_interval"]
-        )  # one hour * 24 / interval
-        table.index = table.index.strftime("%m-%d")
-
-        window_size = 5
-        if len(table) > window_size:
-            for col in table.columns:
-                table[col] = moving_average(table[col], window_size)
+        table.index = pd.to_datetime(table.index).strftime("%m-%d")
 
         with st.expander("GPU log"):
             st.line_chart(table)
 
 
-def show_status(status: MachineStatus, gpu_record: pd.DataFrame):
+def show_utilization_history(status: MachineStatus):
+    """GPU utilization of the last day, one line per GPU"""
+    table = pd.DataFrame(
+        {
+            f"GPU {gpu.index}": get_utilization_history(
+                status.machine_id, "gpu_usage", gpu.index
+            )
+            for gpu in status.gpu_status or []
+        }
+    )
+    if len(table) > 0:
+        with st.expander("GPU utilization (24h)"):
+            st.line_chart(table)
+
+
+def show_status(status: MachineStatus, gpu_usage: pd.DataFrame):
 
     with st.container():
         # IP
@@ -282,12 +381,13 @@ def show_status(status: MachineStatus, gpu_record: pd.DataFrame):
         show_gpu_program(status.gpu_compute_processes)
 
         # GPU History
-        show_gpu_history(gpu_record[gpu_record.machine_id == status.machine_id])
+        show_utilization_history(status)
+        show_gpu_history(gpu_usage[gpu_usage.machine_id == status.machine_id])
 
 
-def show_machine_status(server_status: List[MachineStatus], gpu_record: pd.DataFrame):
+def show_machine_status(server_status: List[MachineStatus], gpu_usage: pd.DataFrame):
     for status in server_status:
-        show_status(status, gpu_record)
+        show_status(status, gpu_usage)
 
 
 def main():
@@ -295,9 +395,11 @@ def main():
     st.sidebar.header("Server IP")
 
     machine_status = get_server_status()
-    gpu_record = pd.DataFrame(get_gpu_record())
+    gpu_usage = pd.DataFrame(
+        get_gpu_usage(), columns=["machine_id", "user", "day", "gpu_index", "hours"]
+    )
 
-    show_machine_status(machine_status, gpu_record)
+    show_machine_status(machine_status, gpu_usage)
 
     return
 